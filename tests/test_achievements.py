@@ -1,3 +1,6 @@
+import random
+
+import numpy as np
 import pendulum
 import pyarrow as pa
 from ward import test
@@ -5,7 +8,7 @@ from ward import test
 from tests.testing_utils import test_db
 from trek.core.progress import achievements
 from trek.database import Database, step_schema
-from trek.models import Step
+from trek.models import AchievementState, Id, Step
 
 
 def _preadd_steps(db: Database, day_step_tuples, date):
@@ -29,6 +32,11 @@ def _preadd_steps(db: Database, day_step_tuples, date):
     return steps_table, trek_id, leg_id
 
 
+def _trek_grid(steps_table: pa.Table, leg_id) -> achievements.StepGrid:
+    trek_grid, _ = achievements.step_grids(steps_table, leg_id)
+    return trek_grid
+
+
 @test("most_steps_one_day ")
 def test_most_steps_one_day(db: Database = test_db):
     date = pendulum.date(2000, 2, 5)
@@ -38,19 +46,17 @@ def test_most_steps_one_day(db: Database = test_db):
         (0, 0, 0),
     ]
     steps_table, trek_id, leg_id = _preadd_steps(db, steps, date)
-    res = achievements._most_steps_one_day(steps_table, date)
+    res = achievements.new_record(
+        achievements.most_steps_one_day, _trek_grid(steps_table, leg_id), date
+    )
     assert res is not None
     new, old = res
     assert new == {
-        "trek_id": trek_id,
-        "leg_id": leg_id,
         "user_id": "00000000000000000000000000000003",
         "taken_at": pendulum.date(2000, 2, 5),
         "amount": 2,
     }
     assert old == {
-        "trek_id": trek_id,
-        "leg_id": leg_id,
         "user_id": "00000000000000000000000000000004",
         "taken_at": pendulum.date(2000, 2, 4),
         "amount": 1,
@@ -66,7 +72,9 @@ def test_most_steps_one_day_no_record(db: Database = test_db):
         (0, 0, 0),
     ]
     steps_table, trek_id, leg_id = _preadd_steps(db, steps, date)
-    res = achievements._most_steps_one_day(steps_table, date)
+    res = achievements.new_record(
+        achievements.most_steps_one_day, _trek_grid(steps_table, leg_id), date
+    )
     assert res is None
 
 
@@ -79,20 +87,18 @@ def test_most_steps_one_day_multiple(db: Database = test_db):
         (0, 0, 1),
     ]
     steps_table, trek_id, leg_id = _preadd_steps(db, steps, date)
-    res = achievements._most_steps_one_day(steps_table, date)
+    res = achievements.new_record(
+        achievements.most_steps_one_day, _trek_grid(steps_table, leg_id), date
+    )
     assert res is not None
     new, old = res
     assert new == {
-        "trek_id": trek_id,
-        "leg_id": leg_id,
         "user_id": "00000000000000000000000000000003",
         "taken_at": pendulum.date(2000, 2, 5),
         "amount": 2,
     }
     assert old == {
-        "trek_id": "00000000000000000000000000000000",
         "user_id": "00000000000000000000000000000004",
-        "leg_id": "00000000000000000000000000000001",
         "taken_at": pendulum.date(2000, 2, 5),
         "amount": 2,
     }
@@ -116,16 +122,18 @@ def test_most_steps_one_week(db: Database = test_db):
         (0, 0, 0),
     ]
     steps_table, trek_id, leg_id = _preadd_steps(db, steps, date)
-    res = achievements._most_steps_one_week(steps_table, date)
+    res = achievements.new_record(
+        achievements.most_steps_one_week, _trek_grid(steps_table, leg_id), date
+    )
     assert res is not None
     new, old = res
     assert new == {
-        "amount": 7.0,
+        "amount": 7,
         "taken_at": pendulum.date(2000, 2, 5),
         "user_id": "00000000000000000000000000000003",
     }
     assert old == {
-        "amount": 6.0,
+        "amount": 6,
         "taken_at": pendulum.date(2000, 2, 3),
         "user_id": "00000000000000000000000000000003",
     }
@@ -138,7 +146,9 @@ def test_most_steps_one_week_too_few_days(db: Database = test_db):
         (0, 2, 0),
     ]
     steps_table, trek_id, leg_id = _preadd_steps(db, steps, date)
-    res = achievements._most_steps_one_week(steps_table, date)
+    res = achievements.new_record(
+        achievements.most_steps_one_week, _trek_grid(steps_table, leg_id), date
+    )
     assert res is None
 
 
@@ -160,10 +170,82 @@ def test_most_steps_one_week_no_record(db: Database = test_db):
         (0, 0, 0),
     ]
     steps_table, trek_id, leg_id = _preadd_steps(db, steps, date)
-    res = achievements._most_steps_one_week(steps_table, date)
+    res = achievements.new_record(
+        achievements.most_steps_one_week, _trek_grid(steps_table, leg_id), date
+    )
     assert res is None
 
 
+@test("most_steps_one_week_skips_missing_days")
+def test_most_steps_one_week_missing_day(db: Database = test_db):
+    date = pendulum.date(2000, 2, 1)
+    trek_id = db.make_id()
+    leg_id = db.make_id()
+    steps: list[Step] = [
+        {
+            "trek_id": trek_id,
+            "leg_id": leg_id,
+            "user_id": user_id,
+            "taken_at": date.add(days=day),
+            "amount": amount,
+        }
+        for day in range(9)
+        for user_id, amount in [(Id("a"), 1000 + day), (Id("b"), 50000)]
+        # the tracker of b could not be reached on the fifth day
+        if not (user_id == "b" and day == 4)
+    ]
+    grid, _ = achievements.step_grids(
+        pa.Table.from_pylist(steps, schema=step_schema), leg_id
+    )
+    last_day = date.add(days=8)
+    res = achievements.new_record(achievements.most_steps_one_week, grid, last_day)
+    assert res == (
+        {"user_id": "b", "taken_at": last_day, "amount": 350000},
+        {"user_id": "b", "taken_at": date.add(days=7), "amount": 350000},
+    )
+    state = achievements.replay(
+        achievements.most_steps_one_week, trek_id, trek_id, grid
+    )
+    assert achievements._state_record(state) == res[0]
+
+
+@test("most_steps_one_week_sums_each_users_last_seven_steps")
+def test_weekly_amounts_match_rolling_sums():
+    rand = random.Random(2)
+    steps = pa.Table.from_pylist(
+        [
+            {
+                "trek_id": "trek",
+                "leg_id": "leg",
+                "user_id": user_id,
+                "taken_at": pendulum.date(2000, 2, 1).add(days=day),
+                "amount": rand.randint(0, 10000),
+            }
+            for day in range(40)
+            for user_id in ["a", "b", "c"]
+            if rand.random() < 0.8
+        ],
+        schema=step_schema,
+    )
+    grid, _ = achievements.step_grids(steps, Id("leg"))
+    weekly = achievements._weekly_amounts(grid)
+    rolling = (
+        steps.to_pandas()
+        .sort_values(["user_id", "taken_at"])
+        .set_index("taken_at")
+        .groupby("user_id")["amount"]
+        .rolling(7)
+        .sum()
+        .dropna()
+    )
+    days = {achievements.EPOCH.add(days=int(day)): i for i, day in enumerate(grid.days)}
+    users = {user_id: i for i, user_id in enumerate(grid.user_ids.to_pylist())}
+    expected = np.full(weekly.shape, np.nan)
+    for (user_id, taken_at), amount in rolling.items():
+        expected[days[taken_at], users[user_id]] = amount
+    np.testing.assert_array_equal(weekly, expected)
+
+
 @test("longest_streak")
 def test_longest_streak(db: Database = test_db):
     date = pendulum.date(2000, 2, 5)
@@ -175,22 +257,20 @@ def test_longest_streak(db: Database = test_db):
         (0, 1, 2),
     ]
     steps_table, trek_id, leg_id = _preadd_steps(db, steps, date)
-    res = achievements._longest_streak(steps_table, date)
+    res = achievements.new_record(
+        achievements.longest_streak, _trek_grid(steps_table, leg_id), date
+    )
     assert res is not None
     new, old = res
 
     assert new == {
         "amount": 3,
         "taken_at": pendulum.date(2000, 2, 5),
-        "trek_id": trek_id,
-        "leg_id": leg_id,
         "user_id": "00000000000000000000000000000003",
     }
     assert old == {
         "amount": 2,
         "taken_at": pendulum.date(2000, 2, 2),
-        "trek_id": trek_id,
-        "leg_id": leg_id,
         "user_id": "00000000000000000000000000000004",
     }
 
@@ -206,5 +286,127 @@ def test_longest_streak_no_record(db: Database = test_db):
         (0, 1, 2),
     ]
     steps_table, trek_id, leg_id = _preadd_steps(db, steps, date)
-    res = achievements._longest_streak(steps_table, date)
+    res = achievements.new_record(
+        achievements.longest_streak, _trek_grid(steps_table, leg_id), date
+    )
     assert res is None
+
+
+@test("step_grids_leg_scope")
+def test_step_grids_leg_scope(db: Database = test_db):
+    date = pendulum.date(2000, 2, 5)
+    steps = [
+        (0, 2, 0),
+        (0, 0, 1),
+        (3, 0, 0),
+    ]
+    steps_table, trek_id, leg_id = _preadd_steps(db, steps, date)
+    # the first day was on another leg
+    next_leg_id = db.make_id()
+    steps_table = steps_table.set_column(
+        1,
+        "leg_id",
+        pa.array([next_leg_id] * 6 + [leg_id] * 3),
+    )
+    trek_grid, leg_grid = achievements.step_grids(steps_table, next_leg_id)
+    assert trek_grid.amounts.shape == (3, 3)
+    assert leg_grid.amounts.shape == (2, 3)
+    assert (
+        achievements.new_record(achievements.most_steps_one_day, trek_grid, date)
+        is None
+    )
+    res = achievements.new_record(achievements.most_steps_one_day, leg_grid, date)
+    assert res is not None
+    new, old = res
+    assert new["amount"] == 2
+    assert old == {
+        "user_id": "00000000000000000000000000000004",
+        "taken_at": pendulum.date(2000, 2, 4),
+        "amount": 1,
+    }
+
+
+@test("advance_matches_full_recompute")
+def test_advance_matches_full_recompute(db: Database = test_db):
+    rand = random.Random(1)
+    date = pendulum.date(2000, 2, 1)
+    trek_id = db.make_id()
+    leg_id = db.make_id()
+    user_ids = [db.make_id() for _ in range(4)]
+    steps: list[Step] = [
+        {
+            "trek_id": trek_id,
+            "leg_id": leg_id,
+            "user_id": user_id,
+            "taken_at": date.add(days=day),
+            "amount": rand.randint(0, 4),
+        }
+        for day in range(20)
+        for user_id in rand.sample(user_ids, rand.randint(1, 4))
+    ]
+    grid, _ = achievements.step_grids(
+        pa.Table.from_pylist(steps, schema=step_schema), leg_id
+    )
+    for achievement in achievements.possible_achievements:
+        state = achievements.empty_state(trek_id, trek_id, achievement)
+        for i in range(len(grid.days)):
+            day = date.add(days=i)
+            day_user_ids, amounts = achievements._day_amounts(
+                state["user_ids"], [step for step in steps if step["taken_at"] == day]
+            )
+            res = achievements.advance(achievement, state, day, day_user_ids, amounts)
+            history = achievements.StepGrid(
+                days=grid.days[: i + 1],
+                user_ids=grid.user_ids,
+                amounts=grid.amounts[: i + 1],
+            )
+            assert res == achievements.new_record(achievement, history, day)
+            assert achievements._state_record(state) == achievements.best_record(
+                achievement, history
+            )
+
+
+@test("main_updates_states_that_check_against_history")
+def test_main_updates_states(db: Database = test_db):
+    date = pendulum.date(2000, 2, 1)
+    trek_id = db.make_id()
+    leg_id = db.make_id()
+    user_ids = [db.make_id(), db.make_id()]
+    days = [(1, 0), (0, 2), (0, 2), (3, 0), (0, 4)]
+    results = []
+    for i, day_amounts in enumerate(days):
+        steps: list[Step] = [
+            {
+                "trek_id": trek_id,
+                "leg_id": leg_id,
+                "user_id": user_id,
+                "taken_at": date.add(days=i),
+                "amount": amount,
+            }
+            for user_id, amount in zip(user_ids, day_amounts)
+        ]
+        db.append_records(Step, steps)
+        results.append(achievements.main(db, trek_id, leg_id, date.add(days=i), steps))
+    db.close()
+    assert results[:2] == [None, None]
+    assert results[3] is not None and results[4] is not None
+    assert [a["achievement_type"] for a in results[3]] == ["most_steps_one_day"]
+    assert [(a["amount"], a["old_amount"]) for a in results[4]] == [(4, 3)]
+    states = db.load_records(AchievementState, where={"trek_id": trek_id})
+    assert len(states) == 6
+    assert {state["n_days"] for state in states} == {5}
+    assert achievements.check(db, trek_id) == []
+
+    # a day's steps added after the fact are not in the states until rebuilt
+    late_step: Step = {
+        "trek_id": trek_id,
+        "leg_id": leg_id,
+        "user_id": db.make_id(),
+        "taken_at": date.add(days=2),
+        "amount": 9,
+    }
+    db.append_record(Step, late_step)
+    mismatches = achievements.check(db, trek_id)
+    assert len(mismatches) == 4
+    achievements.rebuild(db, trek_id)
+    assert achievements.check(db, trek_id) == []
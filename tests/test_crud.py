@@ -1,16 +1,21 @@
 import datetime as dt
+import math
+import uuid
 
 from freezegun import freeze_time
+from geopy.distance import geodesic, great_circle
+import numpy as np
 import pendulum
+import polyline
 import pyarrow as pa
 import pyarrow.compute as pc
 from ward import fixture, raises, test
 
 from tests.testing_utils import test_db
 from trek import exceptions as exc
-from trek.core import crud
+from trek.core import crud, geometry
 from trek.database import Database, trek_user_schema, user_schema, waypoint_schema
-from trek.models import Id, Leg, Trek, TrekUser, User, Waypoint
+from trek.models import Id, Leg, Location, Trek, TrekUser, User, Waypoint
 
 # @test("flake")
 # def test_flake(db: Database = test_db):
@@ -394,7 +399,7 @@ def test_delete(db=test_db):
     assert db.load_table(Trek).num_rows == 1
     assert db.load_table(Leg).num_rows == 1
     assert db.load_table(Waypoint).num_rows == 4
-    assert db.load_table(TrekUser).num_rows == 2
+    assert db.load_table(TrekUser).num_rows == 0
 
 
 @test("test_generate_invite")
@@ -536,3 +541,127 @@ def test_deactivate_trek(db=test_db):
             "output_to": None,
         },
     ]
+
+
+@test("get_leg_simplifies_the_polyline_for_the_map_size")
+def test_get_leg_simplified(db=test_db):
+    points = [
+        (round(59.9 + i * 0.001, 5), round(10.7 + 0.0003 * math.sin(i), 5))
+        for i in range(400)
+    ]
+    request = crud.AddTrekRequest(
+        progress_at_hour=12,
+        progress_at_tz="CET",
+        output_to="discord",
+        polyline=polyline.encode(points, 5),
+    )
+    user_id = db.make_id()
+    trek_id = crud.add_trek(request, db, user_id).trek_id
+    leg_id = db.load_records(Leg)[0]["id"]
+    location = {
+        "trek_id": trek_id,
+        "leg_id": leg_id,
+        "added_at": pendulum.date(2000, 2, 5),
+        "latest_waypoint": "waypoint",
+        "lat": 60.0,
+        "lon": 10.7,
+        "distance": 1e6,
+    }
+    db.append_record(Location, location)
+
+    small = crud.get_leg(trek_id, leg_id, db, user_id, pixels=100)
+    large = crud.get_leg(trek_id, leg_id, db, user_id, pixels=1_000_000)
+    assert polyline.decode(large.polyline, 5) == points
+    small_points = polyline.decode(small.polyline, 5)
+    assert len(small_points) < len(points) / 4
+    assert small_points[0] == points[0] and small_points[-1] == points[-1]
+    assert small.start == {"lat": points[0][0], "lon": points[0][1]}
+
+
+@test("get_leg_ends_a_simplified_straight_line_at_the_last_waypoint_passed")
+def test_get_leg_straight_line_end(db=test_db):
+    points = [(round(59.9 + i * 0.001, 5), 10.7) for i in range(400)]
+    request = crud.AddTrekRequest(
+        progress_at_hour=12,
+        progress_at_tz="CET",
+        output_to="discord",
+        polyline=polyline.encode(points, 5),
+    )
+    user_id = db.make_id()
+    trek_id = crud.add_trek(request, db, user_id).trek_id
+    leg_id = db.load_records(Leg)[0]["id"]
+    distances = (
+        db.load_table(Waypoint, columns=["distance"])
+        .sort_by("distance")
+        .column("distance")
+        .to_pylist()
+    )
+    location = {
+        "trek_id": trek_id,
+        "leg_id": leg_id,
+        "added_at": pendulum.date(2000, 2, 5),
+        "latest_waypoint": "waypoint",
+        "lat": 60.15,
+        "lon": 10.7,
+        "distance": (distances[250] + distances[251]) / 2,
+    }
+    db.append_record(Location, location)
+
+    res = crud.get_leg(trek_id, leg_id, db, user_id, pixels=100)
+    line = polyline.decode(res.polyline, 5)
+    # the coarse level keeps little more than the ends of the leg
+    assert len(line) < 10
+    assert res.start == {"lat": points[0][0], "lon": points[0][1]}
+    assert res.end == {"lat": points[250][0], "lon": points[250][1]}
+    assert line[-1] == points[250]
+
+
+@test("waypoint ingestion decodes and measures like polyline and geopy")
+def test_waypoint_ingestion_parity():
+    rng = np.random.default_rng(0)
+    points = [
+        (round(lat, 5), round(lon, 5))
+        for lat, lon in zip(rng.uniform(-89, 89, 500), rng.uniform(-180, 180, 500))
+    ]
+    # nearly antipodal, where Vincenty's formula does not converge
+    points += [(0.0, 0.0), (0.5, 179.7)]
+    expression = polyline.encode(points, 5)
+    lat, lon = geometry.decode_polyline(expression, 5)
+    assert list(zip(lat.tolist(), lon.tolist())) == polyline.decode(expression, 5)
+
+    lengths = geometry.segment_lengths(lat, lon, "ellipsoidal")
+    exp = [geodesic(a, b).m for a, b in zip(points, points[1:])]
+    assert np.allclose(lengths, exp, rtol=0, atol=1e-3)
+    lengths = geometry.segment_lengths(lat, lon, "haversine")
+    exp = [great_circle(a, b).m for a, b in zip(points, points[1:])]
+    assert np.allclose(lengths, exp, rtol=1e-9)
+
+    ids = Database.make_ids(3).to_pylist()
+    assert len(set(ids)) == 3
+    assert all(uuid.UUID(id_).version == 4 and uuid.UUID(id_).hex == id_ for id_ in ids)
+
+
+@test("leg_summary_is_stored_with_the_waypoints")
+def test_leg_summary_is_stored(db=test_db):
+    points = [(59.9, 10.7), (59.95, 10.6), (60.0, 10.75)]
+    request = crud.AddTrekRequest(
+        progress_at_hour=12,
+        progress_at_tz="CET",
+        output_to="discord",
+        polyline=polyline.encode(points, 5),
+    )
+    user_id = db.make_id()
+    trek_id = crud.add_trek(request, db, user_id).trek_id
+    leg_id = db.load_records(Leg)[0]["id"]
+    waypoints = db.load_records(Waypoint, where={"trek_id": trek_id})
+    # the summary is read without the waypoints
+    db.delete_partion(Waypoint, trek_id)
+
+    summary = geometry.load_summary(db, trek_id, leg_id)
+    assert summary["n_waypoints"] == 3
+    assert summary["total_distance"] == waypoints[-1]["distance"]
+    assert (summary["end_lat"], summary["end_lon"]) == points[-1]
+    assert (summary["min_lat"], summary["min_lon"]) == (59.9, 10.6)
+    assert (summary["max_lat"], summary["max_lon"]) == (60.0, 10.75)
+    trek = crud.get_trek(trek_id, db, user_id)
+    assert trek.current_location == waypoints[0]
@@ -0,0 +1,633 @@
+import asyncio
+from pathlib import Path
+import threading
+from unittest import mock
+
+import pendulum
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from ward import raises, test
+
+from tests.testing_utils import make_temp_dir, test_db
+from trek import config
+from trek.database import (
+    INDEX_SUFFIX,
+    JOURNAL_NAME,
+    LOCK_NAME,
+    AsyncDatabase,
+    CommitConflictError,
+    Database,
+    ReadOnlyError,
+    ReadWriteLock,
+    TableCache,
+    ValidationError,
+    _index_rows,
+    _list_fragments,
+    migrate,
+    table_cache,
+    table_metadatas,
+)
+from trek.models import Id, Step, Trek, Waypoint
+
+
+def _trek_record(trek_id: str) -> dict:
+    return {
+        "id": trek_id,
+        "owner_id": "owner",
+        "is_active": False,
+        "progress_at_hour": 12,
+        "progress_at_tz": "UTC",
+        "output_to": None,
+    }
+
+
+def _waypoint_record(trek_id: str) -> dict:
+    return {
+        "id": "waypoint",
+        "trek_id": trek_id,
+        "leg_id": "leg",
+        "lat": 0.0,
+        "lon": 0.0,
+        "distance": 0.0,
+    }
+
+
+def _step_record(trek_id: str, leg_id: str) -> dict:
+    return {
+        "trek_id": trek_id,
+        "leg_id": leg_id,
+        "user_id": "user",
+        "taken_at": pendulum.Date(2022, 1, 1),
+        "amount": 1,
+    }
+
+
+@test("append_record writes delta fragments")
+def test_append_record_deltas(db: Database = test_db):
+    for i in range(3):
+        db.append_record(Trek, _trek_record(f"trek{i}"))
+
+    fragments = _list_fragments(db.save_dir / "treks")
+    assert len(fragments) == 3
+    assert all(path.name.startswith("delta-00000") for path in fragments)
+    trek_ids = db.load_table(Trek).column("id").to_pylist()
+    assert trek_ids == ["trek0", "trek1", "trek2"]
+
+
+@test("compact merges base and deltas")
+def test_compact(db: Database = test_db):
+    db.save_table(Trek, db.load_table(Trek))
+    for i in range(3):
+        db.append_record(Trek, _trek_record(f"trek{i}"))
+
+    db.compact(Trek)
+
+    fragments = _list_fragments(db.save_dir / "treks")
+    assert len(fragments) == 1
+    assert fragments[0].name.startswith("part-")
+    trek_ids = db.load_table(Trek).column("id").to_pylist()
+    assert trek_ids == ["trek0", "trek1", "trek2"]
+
+
+@test("commit moves new fragments and removes replaced ones")
+def test_commit(temp_dir: Path = make_temp_dir):
+    save_dir = temp_dir / "save"
+    load_dir = temp_dir / "load"
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    db.append_record(Trek, _trek_record("trek0"))
+    db.compact(Trek)
+    db.commit()
+    db.close()
+    base = _list_fragments(load_dir / "treks")
+    assert len(base) == 1
+
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    db.append_record(Trek, _trek_record("trek1"))
+    db.commit()
+    db.close()
+    fragments = _list_fragments(load_dir / "treks")
+    assert fragments[0] == base[0]
+    assert len(fragments) == 2
+
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    db.compact(Trek)
+    db.commit()
+    db.close()
+    assert len(_list_fragments(load_dir / "treks")) == 1
+    assert _list_fragments(save_dir / "treks") == []
+    trek_ids = db.load_table(Trek).column("id").to_pylist()
+    assert trek_ids == ["trek0", "trek1"]
+
+
+@test("commit of a deleted partition removes its directory")
+def test_commit_delete_partition(temp_dir: Path = make_temp_dir):
+    save_dir = temp_dir / "save"
+    load_dir = temp_dir / "load"
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    for trek_id in ["trek0", "trek1"]:
+        db.append_record(Waypoint, _waypoint_record(trek_id))
+    db.commit()
+    db.close()
+    assert (load_dir / "waypoints" / "trek0").exists()
+
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    db.delete_partion(Waypoint, Id("trek0"))
+    db.commit()
+    db.close()
+    assert not (load_dir / "waypoints" / "trek0").exists()
+    assert (load_dir / "waypoints" / "trek1" / "leg").exists()
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    assert db.load_table(Waypoint).column("trek_id").to_pylist() == ["trek1"]
+
+
+@test("recover removes files from an interrupted commit")
+def test_recover(temp_dir: Path = make_temp_dir):
+    save_dir = temp_dir / "save"
+    load_dir = temp_dir / "load"
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    db.append_record(Trek, _trek_record("trek0"))
+    db.commit()
+    db.close()
+    committed = _list_fragments(load_dir / "treks")
+
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    db.append_record(Trek, _trek_record("trek1"))
+    # crash after moving the new fragment, before the manifest was replaced
+    orphan = db._move_into_place(table_metadatas[Trek])[-1]
+    (load_dir / JOURNAL_NAME).write_text('{"treks": ["."]}')
+    assert len(_list_fragments(load_dir / "treks")) == 2
+
+    db.close()
+    Database.recover(load_dir)
+
+    assert _list_fragments(load_dir / "treks") == committed
+    assert orphan.path not in committed
+    assert not (load_dir / JOURNAL_NAME).exists()
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    assert db.load_table(Trek).column("id").to_pylist() == ["trek0"]
+
+
+@test("sessions read the version that was current when they opened")
+def test_snapshot_isolation(temp_dir: Path = make_temp_dir):
+    save_dir = temp_dir / "save"
+    load_dir = temp_dir / "load"
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    db.append_record(Trek, _trek_record("trek0"))
+    db.commit()
+    db.close()
+
+    reader = Database(save_dir=load_dir, load_dir=load_dir, read_only=True)
+    writer = Database(save_dir=save_dir, load_dir=load_dir)
+    writer.append_record(Trek, _trek_record("trek1"))
+    writer.compact(Trek)
+    writer.commit()
+    writer.close()
+
+    # the files of the pinned version outlive the commit that replaced them
+    assert reader.load_table(Trek).column("id").to_pylist() == ["trek0"]
+    assert len(_list_fragments(load_dir / "treks")) == 2
+    reader.close()
+
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    assert db.load_table(Trek).column("id").to_pylist() == ["trek0", "trek1"]
+    db.append_record(Trek, _trek_record("trek2"))
+    db.commit()
+    db.close()
+    # collected once no session pins the old version anymore
+    assert len(_list_fragments(load_dir / "treks")) == 2
+    assert len(list((load_dir / "_versions").iterdir())) == 1
+
+
+@test("concurrent appends are rebased, concurrent rewrites are redone")
+def test_concurrent_commits(temp_dir: Path = make_temp_dir):
+    load_dir = temp_dir / "load"
+    first = Database(save_dir=temp_dir / "first", load_dir=load_dir)
+    second = Database(save_dir=temp_dir / "second", load_dir=load_dir)
+    first.append_record(Trek, _trek_record("trek0"))
+    second.append_record(Trek, _trek_record("trek1"))
+    first.commit()
+    second.commit()
+    first.close()
+    second.close()
+
+    db = Database(save_dir=temp_dir / "first", load_dir=load_dir)
+    assert db.load_table(Trek).column("id").to_pylist() == ["trek0", "trek1"]
+    db.close()
+
+    first = Database(save_dir=temp_dir / "first", load_dir=load_dir)
+    second = Database(save_dir=temp_dir / "second", load_dir=load_dir)
+    third = Database(save_dir=temp_dir / "third", load_dir=load_dir)
+    first.append_record(Trek, _trek_record("trek2"))
+    trek0 = {**_trek_record("trek0"), "progress_at_hour": 18}
+    second.upsert_records(Trek, pa.Table.from_pylist([trek0]), key_columns=["id"])
+    third.compact(Trek)
+    first.commit()
+    second.commit()
+    version = second.version
+    # compaction is not redone, nothing is left to commit
+    third.commit()
+    for db in [first, second, third]:
+        db.close()
+
+    db = Database(save_dir=temp_dir / "first", load_dir=load_dir)
+    assert db.version == version
+    treks = db.load_table(Trek).sort_by("id")
+    assert treks.column("id").to_pylist() == ["trek0", "trek1", "trek2"]
+    assert treks.column("progress_at_hour").to_pylist() == [18, 12, 12]
+    db.close()
+
+    first = Database(save_dir=temp_dir / "first", load_dir=load_dir)
+    second = Database(save_dir=temp_dir / "second", load_dir=load_dir)
+    first.save_table(Trek, pa.Table.from_pylist([_trek_record("trek0")]))
+    second.save_table(Trek, pa.Table.from_pylist([_trek_record("trek1")]))
+    first.commit()
+    with mock.patch.object(config, "commit_retries", 0):
+        with raises(CommitConflictError):
+            second.commit()
+    first.close()
+    second.close()
+
+
+@test("staged sessions merge into one commit, rewrites of one partition are redone")
+def test_stage_merge(temp_dir: Path = make_temp_dir):
+    load_dir = temp_dir / "load"
+    db = Database(save_dir=temp_dir / "save", load_dir=load_dir)
+    db.append_record(Trek, _trek_record("trek0"))
+    db.commit()
+    version = db.version
+
+    first = db.stage()
+    second = db.stage()
+    steps: list = [_step_record("trek1", "leg")]
+    first.append_records(Step, steps)
+    # reading the table applies the append in the staged session
+    assert first.load_table(Step).num_rows == 1
+    first.upsert_records(
+        Trek, pa.Table.from_pylist([_trek_record("trek1")]), key_columns=["id"]
+    )
+    second.append_record(Trek, _trek_record("trek2"))
+    second.compact(Trek)
+    db.merge(first)
+    db.merge(second)
+    db.commit()
+    first.close()
+    second.close()
+    db.close()
+
+    db = Database(save_dir=temp_dir / "save", load_dir=load_dir)
+    treks = db.load_table(Trek).column("id").to_pylist()
+    assert treks == ["trek0", "trek1", "trek2"]
+    assert db.load_table(Step).column("trek_id").to_pylist() == ["trek1"]
+    # the merged changes were committed as one version
+    assert db.version == version + 1
+    db.close()
+
+
+@test("cached tables are decoded once per version")
+def test_table_cache(temp_dir: Path = make_temp_dir):
+    save_dir = temp_dir / "save"
+    load_dir = temp_dir / "load"
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    db.append_record(Trek, _trek_record("trek0"))
+    db.commit()
+
+    hits, misses = table_cache.hits, table_cache.misses
+    assert db.load_table(Trek).num_rows == 1
+    trek0 = db.load_table(Trek, filter=pc.field("id") == "trek0", columns=["id"])
+    assert trek0.column_names == ["id"]
+    assert (table_cache.hits, table_cache.misses) == (hits + 1, misses + 1)
+
+    # staged changes are not cached
+    db.append_record(Trek, _trek_record("trek1"))
+    assert db.load_table(Trek).num_rows == 2
+    assert (table_cache.hits, table_cache.misses) == (hits + 1, misses + 1)
+
+    db.commit()
+    db.close()
+    assert db.load_table(Trek).num_rows == 2
+    assert table_cache.misses == misses + 2
+
+
+@test("table cache evicts least recently used tables over budget")
+def test_table_cache_eviction():
+    table = pa.table({"id": ["a" * 100]})
+    cache = TableCache(max_bytes=table.nbytes * 2)
+    keys = [(Path("tables"), name, ()) for name in ["a", "b", "c"]]
+    cache.put(keys[0], table)
+    cache.put(keys[1], table)
+    assert cache.get(keys[0]) is table
+    cache.put(keys[2], table)
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is table
+    assert cache.n_bytes == table.nbytes * 2
+    cache.invalidate(Path("tables"), "a")
+    assert cache.get(keys[0]) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+@test("indexed lookups only return rows with the key")
+def test_index_lookup(temp_dir: Path = make_temp_dir):
+    save_dir = temp_dir / "save"
+    load_dir = temp_dir / "load"
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    for leg_id in ["leg0", "leg1", "leg0"]:
+        db.append_record(Step, _step_record("trek", leg_id))
+    db.commit()
+    db.close()
+    index_files = list((load_dir / "steps").rglob(f"*{INDEX_SUFFIX}"))
+    assert len(index_files) == 3
+
+    db = Database(save_dir=save_dir, load_dir=load_dir, read_only=True)
+    leg0 = db.load_table(Step, where={"trek_id": "trek", "leg_id": "leg0"})
+    assert leg0.column("leg_id").to_pylist() == ["leg0", "leg0"]
+    assert db.load_table(Step, where={"trek_id": "other"}).num_rows == 0
+    leg1 = db.load_records(
+        Step,
+        filter=pc.field("amount") == 1,
+        where={"user_id": "user", "leg_id": "leg1"},
+    )
+    assert len(leg1) == 1
+    db.close()
+
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    db.compact(Step)
+    db.commit()
+    db.close()
+    assert len(list((load_dir / "steps").rglob(f"*{INDEX_SUFFIX}"))) == 1
+
+
+@test("lookups on cached tables take the rows of the key from an index")
+def test_cached_index_lookup(temp_dir: Path = make_temp_dir):
+    db = Database(save_dir=temp_dir / "save", load_dir=temp_dir / "load")
+    for trek_id in ["trek0", "trek1", "trek2"]:
+        db.append_record(Trek, _trek_record(trek_id))
+    db.commit()
+    with mock.patch("trek.database._index_rows", wraps=_index_rows) as index_rows:
+        trek1 = db.load_records(Trek, columns=["id"], where={"id": "trek1"})
+        assert trek1 == [{"id": "trek1"}]
+        assert db.load_table(Trek, where={"id": "other"}).num_rows == 0
+        # the index is built once per version of the table
+        assert index_rows.call_count == 1
+    db.close()
+
+
+@test("migrate indexes the fragments written before the table had indexes")
+def test_migrate_indexes(temp_dir: Path = make_temp_dir):
+    db = Database(save_dir=temp_dir / "save", load_dir=temp_dir / "load")
+    steps: list = [_step_record("trek0", "leg"), _step_record("trek1", "leg")]
+    db.append_records(Step, steps)
+    db.commit()
+    db.close()
+    legacy_dir = temp_dir / "load" / "steps" / "trek_id=trek0"
+    next(legacy_dir.rglob(f"*{INDEX_SUFFIX}")).unlink()
+    indexed = _list_fragments(temp_dir / "load" / "steps" / "trek_id=trek1")
+
+    with mock.patch.object(config, "tables_path", temp_dir / "load"):
+        migrate()
+    assert len(list(legacy_dir.rglob(f"*{INDEX_SUFFIX}"))) == 1
+    # partitions that were indexed already are left alone
+    assert _list_fragments(temp_dir / "load" / "steps" / "trek_id=trek1") == indexed
+    db = Database(save_dir=temp_dir / "save", load_dir=temp_dir / "load")
+    assert db.load_table(Step, where={"trek_id": "trek0"}).num_rows == 1
+    db.close()
+
+
+@test("unique indexes refuse duplicate keys")
+def test_unique_index(db: Database = test_db):
+    db.append_record(Trek, _trek_record("trek0"))
+    with raises(ValidationError):
+        db.append_record(Trek, _trek_record("trek0"))
+    table = pa.Table.from_pylist(
+        [_trek_record("trek1"), _trek_record("trek1")],
+        schema=table_metadatas[Trek].schema,
+    )
+    with raises(ValidationError):
+        db.save_table(Trek, table)
+    assert db.load_table(Trek).column("id").to_pylist() == ["trek0"]
+
+
+@test("steps are written to and deleted from their trek's partition")
+def test_trek_partitions(temp_dir: Path = make_temp_dir):
+    save_dir = temp_dir / "save"
+    load_dir = temp_dir / "load"
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    steps: list = [_step_record("trek0", "leg"), _step_record("trek1", "leg")]
+    db.append_records(Step, steps)
+    db.append_record(Step, _step_record("trek1", "leg"))
+    db.commit()
+    db.close()
+    assert len(_list_fragments(load_dir / "steps" / "trek_id=trek0")) == 1
+    assert len(_list_fragments(load_dir / "steps" / "trek_id=trek1")) == 2
+
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    db.compact(Step, {Path("trek_id=trek1")})
+    db.delete_records(Step, pc.field("trek_id") == "trek0")
+    db.commit()
+    db.close()
+    assert not (load_dir / "steps" / "trek_id=trek0").exists()
+    assert len(_list_fragments(load_dir / "steps" / "trek_id=trek1")) == 1
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    assert db.load_table(Step).column("trek_id").to_pylist() == ["trek1", "trek1"]
+    db.close()
+
+
+@test("repartition moves unpartitioned fragments into partitions")
+def test_repartition(temp_dir: Path = make_temp_dir):
+    save_dir = temp_dir / "save"
+    load_dir = temp_dir / "load"
+    steps = pa.Table.from_pylist(
+        [_step_record("trek0", "leg"), _step_record("trek1", "leg")],
+        schema=table_metadatas[Step].schema,
+    )
+    ds.write_dataset(steps, load_dir / "steps", format="parquet")
+
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    assert db.load_table(Step, where={"trek_id": "trek1"}).num_rows == 1
+    db.repartition(Step)
+    db.commit()
+    db.close()
+    assert all(
+        path.parent.name.startswith("trek_id=")
+        for path in _list_fragments(load_dir / "steps")
+    )
+    db = Database(save_dir=save_dir, load_dir=load_dir)
+    assert db.load_table(Step).num_rows == 2
+    db.close()
+
+
+@test("fragments are written sorted in row groups that range filters skip")
+def test_sorted_row_groups(db: Database = test_db):
+    waypoints = [
+        {
+            "id": f"waypoint{i}",
+            "trek_id": "trek",
+            "leg_id": "leg",
+            "lat": 0.0,
+            "lon": 0.0,
+            "distance": float(i),
+        }
+        for i in reversed(range(3000))
+    ]
+    table = pa.Table.from_pylist(waypoints, schema=table_metadatas[Waypoint].schema)
+    db.save_table(Waypoint, table)
+
+    (path,) = (db.save_dir / "waypoints").rglob("*.parquet")
+    (fragment,) = ds.dataset(path, format="parquet").get_fragments()
+    assert fragment.num_row_groups == 3
+    in_range = (pc.field("distance") >= 1500) & (pc.field("distance") <= 1600)
+    assert fragment.subset(in_range).num_row_groups == 1
+    distances = db.load_table(Waypoint, filter=in_range).column("distance")
+    assert distances.to_pylist() == [float(i) for i in range(1500, 1601)]
+
+
+@test("upsert_records replaces rows by key and appends new ones")
+def test_upsert_records(db: Database = test_db):
+    schema = table_metadatas[Trek].schema
+    treks: list = [_trek_record("trek0"), _trek_record("trek1")]
+    db.append_records(Trek, treks)
+    upserts = [_trek_record("trek1"), _trek_record("trek2"), _trek_record("trek1")]
+    upserts[0]["progress_at_hour"] = 1
+    upserts[2]["progress_at_hour"] = 2
+    db.upsert_records(Trek, pa.Table.from_pylist(upserts, schema=schema), ["id"])
+
+    treks = db.load_records(Trek)
+    assert [trek["id"] for trek in treks] == ["trek0", "trek2", "trek1"]
+    assert treks[2]["progress_at_hour"] == 2
+
+    keys = pa.table({"id": ["trek0", "trek2", "missing"]})
+    db.delete_records_many(Trek, keys)
+    assert db.load_table(Trek).column("id").to_pylist() == ["trek1"]
+
+
+@test("upsert_records rewrites only the partitions holding replaced rows")
+def test_upsert_records_partitions(temp_dir: Path = make_temp_dir):
+    db = Database(save_dir=temp_dir / "save", load_dir=temp_dir / "load")
+    steps: list = [_step_record("trek0", "leg0"), _step_record("trek1", "leg1")]
+    db.append_records(Step, steps)
+    db.commit()
+
+    replaced = {**_step_record("trek0", "leg0"), "amount": 5}
+    added = {**_step_record("trek1", "leg1"), "user_id": "other"}
+    db.upsert_records(
+        Step,
+        pa.Table.from_pylist([replaced, added]),
+        key_columns=["trek_id", "leg_id", "user_id", "taken_at"],
+    )
+    # trek1 is only appended to, so it merges with other sessions' appends
+    trek1 = [
+        f.path for f in db._fragments["steps"] if f.path.parts[0] == "trek_id=trek1"
+    ]
+    assert trek1[:1] == db._base["steps"][1:]
+    amounts = db.load_table(Step).sort_by(
+        [("trek_id", "ascending"), ("user_id", "ascending")]
+    )
+    assert amounts.column("amount").to_pylist() == [5, 1, 1]
+    db.close()
+
+
+@test("upsert_committed survives concurrent writers of the table")
+def test_upsert_committed(temp_dir: Path = make_temp_dir):
+    load_dir = temp_dir / "load"
+    db = Database(save_dir=temp_dir / "save", load_dir=load_dir)
+    db.append_record(Trek, _trek_record("trek0"))
+    db.commit()
+
+    def persist(trek_id: str) -> None:
+        table = pa.Table.from_pylist([_trek_record(trek_id)])
+        db.upsert_committed(Trek, table, key_columns=["id"])
+
+    threads = [threading.Thread(target=persist, args=(f"trek{i}",)) for i in [1, 2]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # the session does not see them, and its own rewrite is redone on top
+    assert db.load_table(Trek).num_rows == 1
+    trek0 = {**_trek_record("trek0"), "progress_at_hour": 18}
+    db.upsert_records(Trek, pa.Table.from_pylist([trek0]), key_columns=["id"])
+    db.commit()
+    db.close()
+
+    db = Database(save_dir=temp_dir / "save", load_dir=load_dir)
+    treks = db.load_table(Trek).sort_by("id")
+    assert treks.column("id").to_pylist() == ["trek0", "trek1", "trek2"]
+    assert treks.column("progress_at_hour").to_pylist() == [18, 12, 12]
+    db.close()
+
+
+@test("batch writes consecutive mutations of a table once")
+def test_batch(db: Database = test_db):
+    with db.batch():
+        for i in range(3):
+            db.append_record(Trek, _trek_record(f"trek{i}"))
+        assert _list_fragments(db.save_dir / "treks") == []
+        db.append_record(Waypoint, _waypoint_record("trek0"))
+        db.delete_records_many(Trek, pa.table({"id": ["trek1"]}))
+        db.delete_records_many(Trek, pa.table({"id": ["trek2"]}))
+
+        # reading a table applies what was buffered for it
+        assert db.load_table(Trek).column("id").to_pylist() == ["trek0"]
+        assert len(_list_fragments(db.save_dir / "treks")) == 1
+        assert _list_fragments(db.save_dir / "waypoints") == []
+    assert len(_list_fragments(db.save_dir / "waypoints")) == 1
+
+
+@test("read-only session refuses writes")
+def test_read_only(temp_dir: Path = make_temp_dir):
+    db = Database(save_dir=temp_dir, load_dir=temp_dir, read_only=True)
+    assert db.load_table(Trek).num_rows == 0
+    with raises(ReadOnlyError):
+        db.append_record(Trek, _trek_record("trek0"))
+    db.close()
+
+
+@test("readers share the lock, writers wait for them")
+def test_read_write_lock(temp_dir: Path = make_temp_dir):
+    lock = ReadWriteLock(str(temp_dir / "test.lock"))
+    writer_has_lock = threading.Event()
+
+    def write():
+        with lock.exclusive():
+            writer_has_lock.set()
+
+    with lock.shared():
+        with lock.shared():
+            writer = threading.Thread(target=write)
+            writer.start()
+            assert not writer_has_lock.wait(timeout=0.2)
+    writer.join(timeout=1)
+    assert writer_has_lock.is_set()
+
+
+@test("async sessions commit on exit and read the committed tables")
+async def test_async_database(temp_dir: Path = make_temp_dir):
+    async with AsyncDatabase.get_db_mgr(temp_dir) as db:
+        await db.append_record(Trek, _trek_record("trek0"))
+        await db.run(db.session.append_record, Trek, _trek_record("trek1"))
+        table = await db.load_table(Trek, where={"id": "trek1"})
+        assert table.column("id").to_pylist() == ["trek1"]
+
+    async with AsyncDatabase.get_read_db_mgr(temp_dir) as db:
+        records = await db.load_records(Trek, columns=["id"])
+        assert records == [{"id": "trek0"}, {"id": "trek1"}]
+        with raises(ReadOnlyError):
+            await db.append_record(Trek, _trek_record("trek2"))
+
+    sync_db = Database(save_dir=temp_dir, load_dir=temp_dir, read_only=True)
+    assert sync_db.load_table(Trek).num_rows == 2
+    sync_db.close()
+
+
+@test("async sessions wait for the lock without blocking the event loop")
+async def test_async_database_lock(temp_dir: Path = make_temp_dir):
+    lock = ReadWriteLock(str(temp_dir / LOCK_NAME))
+    async with lock.async_exclusive():
+        opening = asyncio.create_task(
+            AsyncDatabase.get_read_db_mgr(temp_dir).__aenter__()
+        )
+        await asyncio.sleep(0.1)
+        assert not opening.done()
+    db = await asyncio.wait_for(opening, timeout=1)
+    assert await db.load_records(Trek) == []
+    db.session.close()
@@ -5,6 +5,8 @@ import pyarrow as pa
 from ward import test
 
 from tests.testing_utils import test_db
+from trek import config
+from trek.core import clients
 from trek.core.trackers.fitbit_ import FitbitUser
 from trek.database import Database, user_schema
 from trek.models import Id, User, UserToken
@@ -57,3 +59,14 @@ def test_persist_token(db: Database = test_db):
         "expires_at": 1573921366.6757,
     }
     assert token == token_exp
+
+
+@test("fitbit users share the process wide connection pool")
+def test_shared_connection_pool(db: Database = test_db):
+    first = FitbitUser(db=db, user_id=Id("first"), token=fake_token(Id("first")))
+    second = FitbitUser(db=db, user_id=Id("second"), token=fake_token(Id("second")))
+    url = "https://api.fitbit.com/1/user/-/activities/steps/date/today/1d.json"
+    first_adapter = first.client.client.session.get_adapter(url)
+    assert first_adapter is second.client.client.session.get_adapter(url)
+    assert first_adapter is clients.requests_session().get_adapter(url)
+    assert first.client.client.timeout == config.http_timeout
@@ -1,13 +1,45 @@
+from io import BytesIO
+import json
+import math
+from pathlib import Path
+import sqlite3
+import threading
+import time
 import typing as t
+from unittest import mock
 
+from PIL import Image
+import gpxpy
+import numpy as np
 import pendulum
 import pyarrow as pa
-from ward import test
+import requests  # type: ignore
+from staticmap import Line
+from ward import raises, test
 
-from tests.testing_utils import test_db
-from trek.core.progress import progress
-from trek.database import Database, trek_user_schema, user_schema, waypoint_schema
-from trek.models import Id, Leg, Location, Trek, TrekUser, User, Waypoint
+from tests.testing_utils import make_temp_dir, test_db
+from trek import config
+from trek.core import clients, geometry
+from trek.core.progress import (
+    factoids,
+    location_apis,
+    mapping,
+    progress,
+    progress_utils,
+    stats,
+)
+from trek.core.progress.geo_cache import GeoCache
+from trek.core.progress.overview_layers import OverviewLayers
+from trek.core.progress.tile_cache import CachedStaticMap, TileCache, TileKey
+from trek.core.trackers import tracker_utils, trackers
+from trek.database import (
+    Database,
+    trek_user_schema,
+    user_schema,
+    user_token_schema,
+    waypoint_schema,
+)
+from trek.models import Id, Leg, Location, Trek, TrekUser, User, UserToken, Waypoint
 
 
 def example_waypoints(trek_id: Id, leg_id: Id) -> list[dict]:
@@ -309,6 +341,381 @@ def test_execute_daily_progression(db=test_db):
     assert locaction == exp
 
 
+class FakeTrackerUser:
+    def __init__(self, db: Database, user_id: Id, token: dict):
+        self.db = db
+        self.user_id = user_id
+        self.token = token
+
+    def steps(self, date: pendulum.Date, db: Database) -> int:
+        if self.token["fail"]:
+            raise Exception("tracker is down")
+        # refreshed token, persisted from the worker thread
+        tracker_utils.persist_token(
+            db,
+            token={"fail": False, "refreshed": True},
+            user_id=self.user_id,
+            tracker_name="fitbit",
+            tracker_user_id=Id("fitbit_" + self.user_id),
+        )
+        return 1000
+
+
+class FakeTrackerService:
+    User = FakeTrackerUser
+
+
+@test("get_users_progress_fetches_in_parallel")
+def test_get_users_progress_fetches_in_parallel(db=test_db):
+    user_ids = [db.make_id() for _ in range(3)]
+    users: list = [{"id": user_id, "active_tracker": "fitbit"} for user_id in user_ids]
+    db.save_table(User, pa.Table.from_pylist(users, schema=user_schema))
+    tokens: list = [
+        {
+            "user_id": user_id,
+            "tracker_name": "fitbit",
+            "tracker_user_id": "fitbit_" + user_id,
+            "token": json.dumps({"fail": user_id == user_ids[2]}),
+        }
+        for user_id in user_ids
+    ]
+    db.save_table(UserToken, pa.Table.from_pylist(tokens, schema=user_token_schema))
+    trek_users: t.Any = [{"user_id": user_id} for user_id in user_ids]
+    date = pendulum.date(2000, 2, 5)
+    with mock.patch.dict(trackers.name_to_service, {"fitbit": FakeTrackerService}):
+        users_progress = progress._get_users_progress(
+            db,
+            Id("trek"),
+            Id("leg"),
+            date,
+            users,
+            trek_users,
+            tracker_utils.StepCache(ttl=math.inf),
+        )
+    amounts = {prog["user"]["id"]: prog["step"]["amount"] for prog in users_progress}
+    assert amounts == {user_ids[0]: 1000, user_ids[1]: 1000, user_ids[2]: 0}
+    refreshed = db.load_records(UserToken, where={"tracker_name": "fitbit"})
+    assert sorted(
+        json.loads(token["token"]).get("refreshed", False) for token in refreshed
+    ) == [False, True, True]
+
+
+@test("step_cache_fetches_once_per_key")
+def test_step_cache_fetches_once_per_key():
+    step_cache = tracker_utils.StepCache(ttl=math.inf)
+    key: tracker_utils.StepKey = (Id("user"), "fitbit", pendulum.date(2000, 2, 5))
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch() -> int:
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 1000
+
+    first = threading.Thread(target=step_cache.get, args=(key, fetch))
+    first.start()
+    started.wait()
+    results = []
+    second = threading.Thread(target=lambda: results.append(step_cache.get(key, fetch)))
+    second.start()
+    release.set()
+    first.join()
+    second.join()
+    assert results == [1000]
+    assert len(calls) == 1
+
+    def fail() -> int:
+        raise Exception("tracker is down")
+
+    other_key: tracker_utils.StepKey = (
+        Id("other"),
+        "fitbit",
+        pendulum.date(2000, 2, 5),
+    )
+    with raises(Exception):
+        step_cache.get(other_key, fail)
+    assert step_cache.get(other_key, lambda: 10) == 10
+
+    expired = tracker_utils.StepCache(ttl=0)
+    expired.get(key, lambda: 1)
+    assert expired.get(key, lambda: 2) == 2
+
+
+@test("geo_cache_serves_nearby_points_and_evicts_over_budget")
+def test_geo_cache(temp_dir: Path = make_temp_dir):
+    cache = GeoCache(path=temp_dir, grid=0.001, max_bytes=3000, offline=False)
+    assert cache.get("poi", 59.9, 10.7) is None
+    cache.put("poi", 59.9, 10.7, {"name": "museum"}, b"x" * 1000, ttl=60)
+    # within the same grid cell
+    assert cache.get("poi", 59.9002, 10.7003) == ({"name": "museum"}, b"x" * 1000)
+    assert cache.get("address", 59.9, 10.7) is None
+    assert (cache.hits["poi"], cache.misses["poi"]) == (1, 1)
+
+    cache.put("address", 59.9, 10.7, {"address": "a", "country": "c"}, None, ttl=0)
+    assert cache.get("address", 59.9, 10.7) is None
+
+    for i in range(3):
+        cache.put("poi", 60.0 + i, 10.7, {"name": None}, b"x" * 1000, ttl=60)
+    assert cache.n_bytes <= 3000
+    # least recently used first
+    assert cache.get("poi", 59.9, 10.7) is None
+    assert cache.get("poi", 62.0, 10.7) is not None
+
+
+@test("location_apis_probe_intervals_nearest_first")
+def test_location_apis_probe_intervals_nearest_first():
+    # interval i is at latitude i, the nearest intervals answer slowest
+    probed = []
+
+    def address(lat, lon):
+        probed.append(lat)
+        time.sleep(0.05 * (2 - lat) if lat < 3 else 0.1)
+        return (f"address{lat}", "country") if lat >= 1 else (None, None)
+
+    def poi(lat, lon):
+        return (f"poi{lat}", None) if lat >= 2 else (None, None)
+
+    def street_view(lat, lon):
+        return b"photo" if lat >= 1 else None
+
+    intervals = iter([(float(i), 0.0) for i in range(10)])
+    with mock.patch.multiple(
+        location_apis,
+        address_for_location=address,
+        poi_for_location=poi,
+        street_view_for_location=street_view,
+    ):
+        res = location_apis.main(
+            Id("trek"),
+            Id("leg"),
+            pendulum.date(2000, 2, 5),
+            intervals,
+            fake_upload_func,
+        )
+    address_res, country, photo_url, map_url, poi_res = res
+    assert (address_res, country, poi_res) == ("address1.0", "country", "poi2.0")
+    assert photo_url is None
+    assert "query=0.0%2C0.0" in map_url
+    # outstanding intervals are not probed once everything is found
+    assert max(probed) < 9
+
+
+class FakeTileServer:
+    def __init__(self):
+        self.requests: list[tuple[str, t.Optional[str]]] = []
+        self.etag = "v1"
+        self.down = False
+
+    def get(self, url, headers, timeout):
+        if self.down:
+            raise requests.ConnectionError(url)
+        etag = headers.get("If-None-Match")
+        self.requests.append((url, etag))
+        response = requests.Response()
+        response.status_code = 304 if etag == self.etag else 200
+        response.headers["ETag"] = self.etag
+        response._content = b"" if etag == self.etag else f"{url}@{self.etag}".encode()
+        return response
+
+
+@test("tile_cache_revalidates_with_etag_and_evicts_over_budget")
+def test_tile_cache(temp_dir: Path = make_temp_dir):
+    server = FakeTileServer()
+    cache = TileCache(
+        path=temp_dir,
+        url_template="tiles/{z}/{x}/{y}",
+        max_bytes=3000,
+        ttl=0,
+        mbtiles_path=None,
+    )
+    with mock.patch.object(clients, "requests_session", return_value=server):
+        assert cache.get((1, 0, 1)) == b"tiles/1/0/1@v1"
+        # expired, but unchanged on the server
+        assert cache.get((1, 0, 1)) == b"tiles/1/0/1@v1"
+        server.etag = "v2"
+        assert cache.get((1, 0, 1)) == b"tiles/1/0/1@v2"
+        assert server.requests == [
+            ("tiles/1/0/1", None),
+            ("tiles/1/0/1", "v1"),
+            ("tiles/1/0/1", "v1"),
+        ]
+        server.down = True
+        assert cache.get((1, 0, 1)) == b"tiles/1/0/1@v2"
+        assert cache.counts == {"fetched": 2, "revalidated": 1, "stale": 1}
+
+        server.down = False
+        cache.ttl = 60
+        cache.prefetch((3, x, 0) for x in range(60))
+        assert cache.n_bytes <= 3000
+        assert cache.get((3, 59, 0)) == b"tiles/3/59/0@v2"
+        # least recently used first
+        server.down = True
+        with raises(requests.ConnectionError):
+            cache.get((3, 0, 0))
+
+
+@test("tile_cache_reads_mbtiles")
+def test_tile_cache_mbtiles(temp_dir: Path = make_temp_dir):
+    mbtiles_path = temp_dir / "tiles.mbtiles"
+    connection = sqlite3.connect(mbtiles_path)
+    connection.execute(
+        "CREATE TABLE tiles "
+        "(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+    )
+    connection.execute("INSERT INTO tiles VALUES (2, 1, 0, ?)", (b"tile",))
+    connection.commit()
+    connection.close()
+    cache = TileCache(
+        path=temp_dir / "cache",
+        url_template="unused",
+        max_bytes=3000,
+        ttl=60,
+        mbtiles_path=mbtiles_path,
+    )
+    # rows are counted from the bottom
+    assert cache.get((2, 1, 3)) == b"tile"
+    with raises(KeyError):
+        cache.get((2, 1, 0))
+
+
+@test("cached_static_map_tiles_are_the_ones_rendered")
+def test_cached_static_map_tiles():
+    class RecordingCache:
+        def __init__(self):
+            self.keys = []
+
+        def get(self, key):
+            self.keys.append(key)
+            buffer = BytesIO()
+            Image.new("RGB", (256, 256)).save(buffer, format="PNG")
+            return buffer.getvalue()
+
+    cache = RecordingCache()
+    map_ = CachedStaticMap(width=1000, height=600, cache=cache)  # type: ignore
+    map_.add_line(Line([(10.7, 59.9), (11.2, 60.1)], "red", 2))
+    tiles = map_.tiles()
+    map_.render()
+    assert sorted(cache.keys) == sorted(tiles)
+
+
+@test("mapping_reuses_overview_layer_while_the_day_fits_its_frame")
+def test_mapping_overview_layer(db=test_db, temp_dir: Path = make_temp_dir):
+    class FakeTileCache:
+        def __init__(self):
+            self.prefetched: list[TileKey] = []
+
+        def prefetch(self, keys):
+            self.prefetched.extend(keys)
+
+        def get(self, key):
+            buffer = BytesIO()
+            Image.new("RGB", (256, 256)).save(buffer, format="PNG")
+            return buffer.getvalue()
+
+    user_ids = _preadd_users(db)
+    trek_id, leg_id = _preadd_treks(db, user_ids, add_location=True)
+    geometry = progress_utils.LegGeometry.load(db, trek_id, leg_id)
+    layers = OverviewLayers(temp_dir)
+    fake_tile_cache = FakeTileCache()
+    uploaded = []
+
+    def upload(img, *args):
+        uploaded.append(img)
+        return "upload_res"
+
+    def run_day(last_distance: t.Optional[float], distance: float):
+        users_progress: t.Any = [
+            {
+                "user": {"name": "user"},
+                "trek_user": {"color": "red"},
+                "step": {"amount": (distance - (last_distance or 0)) / 0.75},
+            }
+        ]
+        last_location: t.Any = None
+        if last_distance is not None:
+            (lat, lon), *_ = geometry.point_at_distance(last_distance)
+            last_location = {"lat": lat, "lon": lon, "distance": last_distance}
+        current_location, *_ = geometry.point_at_distance(distance)
+        fake_tile_cache.prefetched.clear()
+        with mock.patch.multiple(
+            mapping, tile_cache=fake_tile_cache, overview_layers=layers
+        ), mock.patch.object(
+            mapping, "_history_data", wraps=mapping._history_data
+        ) as history_data:
+            res = mapping.main(
+                db,
+                trek_id,
+                leg_id,
+                pendulum.date(2000, 2, 5),
+                last_location,
+                current_location,
+                distance,
+                users_progress,
+                upload,
+                geometry,
+            )
+        assert res == "upload_res"
+        return history_data.call_count
+
+    assert run_day(None, 15000.0) == 1
+    frame = layers.get(trek_id, leg_id).frame  # type: ignore
+    # the day fits in yesterday's frame, only the detailed map needs tiles
+    assert run_day(15000.0, 16000.0) == 0
+    layer = layers.get(trek_id, leg_id)
+    assert layer is not None and (layer.distance, layer.frame) == (16000.0, frame)
+    assert all(key[0] != frame[0] for key in fake_tile_cache.prefetched)
+    # the day leaves the frame
+    assert run_day(16000.0, 30000.0) == 1
+    layer = layers.get(trek_id, leg_id)
+    assert layer is not None and layer.frame != frame
+    assert len(uploaded) == 3
+    db.close()
+
+
+@test("leg_geometry_points_at_distances")
+def test_leg_geometry_points_at_distances():
+    waypoints = [
+        {"id": "a", "lat": 59.9, "lon": 10.7, "distance": 0.0},
+        {"id": "b", "lat": 60.0, "lon": 10.9, "distance": 15000.0},
+        {"id": "c", "lat": 59.95, "lon": 11.2, "distance": 33000.0},
+    ]
+    geometry = progress_utils.LegGeometry.from_table(pa.Table.from_pylist(waypoints))
+    distances = [0.0, 5000.0, 15000.0, 20000.0, 33000.0, 40000.0]
+    lats, lons, latest, finished = geometry.points_at_distances(distances)
+    for distance, lat, lon, index, is_finished in zip(
+        distances, lats, lons, latest, finished
+    ):
+        first = waypoints[index]
+        if index + 1 == len(waypoints):
+            exp = (first["lat"], first["lon"])
+            assert is_finished
+        else:
+            angle = gpxpy.geo.get_course(
+                first["lat"],
+                first["lon"],
+                waypoints[index + 1]["lat"],
+                waypoints[index + 1]["lon"],
+            )
+            delta = gpxpy.geo.LocationDelta(
+                distance=distance - first["distance"], angle=angle
+            )
+            exp_lat, exp_lon = delta.move(
+                gpxpy.geo.Location(first["lat"], first["lon"])
+            )
+            exp = (round(exp_lat, 7), round(exp_lon, 7))
+            assert not is_finished
+        assert (lat, lon) == exp
+    assert latest.tolist() == [0, 0, 1, 1, 2, 2]
+
+    (lat, lon), waypoint, is_finished = geometry.point_at_distance(20000.0)
+    assert (lat, lon) == (lats[3], lons[3])
+    assert waypoint == waypoints[1]
+    assert geometry.total_distance == 33000.0
+    assert [w["id"] for w in geometry.waypoints_between(0, 15000.0)] == ["a", "b"]
+
+
 # @test("treks_to_update_1_days_since_last_10h")
 # def test_treks_to_update_1_days_since_last_10h(db=test_db):
 #     user_ids = _preadd_users(db)
@@ -367,3 +774,265 @@ def test_execute_daily_progression(db=test_db):
 # @test("treks_to_update_never_updated")
 # def test_treks_to_update_never_updated(db=test_db):
 #     ...
+
+
+@test("douglas_peucker_tolerances_keep_what_a_direct_run_keeps")
+def test_douglas_peucker_tolerances():
+    rng = np.random.default_rng(0)
+    lat = 59.9 + np.cumsum(rng.uniform(0, 0.001, 300))
+    lon = 10.7 + np.cumsum(rng.uniform(-0.001, 0.001, 300))
+    x, y = geometry._project(lat, lon)
+
+    def run(first: int, last: int, tolerance: float) -> list[int]:
+        if last - first < 2:
+            return [first]
+        distances = geometry._segment_distances(x, y, first, last)
+        i = int(np.argmax(distances))
+        if distances[i] <= tolerance:
+            return [first]
+        split = first + 1 + i
+        return run(first, split, tolerance) + run(split, last, tolerance)
+
+    tolerances = geometry.douglas_peucker_tolerances(lat, lon)
+    for tolerance in [0.0, 1.0, 10.0, 50.0, 200.0]:
+        kept = run(0, len(lat) - 1, tolerance) + [len(lat) - 1]
+        assert np.flatnonzero(tolerances > tolerance).tolist() == kept
+
+
+@test("stats_follow_saved_steps_and_locations")
+def test_stats_follow_saved_steps_and_locations(db=test_db):
+    user_ids = _preadd_users(db)
+    trek_id, leg_id = _preadd_treks(db, user_ids, add_location=False)
+    date = pendulum.date(2000, 2, 1)
+    for day in range(10):
+        taken_at = date.add(days=day)
+        users_progress: t.Any = [
+            {
+                "step": {
+                    "trek_id": trek_id,
+                    "leg_id": leg_id,
+                    "user_id": user_id,
+                    "taken_at": taken_at,
+                    "amount": 1000 * (i + 1) + day,
+                }
+            }
+            # users join on the first three days
+            for i, user_id in enumerate(user_ids[: day + 1])
+        ]
+        progress._save_users_progress(db, users_progress)
+        if day % 2 == 0:
+            location: t.Any = {
+                "trek_id": trek_id,
+                "leg_id": leg_id,
+                "added_at": taken_at,
+                "latest_waypoint": "waypoint2",
+                "lat": 0.0,
+                "lon": 0.0,
+                "distance": 0.0,
+            }
+            progress._save_location_data(db, location)
+    leg_stats = stats.load(db, trek_id, leg_id)
+    assert leg_stats == stats._from_history(db, trek_id, leg_id)
+    assert stats.load(db, trek_id, trek_id)["n_days"] == 5
+    assert stats.step_totals(leg_stats)[user_ids[0]] == 10045
+    assert stats.weekly_steps(leg_stats, date.add(days=9)) == {
+        user_ids[0]: 7042,
+        user_ids[1]: 14042,
+        user_ids[2]: 21042,
+    }
+    assert stats.weekly_steps(leg_stats, date.add(days=20)) is None
+    assert factoids.leg_summary(db, trek_id, leg_id).startswith(
+        "Denne etappen tok oss 5 dager."
+    )
+
+
+def _save_treks_to_run(
+    temp_dir: Path, output_to: t.Optional[str] = None
+) -> tuple[Path, list[Id]]:
+    tables_path = temp_dir / "tables"
+    db = Database(save_dir=temp_dir / "setup", load_dir=tables_path)
+    user_ids = [Id(f"user{i}") for i in range(2)]
+    users: list = [
+        {"id": user_id, "name": user_id, "active_tracker": "fitbit"}
+        for user_id in user_ids
+    ]
+    db.save_table(User, pa.Table.from_pylist(users, schema=user_schema))
+    tokens: list = [
+        {
+            "user_id": user_id,
+            "tracker_name": "fitbit",
+            "tracker_user_id": "fitbit_" + user_id,
+            "token": json.dumps({"fail": False}),
+        }
+        for user_id in user_ids
+    ]
+    db.save_table(UserToken, pa.Table.from_pylist(tokens, schema=user_token_schema))
+    trek_ids = [Id(f"trek{i}") for i in range(2)]
+    for trek_id, user_id in zip(trek_ids, user_ids):
+        leg_id = Id("leg_" + trek_id)
+        trek: t.Any = {
+            "id": trek_id,
+            "is_active": True,
+            "owner_id": user_id,
+            "progress_at_hour": 12,
+            "progress_at_tz": "UTC",
+            "output_to": output_to,
+        }
+        db.append_record(Trek, trek)
+        leg: t.Any = {
+            "id": leg_id,
+            "trek_id": trek_id,
+            "destination": "testDestination",
+            "added_at": pendulum.datetime(2000, 2, 1),
+            "added_by": user_id,
+            "is_finished": False,
+        }
+        db.append_record(Leg, leg)
+        waypoints: t.Any = example_waypoints(trek_id, leg_id)
+        db.append_records(Waypoint, waypoints)
+        trek_user: t.Any = {
+            "trek_id": trek_id,
+            "user_id": user_id,
+            "added_at": pendulum.datetime(2000, 2, 1),
+        }
+        db.append_record(TrekUser, trek_user)
+    db.commit()
+    db.close()
+    return tables_path, trek_ids
+
+
+@test("run_saves_every_trek_updated_in_parallel")
+def test_run_saves_every_trek(temp_dir: Path = make_temp_dir):
+    tables_path, trek_ids = _save_treks_to_run(temp_dir)
+    with mock.patch.object(config, "tables_path", tables_path), mock.patch.object(
+        progress, "make_upload_f", return_value=fake_upload_func
+    ), mock.patch.object(
+        location_apis, "main", fake_location_apis_func
+    ), mock.patch.object(
+        mapping, "main", fake_mapping_func
+    ), mock.patch.dict(
+        trackers.name_to_service, {"fitbit": FakeTrackerService}
+    ):
+        # the second day updates the stats of both treks in place
+        for day in [2, 3]:
+            pendulum.set_test_now(pendulum.datetime(2000, 2, day, 12))
+            try:
+                progress.run()
+            finally:
+                pendulum.set_test_now()
+
+    db = Database(save_dir=temp_dir / "check", load_dir=tables_path, read_only=True)
+    for trek_id in trek_ids:
+        locations = db.load_table(Location, where={"trek_id": trek_id})
+        assert locations.column("added_at").to_pylist() == [
+            pendulum.date(2000, 2, 1),
+            pendulum.date(2000, 2, 2),
+        ]
+        assert stats.load(db, trek_id, trek_id)["n_days"] == 2
+    db.close()
+
+
+@test("run_posts_after_commit_and_abandoned_treks_upload_nothing")
+def test_run_abandons_late_treks(temp_dir: Path = make_temp_dir):
+    tables_path, trek_ids = _save_treks_to_run(temp_dir, output_to="fake")
+    posted: list[tuple[Id, int]] = []
+    uploads: list[Id] = []
+    late_upload: list[t.Optional[str]] = []
+    released = threading.Event()
+    finished = threading.Event()
+
+    class RecordingOutputter:
+        @staticmethod
+        def post_update(db, trek, users_progress, location, achievements, next_adder):
+            locations = db.load_table(Location, where={"trek_id": trek["id"]})
+            posted.append((trek["id"], locations.num_rows))
+
+    def upload(data, trek_id, leg_id, date, name):
+        uploads.append(trek_id)
+        return "upload_res"
+
+    def location_apis_func(trek_id, leg_id, date, intervals, upload_func):
+        if trek_id == trek_ids[1]:
+            released.wait(timeout=5)
+            late_upload.append(upload_func(b"", trek_id, leg_id, date, "photo"))
+            finished.set()
+            # stop before the trek writes to a directory the test is removing
+            raise RuntimeError("trek abandoned")
+        return fake_location_apis_func()
+
+    with mock.patch.object(config, "tables_path", tables_path), mock.patch.object(
+        config, "trek_deadline", 1
+    ), mock.patch.object(
+        progress, "make_upload_f", return_value=upload
+    ), mock.patch.object(
+        location_apis, "main", location_apis_func
+    ), mock.patch.object(
+        mapping, "main", fake_mapping_func
+    ), mock.patch.dict(
+        trackers.name_to_service, {"fitbit": FakeTrackerService}
+    ), mock.patch.dict(
+        progress.outputters, {"fake": RecordingOutputter}
+    ):
+        pendulum.set_test_now(pendulum.datetime(2000, 2, 2, 12))
+        try:
+            progress.run()
+        finally:
+            pendulum.set_test_now()
+            released.set()
+        assert finished.wait(timeout=5)
+
+    # the update is posted once its location is committed
+    assert posted == [(trek_ids[0], 1)]
+    assert late_upload == [None]
+    assert trek_ids[1] not in uploads
+
+
+class SlowTrackerUser:
+    refreshed = threading.Event()
+
+    def __init__(self, db: Database, user_id: Id, token: dict):
+        self.user_id = user_id
+
+    def steps(self, date: pendulum.Date, db: Database) -> int:
+        time.sleep(0.3)
+        tracker_utils.persist_token(
+            db,
+            token={"refreshed": True},
+            user_id=self.user_id,
+            tracker_name="fitbit",
+            tracker_user_id=Id("fitbit_" + self.user_id),
+        )
+        self.refreshed.set()
+        return 1000
+
+
+class SlowTrackerService:
+    User = SlowTrackerUser
+
+
+@test("tokens_refreshed_after_the_tracker_deadline_are_kept")
+def test_tokens_refreshed_after_the_deadline(temp_dir: Path = make_temp_dir):
+    db = Database(save_dir=temp_dir / "save", load_dir=temp_dir / "tables")
+    user: t.Any = {"id": Id("user"), "active_tracker": "fitbit"}
+    token: t.Any = {
+        "user_id": user["id"],
+        "tracker_name": "fitbit",
+        "tracker_user_id": "fitbit_user",
+        "token": json.dumps({"refreshed": False}),
+    }
+    db.append_record(UserToken, token)
+    db.commit()
+    with mock.patch.dict(
+        trackers.name_to_service, {"fitbit": SlowTrackerService}
+    ), mock.patch.object(config, "tracker_deadline", 0.1):
+        steps = progress._get_steps_for_users(
+            db, [user], pendulum.date(2000, 2, 5), tracker_utils.StepCache(ttl=0)
+        )
+    assert steps == {user["id"]: 0}
+    assert SlowTrackerUser.refreshed.wait(timeout=5)
+    db.close()
+
+    db = Database(save_dir=temp_dir / "save", load_dir=temp_dir / "tables")
+    refreshed = db.load_records(UserToken)[0]
+    assert json.loads(refreshed["token"]) == {"refreshed": True}
+    db.close()
@@ -1,15 +1,20 @@
+from pathlib import Path
+import threading
 import typing as t
+from unittest import mock
 
 from fastapi_jwt_auth import AuthJWT
 import pendulum
 import pyarrow as pa
 from ward import test
 
-from tests.testing_utils import test_db
+from tests.testing_utils import make_temp_dir, test_db
 from trek import utils
+from trek.api import user as user_api
 from trek.core import user
 from trek.core.trackers import tracker_utils
 from trek.database import (
+    AsyncDatabase,
     Database,
     trek_user_schema,
     user_schema,
@@ -292,6 +297,22 @@ def test_redirect_new_tracker_existing_user(db: Database = test_db):
     ]
 
 
+@test("me calls the tracker outside of db_executor")
+async def test_me_thread(temp_dir: Path = make_temp_dir):
+    threads: list[str] = []
+
+    def me(db: Database, user_id: Id):
+        threads.append(threading.current_thread().name)
+
+    Authorize = mock.Mock(get_jwt_subject=lambda: "user")
+    async with AsyncDatabase.get_db_mgr(temp_dir) as db:
+        with mock.patch.object(user, "me", me):
+            await user_api.me(db=db, Authorize=Authorize)
+    assert len(threads) == 1
+    # db_executor threads are named db_0, db_1, ...
+    assert not threads[0].startswith("db")
+
+
 # @test("test_me")
 # def test_me(db: Database = test_db):
 #     user_ids = _preadd_users(db)
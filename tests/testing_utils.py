@@ -4,6 +4,7 @@ import typing as t  # noqa
 import uuid
 
 from fastapi.testclient import TestClient
+import pyarrow as pa
 from ward import fixture
 
 from trek import server
@@ -52,6 +53,9 @@ class TestDatabase(Database):
         self.serial += 1
         return id_
 
+    def make_ids(self, n: int) -> pa.Array:  # type: ignore
+        return pa.array([self.make_id() for _ in range(n)], pa.string())
+
     @classmethod
     def get_db(cls):
         raise NotImplementedError
@@ -59,6 +63,9 @@ class TestDatabase(Database):
     def commit_table(self, table):
         pass
 
+    def upsert_committed(self, Type, table, key_columns):
+        self.upsert_records(Type, table, key_columns)
+
     def commit(self):
         pass
 
@@ -5,7 +5,8 @@ import time
 import schedule
 import uvicorn
 
-from trek.core.progress import progress
+from trek import database
+from trek.core.progress import achievements, progress
 
 log = logging.getLogger(__name__)
 
@@ -28,6 +29,13 @@ def main():  # pragma: no cover
         run_server()
     elif args.mode == "scheduler":
         run_scheduler()
+    elif args.mode == "migrate":
+        database.migrate()
+    elif args.mode == "rebuild-achievements":
+        achievements.rebuild_all()
+    elif args.mode == "check-achievements":
+        if not achievements.check_all():
+            raise SystemExit(1)
     else:
         raise Exception(f"Incorrect mode, {args.mode}")
 
@@ -1,17 +1,18 @@
 from fastapi import APIRouter, Depends
 from fastapi.responses import RedirectResponse
 from fastapi_jwt_auth import AuthJWT
+from starlette.concurrency import run_in_threadpool
 
 from trek.core import user
 from trek.core.trackers import trackers
-from trek.database import Database
+from trek.database import AsyncDatabase
 from trek.models import TrackerName
 
 router = APIRouter(prefix="/user", tags=["users"])
 
 
 @router.get("/login/{tracker_name}")
-def login(
+async def login(
     tracker_name: TrackerName, frontend_redirect_url: str
 ) -> user.AuthorizeResponse:
     Service = trackers.name_to_service[tracker_name]
@@ -20,7 +21,7 @@ def login(
 
 
 @router.get("/add_tracker/{tracker_name}", operation_id="authorize")
-def add_tracker(
+async def add_tracker(
     tracker_name: TrackerName,
     frontend_redirect_url: str,
     Authorize: AuthJWT = Depends(),
@@ -33,53 +34,57 @@ def add_tracker(
 
 
 @router.get("/redirect/{tracker_name}", include_in_schema=False)
-def handle_redirect(
+async def handle_redirect(
     tracker_name: TrackerName,
     code: str,
     state: str,
-    db: Database = Depends(Database.get_db),
+    db: AsyncDatabase = Depends(AsyncDatabase.get_db),
     Authorize: AuthJWT = Depends(),
 ):
     Service = trackers.name_to_service[tracker_name]
     service = Service()
+    # the tracker is called over the network, db_executor is kept for file I/O
     return RedirectResponse(
-        user.handle_redirect(
+        await run_in_threadpool(
+            user.handle_redirect,
             service=service,
             code=code,
             state=state,
-            db=db,
+            db=db.session,
             Authorize=Authorize,
         )
     )
 
 
 @router.get("/me", operation_id="authorize")
-def me(
-    db: Database = Depends(Database.get_db), Authorize: AuthJWT = Depends()
+async def me(
+    db: AsyncDatabase = Depends(AsyncDatabase.get_db), Authorize: AuthJWT = Depends()
 ) -> user.MeResponse:
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
-    return user.me(db, user_id)
+    # steps are fetched from the tracker, db_executor is kept for file I/O
+    return await run_in_threadpool(user.me, db.session, user_id)
 
 
 @router.get(
     "/is_authenticated",
     operation_id="authorize",
 )
-def is_authenticated(
-    db: Database = Depends(Database.get_db), Authorize: AuthJWT = Depends()
+async def is_authenticated(
+    db: AsyncDatabase = Depends(AsyncDatabase.get_read_db),
+    Authorize: AuthJWT = Depends(),
 ) -> user.IsAuthenticatedResponse:
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
-    return user.is_authenticated(db, user_id)
+    return await db.run(user.is_authenticated, db.session, user_id)
 
 
 @router.put("/me", operation_id="authorize")
-def edit_user(
+async def edit_user(
     request: user.EditUserRequest,
-    db: Database = Depends(Database.get_db),
+    db: AsyncDatabase = Depends(AsyncDatabase.get_db),
     Authorize: AuthJWT = Depends(),
 ) -> None:
     Authorize.jwt_required()
     user_id = Authorize.get_jwt_subject()
-    return user.edit_user(request, db, user_id)
+    return await db.run(user.edit_user, request, db.session, user_id)
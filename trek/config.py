@@ -10,8 +10,85 @@ load_dotenv(dotenv_path=Path(".") / ".env")
 app_name: Final = "trek"
 
 max_route_distance: Final = 1_000_000
+# "ellipsoidal" for geodesic lengths of new legs, "haversine" for faster spherical
+waypoint_distance_mode: Final = os.environ.get(
+    "trek_waypoint_distance_mode", "ellipsoidal"
+)
+# the leg polyline sent to the frontend is simplified for a map this many pixels wide
+leg_polyline_pixels: Final = int(os.environ.get("trek_leg_polyline_pixels", 2048))
 
 tables_path: Final = Path(os.environ.get("trek_tables_path", "/var/lib/trekapi/data"))
+compaction_max_fragments: Final = int(
+    os.environ.get("trek_compaction_max_fragments", 32)
+)
+compaction_max_bytes: Final = int(
+    os.environ.get("trek_compaction_max_bytes", 8 * 1024 * 1024)
+)
+table_cache_max_bytes: Final = int(
+    os.environ.get("trek_table_cache_max_bytes", 64 * 1024 * 1024)
+)
+# times a commit is redone on top of the commits that conflicted with it
+commit_retries: Final = int(os.environ.get("trek_commit_retries", 3))
+# threads that do the file I/O of async database sessions
+db_workers: Final = int(os.environ.get("trek_db_workers", 8))
+# seconds between attempts at the database lock in async sessions
+db_lock_poll_interval: Final = float(
+    os.environ.get("trek_db_lock_poll_interval", 0.005)
+)
+tracker_workers: Final = int(os.environ.get("trek_tracker_workers", 8))
+tracker_concurrency: Final = int(os.environ.get("trek_tracker_concurrency", 4))
+tracker_deadline: Final = float(os.environ.get("trek_tracker_deadline", 120))
+step_cache_ttl: Final = float(os.environ.get("trek_step_cache_ttl", 5 * 60))
+trek_workers: Final = int(os.environ.get("trek_trek_workers", 4))
+trek_deadline: Final = float(os.environ.get("trek_trek_deadline", 45 * 60))
+geo_cache_path: Final = Path(
+    os.environ.get("trek_geo_cache_path", tables_path.parent / "geo_cache")
+)
+# degrees, about 100 m
+geo_cache_grid: Final = float(os.environ.get("trek_geo_cache_grid", 0.001))
+geo_cache_max_bytes: Final = int(
+    os.environ.get("trek_geo_cache_max_bytes", 512 * 1024 * 1024)
+)
+geo_cache_offline: Final = os.environ.get("trek_geo_cache_offline", "") == "1"
+geo_cache_address_ttl: Final = float(
+    os.environ.get("trek_geo_cache_address_ttl", 365 * 24 * 60 * 60)
+)
+geo_cache_poi_ttl: Final = float(
+    os.environ.get("trek_geo_cache_poi_ttl", 90 * 24 * 60 * 60)
+)
+geo_cache_street_view_ttl: Final = float(
+    os.environ.get("trek_geo_cache_street_view_ttl", 365 * 24 * 60 * 60)
+)
+tile_url: Final = os.environ.get(
+    "trek_tile_url",
+    "https://a.basemaps.cartocdn.com/rastertiles/voyager/{z}/{x}/{y}.png",
+)
+# an MBTiles file to render maps from instead of tile_url
+tile_mbtiles_path: Final = (
+    Path(os.environ["trek_tile_mbtiles_path"])
+    if os.environ.get("trek_tile_mbtiles_path")
+    else None
+)
+tile_cache_path: Final = Path(
+    os.environ.get("trek_tile_cache_path", tables_path.parent / "tile_cache")
+)
+tile_cache_max_bytes: Final = int(
+    os.environ.get("trek_tile_cache_max_bytes", 256 * 1024 * 1024)
+)
+# seconds before a tile is revalidated
+tile_cache_ttl: Final = float(os.environ.get("trek_tile_cache_ttl", 7 * 24 * 60 * 60))
+tile_workers: Final = int(os.environ.get("trek_tile_workers", 8))
+overview_layers_path: Final = Path(
+    os.environ.get("trek_overview_layers_path", tables_path.parent / "overview_layers")
+)
+http_timeout: Final = float(os.environ.get("trek_http_timeout", 30))
+http_retries: Final = int(os.environ.get("trek_http_retries", 3))
+http_backoff: Final = float(os.environ.get("trek_http_backoff", 0.5))
+http_pool_size: Final = int(os.environ.get("trek_http_pool_size", 16))
+location_probe_window: Final = int(os.environ.get("trek_location_probe_window", 3))
+# requests per second
+nominatim_rate: Final = float(os.environ.get("trek_nominatim_rate", 1))
+google_api_rate: Final = float(os.environ.get("trek_google_api_rate", 10))
 frontend_url: Final = os.environ["trek_frontend_url"]
 backend_url: Final = os.environ["trek_backend_url"]
 dbx_token: Final = os.environ["trek_dbx_token"]
@@ -0,0 +1,110 @@
+"""Clients for the external services, shared by the whole process
+
+Clients are created on first use and keep their connections alive, so TLS
+handshakes and discovery documents are paid once per process rather than per
+call or per user. Sessions of libraries that create their own, like the
+trackers' OAuth sessions, are pointed at the shared connection pool with
+mount_pool().
+"""
+from functools import lru_cache
+import importlib.util
+import threading
+import typing as t  # noqa
+
+from dropbox import Dropbox, create_session
+from geopy.geocoders import Nominatim
+import google.auth.transport.requests
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import Resource, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+import googlemaps
+import httplib2
+import httpx
+import requests  # type: ignore
+from requests.adapters import HTTPAdapter  # type: ignore
+from urllib3.util.retry import Retry
+
+from trek import config
+
+retry_statuses = (429, 500, 502, 503, 504)
+
+
+@lru_cache(maxsize=None)
+def _adapter() -> HTTPAdapter:
+    retry = Retry(
+        total=config.http_retries,
+        backoff_factor=config.http_backoff,
+        status_forcelist=retry_statuses,
+    )
+    return HTTPAdapter(pool_maxsize=config.http_pool_size, max_retries=retry)
+
+
+def mount_pool(session: requests.Session) -> requests.Session:
+    """Send the requests of session through the shared connection pool"""
+    adapter = _adapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def requests_session() -> requests.Session:
+    return mount_pool(requests.Session())
+
+
+@lru_cache(maxsize=None)
+def httpx_client() -> httpx.Client:
+    # the h2 package is optional
+    http2 = importlib.util.find_spec("h2") is not None
+    transport = httpx.HTTPTransport(
+        http2=http2,
+        retries=config.http_retries,
+        limits=httpx.Limits(max_keepalive_connections=config.http_pool_size),
+    )
+    return httpx.Client(transport=transport, timeout=config.http_timeout)
+
+
+@lru_cache(maxsize=None)
+def nominatim() -> Nominatim:
+    return Nominatim(user_agent=config.app_name, timeout=config.http_timeout)
+
+
+@lru_cache(maxsize=None)
+def googlemaps_client() -> googlemaps.Client:
+    return googlemaps.Client(
+        key=config.google_api_key,
+        timeout=config.http_timeout,
+        requests_session=requests_session(),
+    )
+
+
+@lru_cache(maxsize=None)
+def dropbox_client() -> Dropbox:
+    # dropbox pins its certificates, so it keeps a session of its own
+    session = create_session(max_connections=config.http_pool_size)
+    return Dropbox(config.dbx_token, session=session, timeout=config.http_timeout)
+
+
+def google_auth_request() -> google.auth.transport.requests.Request:
+    return google.auth.transport.requests.Request(session=requests_session())
+
+
+@lru_cache(maxsize=None)
+def _discovery_document(service: str, version: str) -> str:
+    return get_static_doc(service, version)
+
+
+# httplib2 connections are not thread safe, each thread keeps its own
+_local = threading.local()
+
+
+def _httplib2_http() -> httplib2.Http:
+    if not hasattr(_local, "http"):
+        _local.http = httplib2.Http(timeout=config.http_timeout)
+    return _local.http
+
+
+def google_service(service: str, version: str, credentials) -> Resource:
+    """A Google API client for one user, on this thread's connections"""
+    http = AuthorizedHttp(credentials, http=_httplib2_http())
+    return build_from_document(_discovery_document(service, version), http=http)
@@ -2,7 +2,6 @@ from itertools import cycle
 import typing as t  # noqa
 
 from fastapi import HTTPException
-import pyarrow.compute as pc
 
 from trek.database import Database
 from trek.models import Id, Trek, TrekUser
@@ -22,7 +21,7 @@ def get_next_leg_adder(most_recent_adder_id: Id, trek_users: list[TrekUser]) ->
 
 
 def assert_trek_owner(db: Database, trek_id: Id, user_id: Id) -> None:
-    trek_table = db.load_table(Trek, filter=pc.field("id") == pc.scalar(trek_id))
+    trek_table = db.load_table(Trek, where={"id": trek_id})
     assert trek_table.num_rows == 1
     owner_id = trek_table.column("owner_id").to_pylist()[0]
     if not owner_id == user_id:
@@ -30,7 +29,7 @@ def assert_trek_owner(db: Database, trek_id: Id, user_id: Id) -> None:
 
 
 def assert_trek_exists(db: Database, trek_id: Id) -> None:
-    trek_table = db.load_table(Trek, filter=pc.field("id") == pc.scalar(trek_id))
+    trek_table = db.load_table(Trek, where={"id": trek_id})
     if not trek_table.num_rows > 0:
         raise HTTPException(status_code=403, detail="Trek not found")
 
@@ -42,10 +41,6 @@ def assert_trek_participant(db: Database, trek_id: Id, user_id: Id) -> None:
 
 def is_trek_participant(db: Database, trek_id: Id, user_id: Id) -> bool:
     trek_user_table = db.load_table(
-        TrekUser,
-        filter=(
-            (pc.field("trek_id") == pc.scalar(trek_id))
-            & (pc.field("user_id") == pc.scalar(user_id))
-        ),
+        TrekUser, where={"trek_id": trek_id, "user_id": user_id}
     )
     return trek_user_table.num_rows > 0
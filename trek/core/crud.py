@@ -4,7 +4,7 @@ import typing as t
 
 from colorhash import ColorHash
 from cryptography.fernet import Fernet
-from geopy.distance import distance
+import numpy as np
 import pendulum
 import polyline
 import pyarrow as pa
@@ -13,6 +13,7 @@ from pydantic import BaseModel, Field
 
 from trek import config
 from trek import exceptions as exc
+from trek.core import geometry
 from trek.core.core_utils import (
     assert_trek_exists,
     assert_trek_owner,
@@ -20,9 +21,25 @@ from trek.core.core_utils import (
     get_next_leg_adder,
     is_trek_participant,
 )
-from trek.database import Database, trek_schema, trek_user_schema, waypoint_schema
-from trek.models import Id, Leg, Location, OutputName, Trek, TrekUser, Waypoint
-from trek.utils import round_coords
+from trek.database import (
+    Database,
+    leg_simplification_schema,
+    trek_schema,
+    waypoint_schema,
+)
+from trek.models import (
+    AchievementState,
+    Id,
+    Leg,
+    LegSimplification,
+    LegSummary,
+    Location,
+    OutputName,
+    Trek,
+    TrekStats,
+    TrekUser,
+    Waypoint,
+)
 
 log = logging.getLogger(__name__)
 
@@ -64,9 +81,8 @@ def _get_user_color(index: int, user_id: Id) -> str:
 
 
 def _generate_and_add_trek_user_record(db: Database, trek_id: Id, user_id: Id) -> None:
-    trek_user_table = db.load_table(TrekUser)
-    user_index = trek_user_table.filter(
-        pc.field("trek_id") == pc.scalar(trek_id)
+    user_index = db.load_table(
+        TrekUser, where={"trek_id": trek_id}, columns=["user_id"]
     ).num_rows
     user_color = _get_user_color(user_index, user_id)
 
@@ -77,9 +93,7 @@ def _generate_and_add_trek_user_record(db: Database, trek_id: Id, user_id: Id) -
         "added_at": now,
         "color": user_color,
     }
-    record_table = pa.Table.from_pylist([trek_user_record], schema=trek_user_schema)
-    merged_table = pa.concat_tables([trek_user_table, record_table])
-    db.save_table(TrekUser, merged_table)
+    db.append_record(TrekUser, trek_user_record)
 
 
 class GenerateInviteResponse(BaseModel):
@@ -165,10 +179,8 @@ def add_trek(
     }
     db.append_record(Leg, leg_record)
 
-    waypoints = polyline.decode(request.polyline, 5)
-    waypoint_records = _waypoint_tuple_to_records(trek_id, leg_id, waypoints, db)
-    waypoints_table = pa.Table.from_pylist(waypoint_records, schema=waypoint_schema)
-    db.save_table(Waypoint, waypoints_table)
+    lat, lon = geometry.decode_polyline(request.polyline, 5)
+    _save_waypoints(db, trek_id, leg_id, lat, lon)
 
     return AddTrekResponse(trek_id=trek_id)
 
@@ -187,7 +199,7 @@ def get_trek(
     db: Database,
     user_id: Id,
 ) -> GetTrekResponse:
-    trek_table = db.load_table(Trek, filter=pc.field("id") == pc.scalar(trek_id))
+    trek_table = db.load_table(Trek, where={"id": trek_id})
     if trek_table.num_rows == 0:
         raise exc.ServerException(
             exc.E101Error(status_code=403, detail="Trek not found")
@@ -195,9 +207,7 @@ def get_trek(
     assert trek_table.num_rows == 1
     trek_record = trek_table.to_pylist()[0]
 
-    trek_user_table = db.load_table(
-        TrekUser, filter=(pc.field("trek_id") == pc.scalar(trek_id))
-    )
+    trek_user_table = db.load_table(TrekUser, where={"trek_id": trek_id})
 
     if trek_user_table.filter(pc.field("user_id") == pc.scalar(user_id)).num_rows == 0:
         raise exc.ServerException(exc.E101Error(status_code=403, detail="Forbidden"))
@@ -207,25 +217,28 @@ def get_trek(
 
     is_owner = trek_record["owner_id"] == user_id
 
-    leg_table = db.load_table(
-        Leg, filter=pc.field("trek_id") == pc.scalar(trek_id)
-    ).sort_by("added_at")
+    leg_table = db.load_table(Leg, where={"trek_id": trek_id}).sort_by("added_at")
     leg_records = leg_table.to_pylist()
 
     can_add_leg = (not _check_unfinished_leg(leg_table)) and _check_is_next_leg_adder(
         trek_user_records, leg_table, user_id
     )
 
-    locations_table = db.load_table(
-        Location, filter=pc.field("trek_id") == pc.scalar(trek_id)
-    ).sort_by([("added_at", "descending")])
+    locations_table = db.load_table(Location, where={"trek_id": trek_id}).sort_by(
+        [("added_at", "descending")]
+    )
     if locations_table.num_rows > 0:
         current_location = locations_table.slice(length=1).to_pylist()[0]
     else:
-        waypoints_table = db.load_table(
-            Waypoint, filter=pc.field("trek_id") == pc.scalar(trek_id)
-        )
-        current_location = waypoints_table.slice(length=1).to_pylist()[0]
+        first_leg = geometry.load_summary(db, trek_id, leg_records[0]["id"])
+        current_location = {
+            "id": first_leg["start_waypoint_id"],
+            "trek_id": trek_id,
+            "leg_id": first_leg["leg_id"],
+            "lat": first_leg["start_lat"],
+            "lon": first_leg["start_lon"],
+            "distance": 0.0,
+        }
 
     res = GetTrekResponse(
         legs=leg_records,
@@ -309,15 +322,8 @@ def _assert_waypoints_connect(
     db: Database, leg_table: pa.Table, trek_id: Id, waypoints: t.Sequence[tuple]
 ):
     prev_leg_id = leg_table.column("id").to_pylist()[-1]
-    prev_leg_waypoints_table = db.load_table(
-        Waypoint,
-        filter=(
-            (pc.field("trek_id") == pc.scalar(trek_id))
-            & (pc.field("leg_id") == pc.scalar(prev_leg_id))
-        ),
-    )
-    last_loc_record = prev_leg_waypoints_table.sort_by("distance").to_pylist()[-1]
-    last_loc_tuple = (int(last_loc_record["lat"]), int(last_loc_record["lon"]))
+    prev_leg = geometry.load_summary(db, trek_id, prev_leg_id)
+    last_loc_tuple = (int(prev_leg["end_lat"]), int(prev_leg["end_lon"]))
     first_loc = waypoints[0]
     first_loc_tuple = (int(first_loc[0]), int(first_loc[1]))
     if last_loc_tuple != first_loc_tuple:
@@ -337,18 +343,14 @@ def add_leg(
 ) -> AddLegResponse:
     assert_trek_exists(db, trek_id)
     assert_trek_participant(db, trek_id, user_id)
-    leg_table = db.load_table(
-        Leg, filter=pc.field("trek_id") == pc.scalar(trek_id)
-    ).sort_by("added_at")
+    leg_table = db.load_table(Leg, where={"trek_id": trek_id}).sort_by("added_at")
 
     _assert_no_unfinished_leg(leg_table)
-    trek_users = db.load_records(
-        TrekUser, filter=pc.field("trek_id") == pc.scalar(trek_id)
-    )
+    trek_users = db.load_records(TrekUser, where={"trek_id": trek_id})
     _assert_is_next_leg_adder(trek_users, leg_table, user_id)
-    waypoints = polyline.decode(request.polyline, 5)
+    lat, lon = geometry.decode_polyline(request.polyline, 5)
     if leg_table.num_rows > 0:
-        _assert_waypoints_connect(db, leg_table, trek_id, waypoints)
+        _assert_waypoints_connect(db, leg_table, trek_id, [(lat[0], lon[0])])
 
     leg_id = db.make_id()
     leg_record: Leg = {
@@ -360,46 +362,61 @@ def add_leg(
     }
     db.append_record(Leg, leg_record)
 
-    waypoint_records = _waypoint_tuple_to_records(trek_id, leg_id, waypoints, db)
-    waypoints_table = pa.Table.from_pylist(waypoint_records, schema=waypoint_schema)
-    db.save_table(Waypoint, waypoints_table)
+    _save_waypoints(db, trek_id, leg_id, lat, lon)
 
     return AddLegResponse(leg_id=leg_id)
 
 
-def _waypoint_tuple_to_records(
-    trek_id: Id, leg_id: Id, waypoints: list[tuple[float, float]], db: Database
-) -> list[Waypoint]:
-    result = []
-    lat, lon = waypoints[0]
-    first_waypoint: Waypoint = {
-        "id": db.make_id(),
-        "trek_id": trek_id,
-        "leg_id": leg_id,
-        "lat": round_coords(lat),
-        "lon": round_coords(lon),
-        "distance": 0,
-    }
-    result.append(first_waypoint)
-    prev_waypoint = first_waypoint
-    for lat, lon in waypoints[1:]:
-        distance_from_prev = distance(
-            (prev_waypoint["lat"], prev_waypoint["lon"]),
-            (lat, lon),
-        ).m
-        distance_from_prev = round(distance_from_prev, 2)
-        cumulative_distance = prev_waypoint["distance"] + distance_from_prev
-        waypoint: Waypoint = {
-            "id": db.make_id(),
-            "trek_id": trek_id,
-            "leg_id": leg_id,
-            "lat": round_coords(lat),
-            "lon": round_coords(lon),
-            "distance": cumulative_distance,
-        }
-        result.append(waypoint)
-        prev_waypoint = waypoint
-    return result
+def _save_waypoints(
+    db: Database, trek_id: Id, leg_id: Id, lat: np.ndarray, lon: np.ndarray
+) -> None:
+    waypoints_table = _waypoints_table(db, trek_id, leg_id, lat, lon)
+    db.save_table(Waypoint, waypoints_table)
+    lat = waypoints_table.column("lat").to_numpy()
+    lon = waypoints_table.column("lon").to_numpy()
+    distance = waypoints_table.column("distance").to_numpy()
+    summary = geometry.summary_record(
+        trek_id,
+        leg_id,
+        ids=waypoints_table.column("id").to_pylist(),
+        lat=lat,
+        lon=lon,
+        distance=distance,
+    )
+    db.append_record(LegSummary, summary)
+    simplification_records = geometry.simplification_records(
+        trek_id, leg_id, lat=lat, lon=lon, distance=distance
+    )
+    if simplification_records:
+        db.save_table(
+            LegSimplification,
+            pa.Table.from_pylist(
+                simplification_records, schema=leg_simplification_schema
+            ),
+        )
+
+
+def _waypoints_table(
+    db: Database, trek_id: Id, leg_id: Id, lat: np.ndarray, lon: np.ndarray
+) -> pa.Table:
+    n = len(lat)
+    lat = np.round(lat, 7)
+    lon = np.round(lon, 7)
+    lengths = np.round(
+        geometry.segment_lengths(lat, lon, config.waypoint_distance_mode), 2
+    )
+    distance = np.concatenate(([0.0], np.cumsum(lengths)))
+    return pa.Table.from_pydict(
+        {
+            "id": db.make_ids(n),
+            "trek_id": pa.array([trek_id] * n, pa.string()),
+            "leg_id": pa.array([leg_id] * n, pa.string()),
+            "lat": lat,
+            "lon": lon,
+            "distance": distance,
+        },
+        schema=waypoint_schema,
+    )
 
 
 def delete_trek(trek_id: Id, db: Database, user_id: Id):
@@ -410,7 +427,11 @@ def delete_trek(trek_id: Id, db: Database, user_id: Id):
     db.delete_records(Leg, filter=filter_)
     db.delete_records(Location, filter=filter_)
     db.delete_records(TrekUser, filter=filter_)
+    db.delete_records(LegSummary, filter=filter_)
     db.delete_partion(Waypoint, trek_id)
+    db.delete_partion(LegSimplification, trek_id)
+    db.delete_partion(AchievementState, trek_id)
+    db.delete_partion(TrekStats, trek_id)
 
 
 class GetLegResponse(BaseModel):
@@ -421,50 +442,78 @@ class GetLegResponse(BaseModel):
     polyline: t.Optional[str]
 
 
+def _leg_line(
+    db: Database, trek_id: Id, leg_id: Id, high: t.Optional[float], pixels: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """The leg line before high, simplified to what pixels by pixels can show"""
+    waypoints_filter = (pc.field("trek_id") == pc.scalar(trek_id)) & (
+        pc.field("leg_id") == pc.scalar(leg_id)
+    )
+    if high is not None:
+        waypoints_filter = waypoints_filter & (pc.field("distance") < high)
+    levels = geometry.load_levels(db, trek_id, leg_id)
+    level = None
+    if levels:
+        finest = levels[0]
+        before = finest.distance < (high if high is not None else np.inf)
+        tolerance = geometry.fit_tolerance(
+            finest.lat[before], finest.lon[before], pixels, pixels
+        )
+        level = geometry.pick_level(levels, tolerance)
+    if level is None:
+        waypoints = db.load_table(
+            Waypoint, filter=waypoints_filter, columns=["lat", "lon"]
+        )
+        return waypoints.column("lat").to_numpy(), waypoints.column("lon").to_numpy()
+    if high is None:
+        return level.lat, level.lon
+    before = level.distance < high
+    lat, lon = level.lat[before], level.lon[before]
+    # straight stretches keep few points, so the line ends at the last waypoint
+    # before high, as the full line does, rather than where the level stops
+    if before.any():
+        waypoints_filter = waypoints_filter & (
+            pc.field("distance") > level.distance[before][-1]
+        )
+    tail = db.load_table(
+        Waypoint, filter=waypoints_filter, columns=["lat", "lon", "distance"]
+    )
+    if tail.num_rows == 0:
+        return lat, lon
+    last = tail.sort_by([("distance", "descending")]).slice(0, 1)
+    return (
+        np.append(lat, last.column("lat").to_numpy()),
+        np.append(lon, last.column("lon").to_numpy()),
+    )
+
+
 def get_leg(
     trek_id: Id,
     leg_id: Id,
     db: Database,
     user_id: Id,
+    pixels: int = config.leg_polyline_pixels,
 ) -> GetLegResponse:
     assert_trek_exists(db, trek_id)
     assert_trek_participant(db, trek_id, user_id)
     try:
-        leg_record = db.load_records(
-            Leg,
-            filter=(pc.field("trek_id") == pc.scalar(trek_id))
-            & (pc.field("id") == pc.scalar(leg_id)),
-        )[0]
+        leg_record = db.load_records(Leg, where={"trek_id": trek_id, "id": leg_id})[0]
     except IndexError:
         raise exc.ServerException(
             exc.E101Error(status_code=403, detail="Leg not found")
         )
-    locations = db.load_records(
-        Location,
-        filter=(pc.field("trek_id") == pc.scalar(trek_id))
-        & (pc.field("leg_id") == pc.scalar(leg_id)),
-    )
+    locations = db.load_records(Location, where={"trek_id": trek_id, "leg_id": leg_id})
 
     if len(locations) == 0:
         line = None
         start = None
         end = None
     else:
-        waypoints_filter = (pc.field("trek_id") == pc.scalar(trek_id)) & (
-            pc.field("leg_id") == pc.scalar(leg_id)
-        )
-        if not leg_record["is_finished"]:
-            waypoints_filter = waypoints_filter & (
-                pc.field("distance") < locations[-1]["distance"]
-            )
-        waypoints = db.load_records(
-            Waypoint, filter=waypoints_filter, columns=["lat", "lon"]
-        )
-        line = polyline.encode(
-            [(waypoint["lat"], waypoint["lon"]) for waypoint in waypoints], 5
-        )
-        start = waypoints[0]
-        end = waypoints[-1]
+        high = None if leg_record["is_finished"] else locations[-1]["distance"]
+        lat, lon = _leg_line(db, trek_id, leg_id, high, pixels)
+        line = polyline.encode(list(zip(lat.tolist(), lon.tolist())), 5)
+        start = {"lat": float(lat[0]), "lon": float(lon[0])}
+        end = {"lat": float(lat[-1]), "lon": float(lon[-1])}
 
     res = GetLegResponse(
         leg=leg_record,
@@ -0,0 +1,308 @@
+"""Leg lines as arrays: decoding, lengths and Douglas–Peucker simplification
+
+Polylines are decoded straight into arrays, and segment lengths are computed for
+all segments at once, so adding a leg of tens of thousands of points does not
+loop over them in Python.
+
+Every waypoint of a leg gets the largest tolerance, in meters, at which
+Douglas–Peucker keeps it. A simplified line for any tolerance is then a filter,
+and a few levels of it are stored per leg when its waypoints are added, so maps
+and the frontend draw only as many points as their resolution can show.
+"""
+from dataclasses import dataclass
+import typing as t
+
+from geopy.distance import EARTH_RADIUS, geodesic
+from gpxpy.geo import ONE_DEGREE
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from trek.database import Database
+from trek.models import Id, LegSimplification, LegSummary, Waypoint
+
+# 1 m to 16 km
+LEVEL_TOLERANCES: t.Final = tuple(2.0**k for k in range(15))
+# the ends of a line are kept at every tolerance
+KEPT: t.Final = float(np.finfo(np.float64).max)
+
+
+# WGS-84, as used by geopy's geodesic
+WGS84_A: t.Final = 6378137.0
+WGS84_F: t.Final = 1 / 298.257223563
+WGS84_B: t.Final = (1 - WGS84_F) * WGS84_A
+
+
+def decode_polyline(
+    expression: str, precision: int = 5
+) -> tuple[np.ndarray, np.ndarray]:
+    """Latitudes and longitudes of an encoded polyline, as polyline.decode"""
+    if not expression:
+        return np.zeros(0), np.zeros(0)
+    chars = np.frombuffer(expression.encode("ascii"), dtype=np.uint8)
+    codes = chars.astype(np.int64) - 63
+    # a value is a run of 5 bit chunks, the last without the continuation bit
+    is_last = (codes & 0x20) == 0
+    value_starts = np.flatnonzero(np.concatenate(([True], is_last[:-1])))
+    value_index = np.cumsum(np.concatenate(([0], is_last[:-1])))
+    shifts = 5 * (np.arange(len(codes)) - value_starts[value_index])
+    values = np.add.reduceat((codes & 0x1F) << shifts, value_starts)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+    factor = float(10**precision)
+    lat = np.cumsum(deltas[0::2]) / factor
+    lon = np.cumsum(deltas[1::2]) / factor
+    return lat, lon
+
+
+def _vincenty(
+    lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Vincenty's inverse formula, and whether it converged, per pair of points"""
+    f = WGS84_F
+    u1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+    diff_lon = np.radians(lon2 - lon1)
+    lam = diff_lon
+    converged = np.zeros(len(lam), dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for _ in range(200):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(
+                cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam
+            )
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(
+                sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma
+            )
+            cos2_alpha = 1 - sin_alpha**2
+            # equatorial lines have cos2_alpha 0
+            cos_2sigma_m = np.where(
+                cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha
+            )
+            c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            prev_lam = lam
+            lam = diff_lon + (1 - c) * f * sin_alpha * (
+                sigma
+                + c
+                * sin_sigma
+                * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m**2))
+            )
+            converged = np.abs(lam - prev_lam) < 1e-12
+            if converged.all():
+                break
+    u_sq = cos2_alpha * (WGS84_A**2 - WGS84_B**2) / WGS84_B**2
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    cos2_2sigma_m = cos_2sigma_m**2
+    term = cos_sigma * (2 * cos2_2sigma_m - 1) - b / 6 * cos_2sigma_m * (
+        4 * sin_sigma**2 - 3
+    ) * (4 * cos2_2sigma_m - 3)
+    delta_sigma = b * sin_sigma * (cos_2sigma_m + b / 4 * term)
+    return WGS84_B * a * (sigma - delta_sigma), converged
+
+
+def _haversine(
+    lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray
+) -> np.ndarray:
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(lon2 - lon1)
+    h = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * 1000 * np.arcsin(np.sqrt(h))
+
+
+def segment_lengths(
+    lat: np.ndarray, lon: np.ndarray, mode: str = "ellipsoidal"
+) -> np.ndarray:
+    """Lengths in meters between consecutive points
+
+    Ellipsoidal lengths match geopy's geodesic to well under a millimeter,
+    haversine lengths are on a sphere and within about half a percent.
+    """
+    if mode == "haversine":
+        return _haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    if mode != "ellipsoidal":
+        raise ValueError(f"Unknown distance mode {mode}")
+    lengths, converged = _vincenty(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    # nearly antipodal points, where Vincenty's formula does not converge
+    for i in np.flatnonzero(~converged):
+        lengths[i] = geodesic((lat[i], lon[i]), (lat[i + 1], lon[i + 1])).m
+    return lengths
+
+
+def _project(lat: np.ndarray, lon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # equirectangular, in meters, good enough for tolerances of a few pixels
+    lon = np.degrees(np.unwrap(np.radians(lon)))
+    x = lon * ONE_DEGREE * np.cos(np.radians(lat))
+    y = lat * ONE_DEGREE
+    return x, y
+
+
+def _segment_distances(
+    x: np.ndarray, y: np.ndarray, first: int, last: int
+) -> np.ndarray:
+    """Distances of the points between first and last to the segment joining them"""
+    px, py = x[first + 1 : last], y[first + 1 : last]
+    dx, dy = x[last] - x[first], y[last] - y[first]
+    length2 = dx * dx + dy * dy
+    if length2 == 0:
+        return np.hypot(px - x[first], py - y[first])
+    along = np.clip(((px - x[first]) * dx + (py - y[first]) * dy) / length2, 0, 1)
+    return np.hypot(px - (x[first] + along * dx), py - (y[first] + along * dy))
+
+
+def douglas_peucker_tolerances(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """The largest tolerance in meters at which each point is kept
+
+    Simplifying with a tolerance keeps the points whose value is larger than it,
+    exactly the points a Douglas–Peucker run with that tolerance keeps.
+    """
+    n = len(lat)
+    tolerances = np.zeros(n)
+    if n == 0:
+        return tolerances
+    tolerances[[0, -1]] = KEPT
+    x, y = _project(np.asarray(lat), np.asarray(lon))
+    stack = [(0, n - 1, KEPT)]
+    while stack:
+        first, last, parent = stack.pop()
+        if last - first < 2:
+            continue
+        distances = _segment_distances(x, y, first, last)
+        i = int(np.argmax(distances))
+        # a point is only kept if the split that made its segment was kept
+        tolerance = min(float(distances[i]), parent)
+        tolerances[first + 1 + i] = tolerance
+        stack.append((first, first + 1 + i, tolerance))
+        stack.append((first + 1 + i, last, tolerance))
+    return tolerances
+
+
+def fit_tolerance(lat: np.ndarray, lon: np.ndarray, width: int, height: int) -> float:
+    """Meters per pixel of a width by height map that fits the points"""
+    if len(lat) == 0:
+        return 0.0
+    x, y = _project(lat, lon)
+    return max(float(np.ptp(x)) / width, float(np.ptp(y)) / height)
+
+
+def simplification_records(
+    trek_id: Id, leg_id: Id, lat: np.ndarray, lon: np.ndarray, distance: np.ndarray
+) -> list[LegSimplification]:
+    """Levels of the leg line, each with at most half the points of the last"""
+    tolerances = douglas_peucker_tolerances(lat, lon)
+    records: list[LegSimplification] = []
+    n_points = len(lat)
+    for tolerance in LEVEL_TOLERANCES:
+        keep = tolerances > tolerance
+        n_kept = int(keep.sum())
+        if n_kept > n_points / 2:
+            continue
+        records.append(
+            {
+                "trek_id": trek_id,
+                "leg_id": leg_id,
+                "tolerance": tolerance,
+                "lat": lat[keep].tolist(),
+                "lon": lon[keep].tolist(),
+                "distance": distance[keep].tolist(),
+            }
+        )
+        n_points = n_kept
+        if n_kept <= 2:
+            break
+    return records
+
+
+@dataclass(frozen=True)
+class SimplifiedLine:
+    tolerance: float
+    lat: np.ndarray
+    lon: np.ndarray
+    distance: np.ndarray
+
+
+def load_levels(db: Database, trek_id: Id, leg_id: Id) -> list[SimplifiedLine]:
+    """The stored levels of a leg line, finest first"""
+    table = db.load_table(
+        LegSimplification,
+        filter=(
+            (pc.field("trek_id") == pc.scalar(trek_id))
+            & (pc.field("leg_id") == pc.scalar(leg_id))
+        ),
+        columns=["tolerance", "lat", "lon", "distance"],
+    ).sort_by("tolerance")
+    return [
+        SimplifiedLine(
+            tolerance=table.column("tolerance")[i].as_py(),
+            lat=_list_values(table.column("lat")[i]),
+            lon=_list_values(table.column("lon")[i]),
+            distance=_list_values(table.column("distance")[i]),
+        )
+        for i in range(table.num_rows)
+    ]
+
+
+def _list_values(scalar: pa.ListScalar) -> np.ndarray:
+    return scalar.values.to_numpy(zero_copy_only=False)
+
+
+def pick_level(
+    levels: t.Sequence[SimplifiedLine], tolerance: float
+) -> t.Optional[SimplifiedLine]:
+    """The coarsest level within tolerance, None if the full line is needed"""
+    fitting = [level for level in levels if level.tolerance <= tolerance]
+    return fitting[-1] if fitting else None
+
+
+def summary_record(
+    trek_id: Id,
+    leg_id: Id,
+    ids: t.Sequence[Id],
+    lat: np.ndarray,
+    lon: np.ndarray,
+    distance: np.ndarray,
+) -> LegSummary:
+    """The summary of a leg line, its points sorted by distance"""
+    return {
+        "trek_id": trek_id,
+        "leg_id": leg_id,
+        "n_waypoints": len(lat),
+        "total_distance": float(distance[-1]),
+        "start_waypoint_id": ids[0],
+        "start_lat": float(lat[0]),
+        "start_lon": float(lon[0]),
+        "end_waypoint_id": ids[-1],
+        "end_lat": float(lat[-1]),
+        "end_lon": float(lon[-1]),
+        "min_lat": float(lat.min()),
+        "min_lon": float(lon.min()),
+        "max_lat": float(lat.max()),
+        "max_lon": float(lon.max()),
+    }
+
+
+def load_summary(db: Database, trek_id: Id, leg_id: Id) -> LegSummary:
+    """The stored summary of a leg, from its waypoints if it has none"""
+    records = db.load_records(LegSummary, where={"trek_id": trek_id, "leg_id": leg_id})
+    if records:
+        return records[0]
+    waypoints = db.load_table(
+        Waypoint,
+        filter=(
+            (pc.field("trek_id") == pc.scalar(trek_id))
+            & (pc.field("leg_id") == pc.scalar(leg_id))
+        ),
+        columns=["id", "lat", "lon", "distance"],
+    ).sort_by("distance")
+    return summary_record(
+        trek_id,
+        leg_id,
+        ids=waypoints.column("id").to_pylist(),
+        lat=waypoints.column("lat").to_numpy(),
+        lon=waypoints.column("lon").to_numpy(),
+        distance=waypoints.column("distance").to_numpy(),
+    )
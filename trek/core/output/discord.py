@@ -10,7 +10,7 @@ from trek import config, utils
 from trek.core.core_utils import assert_trek_owner
 from trek.core.output import output_utils
 from trek.core.progress.progress_utils import STRIDE, UserProgress, round_meters
-from trek.database import Database
+from trek.database import AsyncDatabase, Database
 from trek.models import Achievement, DiscordChannel, Id, Location, Trek, User
 
 
@@ -41,19 +41,24 @@ def make_authorization_url(
     return UrlResponse(url=url)
 
 
-def handle_discord_redirect(db: Database, state, guild_id: int):
+async def handle_discord_redirect(db: AsyncDatabase, state, guild_id: int):
     state_params = utils.decode_dict(state)
     trek_id = state_params["trek_id"]
-    channel_id = asyncio.run(_make_trek_channel(guild_id))
+    channel_id = await _make_trek_channel(guild_id)
     channel: DiscordChannel = {
         "trek_id": trek_id,
         "guild_id": guild_id,
         "channel_id": channel_id,
     }
-    db.upsert_record(DiscordChannel, channel, pc.field("trek_id") == pc.scalar(trek_id))
-    trek_record = db.load_records(Trek, filter=pc.field("id") == pc.scalar(trek_id))[0]
+    await db.upsert_record(
+        DiscordChannel, channel, pc.field("trek_id") == pc.scalar(trek_id)
+    )
+    trek_records = await db.load_records(
+        Trek, filter=pc.field("id") == pc.scalar(trek_id)
+    )
+    trek_record = trek_records[0]
     trek_record["output_to"] = "discord"
-    db.upsert_record(Trek, trek_record, pc.field("id") == pc.scalar(trek_id))
+    await db.upsert_record(Trek, trek_record, pc.field("id") == pc.scalar(trek_id))
 
     frontend_redirect_url = state_params["frontend_redirect_url"]
     return frontend_redirect_url
@@ -1,146 +1,538 @@
+"""Records of the steps taken, for a whole trek and for its current leg
+
+Each achievement type keeps a running state per trek and per leg: the record,
+and what it needs to value a new day, like the users' last amounts or the
+current streak. A day's steps update the state without reading the history.
+
+The state can be rebuilt from the history, and checked against a full
+recompute, where the steps are laid out as a days by users grid and a kernel
+turns the grid into a grid of the values the achievement type ranks.
+
+New achievement types are added to possible_achievements, with a kernel and an
+advance function that values one new day.
+"""
+from dataclasses import dataclass
 import logging
 import typing as t
-import warnings
 
-import pandas as pd
-from pandas.errors import SettingWithCopyWarning
+import numpy as np
 import pendulum
 import pyarrow as pa
 import pyarrow.compute as pc
 
-from trek.database import Database
-from trek.models import Achievement, Id, Step
+from trek.database import Database, achievement_state_schema
+from trek.models import Achievement, AchievementState, Id, Step, Trek
 
 log = logging.getLogger(__name__)
 
+EPOCH: t.Final = pendulum.date(1970, 1, 1)
+STATE_KEY: t.Final = ["trek_id", "scope", "achievement_type"]
+
+
+@dataclass(frozen=True)
+class StepGrid:
+    """Steps of a scope by day and user, NaN where there is no step"""
+
+    # days since the epoch, ascending
+    days: np.ndarray
+    user_ids: pa.Array
+    amounts: np.ndarray
+
+
+class Record(t.TypedDict):
+    user_id: Id
+    taken_at: pendulum.Date
+    amount: int
+
+
+Kernel = t.Callable[[StepGrid], np.ndarray]
+# the values of a new day from its amounts, updating the state it needs
+Advance = t.Callable[[AchievementState, np.ndarray], np.ndarray]
+
+
+@dataclass(frozen=True)
+class AchievementType:
+    achievement_type: str
+    kernel: Kernel
+    advance: Advance
+    description: str
+    unit: str
+    # on equal values, whether the latest day holds the record rather than the first
+    latest_first: bool = False
+
+
+def step_grid(table: pa.Table, user_ids: pa.Array) -> StepGrid:
+    days = pc.cast(table.column("taken_at"), pa.int32()).to_numpy()
+    user_index = pc.index_in(table.column("user_id"), value_set=user_ids).to_numpy()
+    amounts = pc.cast(table.column("amount"), pa.float64()).to_numpy()
+    grid_days, day_index = np.unique(days, return_inverse=True)
+    grid_amounts = np.full((len(grid_days), len(user_ids)), np.nan)
+    grid_amounts[day_index, user_index] = amounts
+    return StepGrid(days=grid_days, user_ids=user_ids, amounts=grid_amounts)
+
+
+def step_grids(table: pa.Table, leg_id: Id) -> tuple[StepGrid, StepGrid]:
+    """The grids of the trek and of the leg, from the trek's steps"""
+    user_ids = pc.unique(table.column("user_id"))
+    leg_steps = table.filter(pc.field("leg_id") == pc.scalar(leg_id))
+    return step_grid(table, user_ids), step_grid(leg_steps, user_ids)
+
+
+def _daily_amounts(grid: StepGrid) -> np.ndarray:
+    return grid.amounts
+
+
+def _advance_daily_amounts(state: AchievementState, amounts: np.ndarray) -> np.ndarray:
+    return amounts
+
+
+def _weekly_amounts(grid: StepGrid, n_days: int = 7) -> np.ndarray:
+    """Sums of each user's last n_days steps, on the days the user took steps
+
+    Days a user has no steps are skipped rather than counted, as a missing day
+    usually means the tracker could not be reached.
+    """
+    weekly = np.full(grid.amounts.shape, np.nan)
+    for user, amounts in enumerate(grid.amounts.T):
+        rows = np.flatnonzero(~np.isnan(amounts))
+        sums = np.cumsum(np.concatenate([[0.0], amounts[rows]]))
+        weekly[rows[n_days - 1 :], user] = sums[n_days:] - sums[:-n_days]
+    return weekly
+
 
-def _check_new_achivement(
-    records: list[Step], date: pendulum.Date
-) -> t.Optional[tuple[Step, Step]]:
-    if not records:
+def _advance_weekly_amounts(
+    state: AchievementState, amounts: np.ndarray, n_days: int = 7
+) -> np.ndarray:
+    recent = _recent_amounts(state)
+    window = np.full((n_days, len(amounts)), np.nan)
+    window[n_days - 1 - len(recent) : n_days - 1] = recent
+    window[-1] = amounts
+    is_step = ~np.isnan(amounts)
+    # users without steps today keep their last amounts and get no value
+    weekly = np.where(is_step, window.sum(axis=0), np.nan)
+    window[:-1, is_step] = window[1:, is_step]
+    state["recent_amounts"] = window[:-1].ravel().tolist()
+    return weekly
+
+
+def _leaders(amounts: np.ndarray) -> np.ndarray:
+    """The user with the most steps of each day, the first on ties, -1 if none"""
+    is_step = ~np.isnan(amounts)
+    leaders = np.where(is_step, amounts, -np.inf).argmax(axis=-1)
+    return np.where(is_step.any(axis=-1), leaders, -1)
+
+
+def _streak_lengths(grid: StepGrid) -> np.ndarray:
+    """Days in a row the user with the most steps of each day has had the most"""
+    n_days = len(grid.days)
+    leader = _leaders(grid.amounts)
+    day_numbers = np.arange(n_days)
+    is_start = np.ones(n_days, dtype=bool)
+    is_start[1:] = leader[1:] != leader[:-1]
+    starts = np.maximum.accumulate(np.where(is_start, day_numbers, 0))
+    lengths = np.full(grid.amounts.shape, np.nan)
+    has_leader = leader >= 0
+    lengths[day_numbers[has_leader], leader[has_leader]] = (day_numbers - starts + 1)[
+        has_leader
+    ]
+    return lengths
+
+
+def _advance_streak_lengths(state: AchievementState, amounts: np.ndarray) -> np.ndarray:
+    lengths = np.full(len(amounts), np.nan)
+    leader = int(_leaders(amounts))
+    if leader < 0:
+        state["streak_user_id"] = None
+        state["streak_length"] = 0
+        return lengths
+    user_id = state["user_ids"][leader]
+    if user_id == state["streak_user_id"]:
+        state["streak_length"] += 1
+    else:
+        state["streak_user_id"] = user_id
+        state["streak_length"] = 1
+    lengths[leader] = state["streak_length"]
+    return lengths
+
+
+most_steps_one_day = AchievementType(
+    achievement_type="most_steps_one_day",
+    kernel=_daily_amounts,
+    advance=_advance_daily_amounts,
+    description="Flest skritt gått på en dag",
+    unit="skritt",
+)
+most_steps_one_week = AchievementType(
+    achievement_type="most_steps_one_week",
+    kernel=_weekly_amounts,
+    advance=_advance_weekly_amounts,
+    description="Flest skritt gått på en uke",
+    unit="skritt",
+    latest_first=True,
+)
+longest_streak = AchievementType(
+    achievement_type="longest_streak",
+    kernel=_streak_lengths,
+    advance=_advance_streak_lengths,
+    description="Flest førsteplasser på rad",
+    unit="dager",
+)
+possible_achievements = [most_steps_one_day, most_steps_one_week, longest_streak]
+achievement_types = {
+    achievement.achievement_type: achievement for achievement in possible_achievements
+}
+
+
+def _record(grid: StepGrid, values: np.ndarray, day: int, user: int) -> Record:
+    return {
+        "user_id": grid.user_ids[user].as_py(),
+        "taken_at": EPOCH.add(days=int(grid.days[day])),
+        "amount": int(values[day, user]),
+    }
+
+
+def _top_records(achievement: AchievementType, grid: StepGrid, n: int) -> list[Record]:
+    """The n best values of the kernel, in order"""
+    values = achievement.kernel(grid)
+    if values.size == 0:
+        return []
+    n_days, n_users = values.shape
+    # the best value wins, then the first day in this order and the first user
+    ordered = values[::-1] if achievement.latest_first else values
+    ranks = np.where(np.isnan(ordered), -np.inf, ordered).ravel()
+    records: list[Record] = []
+    for _ in range(n):
+        best = int(ranks.argmax())
+        if ranks[best] == -np.inf:
+            break
+        ranks[best] = -np.inf
+        day, user = divmod(best, n_users)
+        if achievement.latest_first:
+            day = n_days - 1 - day
+        records.append(_record(grid, values, day, user))
+    return records
+
+
+def best_record(achievement: AchievementType, grid: StepGrid) -> t.Optional[Record]:
+    records = _top_records(achievement, grid, 1)
+    return records[0] if records else None
+
+
+def new_record(
+    achievement: AchievementType, grid: StepGrid, date: pendulum.Date
+) -> t.Optional[tuple[Record, Record]]:
+    """The record set on date and the one it beat, if date set a record"""
+    records = _top_records(achievement, grid, 2)
+    if len(records) < 2 or records[0]["taken_at"] != date:
         return None
-    if not records[0]["taken_at"] == date:
+    new, old = records
+    return new, old
+
+
+def empty_state(
+    trek_id: Id, scope: Id, achievement: AchievementType
+) -> AchievementState:
+    return {
+        "trek_id": trek_id,
+        "scope": scope,
+        "achievement_type": achievement.achievement_type,
+        "taken_at": EPOCH,
+        "n_days": 0,
+        "user_ids": [],
+        "recent_amounts": [],
+        "record_user_id": None,
+        "record_taken_at": None,
+        "record_amount": None,
+        "streak_user_id": None,
+        "streak_length": 0,
+    }
+
+
+def _recent_amounts(state: AchievementState) -> np.ndarray:
+    n_users = len(state["user_ids"])
+    n_days = len(state["recent_amounts"]) // n_users if n_users else 0
+    return np.array(state["recent_amounts"]).reshape(n_days, n_users)
+
+
+def _state_record(state: AchievementState) -> t.Optional[Record]:
+    if state["record_user_id"] is None:
         return None
-    if len(records) < 2:
+    assert state["record_taken_at"] is not None
+    assert state["record_amount"] is not None
+    return {
+        "user_id": state["record_user_id"],
+        "taken_at": state["record_taken_at"],
+        "amount": int(state["record_amount"]),
+    }
+
+
+def _beats(achievement: AchievementType, new: Record, old: Record) -> bool:
+    """Whether new, of a later day, ranks before old"""
+    if achievement.latest_first:
+        return new["amount"] >= old["amount"]
+    return new["amount"] > old["amount"]
+
+
+def advance(
+    achievement: AchievementType,
+    state: AchievementState,
+    taken_at: pendulum.Date,
+    user_ids: list[Id],
+    amounts: np.ndarray,
+) -> t.Optional[tuple[Record, Record]]:
+    """Add a day's steps to state, and return the record set that day and the one
+    it beat, if the day set a record
+
+    user_ids starts with the users of state, and amounts has a value for each.
+    """
+    n_new_users = len(user_ids) - len(state["user_ids"])
+    if n_new_users:
+        recent = _recent_amounts(state)
+        padding = np.full((len(recent), n_new_users), np.nan)
+        state["recent_amounts"] = np.hstack([recent, padding]).ravel().tolist()
+        state["user_ids"] = list(user_ids)
+    values = achievement.advance(state, amounts)
+    state["taken_at"] = taken_at
+    state["n_days"] += 1
+
+    ranks = np.where(np.isnan(values), -np.inf, values)
+    day_records: list[Record] = []
+    for _ in range(2):
+        best = int(ranks.argmax())
+        if ranks[best] == -np.inf:
+            break
+        ranks[best] = -np.inf
+        day_records.append(
+            {
+                "user_id": user_ids[best],
+                "taken_at": taken_at,
+                "amount": int(values[best]),
+            }
+        )
+    if not day_records:
+        return None
+    record = _state_record(state)
+    new = day_records[0]
+    if record is not None and not _beats(achievement, new, record):
         return None
-    new, old = records[0:2]
-    if pd.isna(new["amount"]) or pd.isna(old["amount"]):
+    state["record_user_id"] = new["user_id"]
+    state["record_taken_at"] = new["taken_at"]
+    state["record_amount"] = float(new["amount"])
+    if len(day_records) == 1:
+        old = record
+    elif record is None or _beats(achievement, day_records[1], record):
+        old = day_records[1]
+    else:
+        old = record
+    if old is None:
         return None
     return new, old
 
 
-def _most_steps_one_day(
-    table: pa.Table, date: pendulum.Date
-) -> t.Optional[tuple[Step, Step]]:
-    records = table.sort_by(
-        [("amount", "descending"), ("taken_at", "ascending")]
-    ).to_pylist()
-    return _check_new_achivement(records, date)
-
-
-def _most_steps_one_week(
-    table: pa.Table, date: pendulum.Date
-) -> t.Optional[tuple[Step, Step]]:
-    df = (
-        table.to_pandas()
-        .sort_values(["user_id", "taken_at"])
-        .set_index("taken_at")
-        .groupby(["user_id"])["amount"]
-        .rolling(7)
-        .sum()
-        .reset_index()
-        .sort_values(["amount", "taken_at"], ascending=False)
+def replay(
+    achievement: AchievementType, trek_id: Id, scope: Id, grid: StepGrid
+) -> AchievementState:
+    """The state after adding the days of grid, one by one"""
+    state = empty_state(trek_id, scope, achievement)
+    user_ids = grid.user_ids.to_pylist()
+    for day, amounts in zip(grid.days, grid.amounts):
+        advance(achievement, state, EPOCH.add(days=int(day)), user_ids, amounts)
+    return state
+
+
+def _load_steps(
+    db: Database, trek_id: Id, filter: t.Optional[pc.Expression] = None, **where
+) -> pa.Table:
+    return db.load_table(
+        Step,
+        filter=filter,
+        where={"trek_id": trek_id, **where},
+        columns=["leg_id", "user_id", "taken_at", "amount"],
+    )
+
+
+def _rebuild_states(
+    db: Database, trek_id: Id, leg_id: Id, before: pendulum.Date
+) -> list[AchievementState]:
+    history = _load_steps(db, trek_id, filter=pc.field("taken_at") < pc.scalar(before))
+    trek_grid, leg_grid = step_grids(history, leg_id)
+    return [
+        replay(achievement, trek_id, scope, grid)
+        for scope, grid in [(trek_id, trek_grid), (leg_id, leg_grid)]
+        for achievement in possible_achievements
+    ]
+
+
+def _rebuild_leg_states(
+    db: Database, trek_id: Id, leg_id: Id, before: pendulum.Date, user_ids: list[Id]
+) -> list[AchievementState]:
+    history = _load_steps(
+        db, trek_id, filter=pc.field("taken_at") < pc.scalar(before), leg_id=leg_id
     )
-    records = df.to_dict("records")
-    return _check_new_achivement(records, date)
-
-
-def _longest_streak(
-    table: pa.Table, date: pendulum.Date
-) -> t.Optional[tuple[Step, Step]]:
-    df = table.to_pandas()[["amount", "taken_at", "user_id", "trek_id", "leg_id"]]
-    idx = df.groupby("taken_at")["amount"].idxmax()
-    daily_max = df.iloc[idx]
-    # https://joshdevlin.com/blog/calculate-streaks-in-pandas/
-    start_of_streak = daily_max["user_id"] != daily_max["user_id"].shift()
-    streak_ids = start_of_streak.cumsum()
-
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", category=SettingWithCopyWarning)
-        daily_max["streak_length"] = streak_ids.groupby(streak_ids).cumcount() + 1
-    daily_max = (
-        daily_max.sort_values("streak_length", ascending=False)
-        .drop(columns=["amount"])
-        .rename(columns={"streak_length": "amount"})
+    leg_grid = step_grid(history, pa.array(user_ids, pa.string()))
+    return [
+        replay(achievement, trek_id, leg_id, leg_grid)
+        for achievement in possible_achievements
+    ]
+
+
+def _states_are_current(states: list[AchievementState], date: pendulum.Date) -> bool:
+    types = {state["achievement_type"] for state in states}
+    return types == set(achievement_types) and all(
+        state["taken_at"] < date for state in states
     )
-    records = daily_max.to_dict("records")
-    return _check_new_achivement(records, date)
-
-
-possible_achievements = [
-    (
-        "most_steps_one_day",
-        _most_steps_one_day,
-        "Flest skritt gått på en dag",
-        "skritt",
-    ),
-    (
-        "most_steps_one_week",
-        _most_steps_one_week,
-        "Flest skritt gått på en uke",
-        "skritt",
-    ),
-    (
-        "longest_streak",
-        _longest_streak,
-        "Flest førsteplasser på rad",
-        "dager",
-    ),
-]
-
-
-def get_achievements_for_scope(
-    db: Database, table: pa.Table, date: pendulum.Date, is_for_trek: bool
-) -> list[Achievement]:
-    achievements: list[Achievement] = []
-    for ach_type, func, description, unit in possible_achievements:
-        try:
-            res = func(table, date)
-        except Exception:
-            log.error(f"Error getting checking achievement {ach_type}", exc_info=True)
-        if res is None:
-            continue
-        new, old = res
-        new_achievement: Achievement = {
-            "id": db.make_id(),
-            "added_at": new["taken_at"],
-            "amount": int(new["amount"]),
-            "user_id": new["user_id"],
-            "old_added_at": old["taken_at"],
-            "old_amount": int(old["amount"]),
-            "old_user_id": old["user_id"],
-            "is_for_trek": is_for_trek,
-            "achievement_type": ach_type,
-            "description": description,
-            "unit": unit,
-        }
-        achievements.append(new_achievement)
-    return achievements
 
 
-def main(
+def _load_states(
     db: Database, trek_id: Id, leg_id: Id, date: pendulum.Date
+) -> list[AchievementState]:
+    """The states of the trek and the leg up to the day before date
+
+    States that are missing, or that already have date, are rebuilt from the
+    history.
+    """
+    states = db.load_records(
+        AchievementState,
+        where={"trek_id": trek_id},
+        filter=pc.field("scope").isin([trek_id, leg_id]),
+    )
+    trek_states = [state for state in states if state["scope"] == trek_id]
+    leg_states = [state for state in states if state["scope"] == leg_id]
+    if not _states_are_current(trek_states, date):
+        log.info(f"Rebuilding achievement states of {trek_id}")
+        return _rebuild_states(db, trek_id, leg_id, before=date)
+    if not _states_are_current(leg_states, date):
+        log.info(f"Rebuilding achievement states of {trek_id}, leg {leg_id}")
+        user_ids = trek_states[0]["user_ids"]
+        leg_states = _rebuild_leg_states(db, trek_id, leg_id, date, user_ids)
+    return trek_states + leg_states
+
+
+def _day_amounts(user_ids: list[Id], steps: list[Step]) -> tuple[list[Id], np.ndarray]:
+    """The users with new users last, and the amount of each"""
+    amount_for_user_id = {step["user_id"]: step["amount"] for step in steps}
+    known = set(user_ids)
+    user_ids = user_ids + [
+        step["user_id"] for step in steps if step["user_id"] not in known
+    ]
+    amounts = np.array(
+        [amount_for_user_id.get(user_id) for user_id in user_ids], dtype=float
+    )
+    return user_ids, amounts
+
+
+def _achievement(
+    db: Database,
+    achievement: AchievementType,
+    new: Record,
+    old: Record,
+    is_for_trek: bool,
+) -> Achievement:
+    return {
+        "id": db.make_id(),
+        "added_at": new["taken_at"],
+        "amount": new["amount"],
+        "user_id": new["user_id"],
+        "old_added_at": old["taken_at"],
+        "old_amount": old["amount"],
+        "old_user_id": old["user_id"],
+        "is_for_trek": is_for_trek,
+        "achievement_type": achievement.achievement_type,
+        "description": achievement.description,
+        "unit": achievement.unit,
+    }
+
+
+def main(
+    db: Database, trek_id: Id, leg_id: Id, date: pendulum.Date, steps: list[Step]
 ) -> t.Optional[list[Achievement]]:
-    trek_steps = db.load_table(Step, filter=pc.field("trek_id") == pc.scalar(trek_id))
-    n_days_in_trek = pc.count_distinct(trek_steps.column("taken_at")).as_py()
+    states = _load_states(db, trek_id, leg_id, date)
+    trek_states = [state for state in states if state["scope"] == trek_id]
+    # the leg's users are ordered as in the trek
+    user_ids, amounts = _day_amounts(trek_states[0]["user_ids"], steps)
+    achievements_for_scope: dict[Id, list[Achievement]] = {trek_id: [], leg_id: []}
+    for state in states:
+        achievement = achievement_types[state["achievement_type"]]
+        try:
+            res = advance(achievement, state, date, user_ids, amounts)
+        except Exception:
+            log.error(
+                f"Error getting checking achievement {achievement.achievement_type}",
+                exc_info=True,
+            )
+            continue
+        if res is not None:
+            new, old = res
+            is_for_trek = state["scope"] == trek_id
+            achievements_for_scope[state["scope"]].append(
+                _achievement(db, achievement, new, old, is_for_trek)
+            )
+    db.upsert_records(
+        AchievementState,
+        pa.Table.from_pylist(states, schema=achievement_state_schema),
+        key_columns=STATE_KEY,
+    )
+
+    n_days_in_trek = trek_states[0]["n_days"]
     if n_days_in_trek < 3:
         return None
-    achievements = get_achievements_for_scope(db, trek_steps, date, is_for_trek=True)
-    if not achievements:
-        leg_steps = trek_steps.filter(pc.field("leg_id") == pc.scalar(leg_id))
-        n_days_in_leg = pc.count_distinct(leg_steps.column("taken_at")).as_py()
-        if n_days_in_leg > 3:
-            achievements = get_achievements_for_scope(
-                db, leg_steps, date, is_for_trek=False
-            )
+    achievements = achievements_for_scope[trek_id]
+    n_days_in_leg = next(s["n_days"] for s in states if s["scope"] == leg_id)
+    if not achievements and n_days_in_leg > 3:
+        achievements = achievements_for_scope[leg_id]
     return achievements
+
+
+def rebuild(db: Database, trek_id: Id) -> None:
+    """Replace the states of a trek and its legs with states rebuilt from history"""
+    steps = _load_steps(db, trek_id)
+    user_ids = pc.unique(steps.column("user_id"))
+    scope_steps = [(trek_id, steps)] + [
+        (leg_id, steps.filter(pc.field("leg_id") == pc.scalar(leg_id)))
+        for leg_id in pc.unique(steps.column("leg_id")).to_pylist()
+    ]
+    states = [
+        replay(achievement, trek_id, scope, step_grid(table, user_ids))
+        for scope, table in scope_steps
+        for achievement in possible_achievements
+    ]
+    db.delete_partion(AchievementState, trek_id)
+    db.append_records(AchievementState, states)
+
+
+def check(db: Database, trek_id: Id) -> list[str]:
+    """Differences between the stored records and records recomputed from history"""
+    steps = _load_steps(db, trek_id)
+    user_ids = pc.unique(steps.column("user_id"))
+    mismatches = []
+    for state in db.load_records(AchievementState, where={"trek_id": trek_id}):
+        table = steps.filter(pc.field("taken_at") <= pc.scalar(state["taken_at"]))
+        if state["scope"] != trek_id:
+            table = table.filter(pc.field("leg_id") == pc.scalar(state["scope"]))
+        grid = step_grid(table, user_ids)
+        achievement = achievement_types[state["achievement_type"]]
+        expected = best_record(achievement, grid)
+        if _state_record(state) != expected or state["n_days"] != len(grid.days):
+            mismatches.append(
+                f"{achievement.achievement_type} of {state['scope']}: "
+                f"{_state_record(state)} after {state['n_days']} days, "
+                f"recomputed {expected} after {len(grid.days)} days"
+            )
+    return mismatches
+
+
+def rebuild_all() -> None:
+    with Database.get_db_mgr() as db:
+        for trek in db.load_records(Trek, columns=["id"]):
+            log.info(f"Rebuilding achievement states of {trek['id']}")
+            rebuild(db, trek["id"])
+
+
+def check_all() -> bool:
+    with Database.get_read_db_mgr() as db:
+        is_consistent = True
+        for trek in db.load_records(Trek, columns=["id"]):
+            for mismatch in check(db, trek["id"]):
+                log.warning(f"Achievement state of {trek['id']} differs, {mismatch}")
+                is_consistent = False
+    return is_consistent
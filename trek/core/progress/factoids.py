@@ -3,39 +3,19 @@ from operator import itemgetter
 import typing as t  # noqa
 
 import pendulum
-import pyarrow.compute as pc
 
-from trek.core.progress.progress_utils import STRIDE, round_meters
+from trek.core.progress import stats
+from trek.core.progress.progress_utils import STRIDE, LegGeometry, round_meters
 from trek.database import Database
-from trek.models import Id, Location, Step, User, Waypoint
-
-
-def _get_leg_total_distance(
-    db: Database,
-    trek_id: Id,
-    leg_id: Id,
-) -> float:
-    waypoints_table = db.load_table(
-        Waypoint,
-        filter=(
-            (pc.field("trek_id") == pc.scalar(trek_id))
-            & (pc.field("leg_id") == pc.scalar(leg_id))
-        ),
-        columns=["distance"],
-    )
-    scalar = pc.max(waypoints_table.column("distance"))
-    value = scalar.as_py()
-    return value
+from trek.models import Id, User
 
 
 def remaining_distance_leg(
-    db: Database,
-    trek_id: Id,
-    leg_id: Id,
     cumulative_progress: float,
+    geometry: LegGeometry,
     **kwargs,
 ) -> str:
-    leg_total_distance = _get_leg_total_distance(db, trek_id, leg_id)
+    leg_total_distance = geometry.total_distance
     distance_remaining = max(leg_total_distance - cumulative_progress, 0)
     return (
         f"Nå har vi gått {round_meters(cumulative_progress)} på denne etappen - "
@@ -49,20 +29,14 @@ def eta_average_leg(
     leg_id: Id,
     date: pendulum.Date,
     cumulative_progress: float,
+    geometry: LegGeometry,
     **kwargs,
 ) -> str:
-    locations_table = db.load_table(
-        Location,
-        filter=(
-            (pc.field("trek_id") == pc.scalar(trek_id))
-            & (pc.field("leg_id") == pc.scalar(leg_id))
-        ),
-    )
-    n_days = locations_table.num_rows + 1
+    # today's location is not saved yet
+    n_days = stats.load(db, trek_id, leg_id)["n_days"] + 1
     distance_average = cumulative_progress / n_days
 
-    leg_total_distance = _get_leg_total_distance(db, trek_id, leg_id)
-    distance_remaining = leg_total_distance - cumulative_progress
+    distance_remaining = geometry.total_distance - cumulative_progress
 
     days_remaining = math.ceil(distance_remaining / distance_average)
     eta = date.add(days=days_remaining)
@@ -80,31 +54,23 @@ def eta_average_leg(
 #     )
 
 
+def _top_user(db: Database, steps_for_user_id: dict[Id, int]) -> tuple[User, int]:
+    # the last user wins ties
+    user_id, amount = max(reversed(steps_for_user_id.items()), key=itemgetter(1))
+    user = db.load_records(User, where={"id": user_id})[0]
+    return user, amount
+
+
 def weekly_summary(
     db, trek_id: Id, leg_id: Id, date: pendulum.Date, **kwargs
 ) -> t.Optional[str]:
-    one_week_ago = date.subtract(weeks=1)
-    users_sum_steps = (
-        db.load_table(
-            Step,
-            filter=(
-                (pc.field("trek_id") == pc.scalar(trek_id))
-                & (pc.field("leg_id") == pc.scalar(leg_id))
-                & (pc.field("taken_at") > pc.scalar(one_week_ago))
-            ),
-        )
-        .group_by("user_id")
-        .aggregate([("amount", "sum")])
-    ).to_pylist()
-    if len(users_sum_steps) == 0:
+    users_sum_steps = stats.weekly_steps(stats.load(db, trek_id, leg_id), date)
+    if users_sum_steps is None:
         return None
-    top_user = sorted(users_sum_steps, key=itemgetter("amount_sum"))[-1]
-    user_data = db.load_table(
-        User, filter=pc.field("id") == top_user["user_id"]
-    ).to_pylist()[0]
-    max_week_distance = round_meters(top_user["amount_sum"] * STRIDE)
+    user_data, top_user_steps = _top_user(db, users_sum_steps)
+    max_week_distance = round_meters(top_user_steps * STRIDE)
 
-    together_week_steps = sum(user["amount_sum"] for user in users_sum_steps)
+    together_week_steps = sum(users_sum_steps.values())
     together_week_distance = together_week_steps * STRIDE
     return (
         f"Denne uken har vi gått {round_meters(together_week_distance)} til sammen. "
@@ -113,32 +79,10 @@ def weekly_summary(
 
 
 def leg_summary(db, trek_id: Id, leg_id: Id) -> str:
-    location_table = db.load_table(
-        Location,
-        filter=(
-            (pc.field("trek_id") == pc.scalar(trek_id))
-            & (pc.field("leg_id") == pc.scalar(leg_id))
-        ),
-        columns=["added_at"],
-    )
-    n_days = location_table.num_rows
-
-    users_sum_steps = (
-        db.load_table(
-            Step,
-            filter=(
-                (pc.field("trek_id") == pc.scalar(trek_id))
-                & (pc.field("leg_id") == pc.scalar(leg_id))
-            ),
-        )
-        .group_by("user_id")
-        .aggregate([("amount", "sum")])
-    ).to_pylist()
-    top_user = sorted(users_sum_steps, key=itemgetter("amount_sum"))[-1]
-    user_data = db.load_table(
-        User, filter=pc.field("id") == top_user["user_id"]
-    ).to_pylist()[0]
-    max_total_distance = round_meters(top_user["amount_sum"] * STRIDE)
+    leg_stats = stats.load(db, trek_id, leg_id)
+    n_days = leg_stats["n_days"]
+    user_data, top_user_steps = _top_user(db, stats.step_totals(leg_stats))
+    max_total_distance = round_meters(top_user_steps * STRIDE)
 
     return (
         f"Denne etappen tok oss {n_days} dager. "
@@ -153,6 +97,7 @@ def main(
     date: pendulum.Date,
     progress_today: float,
     cumulative_progress: float,
+    geometry: LegGeometry,
 ) -> t.Optional[str]:
 
     switch = {
@@ -173,5 +118,6 @@ def main(
         date=date,
         progress_today=progress_today,
         cumulative_progress=cumulative_progress,
+        geometry=geometry,
     )
     return result
@@ -0,0 +1,141 @@
+from collections import Counter
+from contextlib import suppress
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+import typing as t  # noqa
+import uuid
+
+from trek import config
+
+log = logging.getLogger(__name__)
+
+
+class GeoCache:
+    """Responses of the location APIs on local disk, by position on a grid
+
+    Positions are quantised to cells of grid degrees, so nearby points share an
+    entry. An entry is a json file with the response, and for photos a file with
+    the bytes. Entries expire after their ttl, and the least recently used go
+    first when the cache grows over max_bytes. In offline mode the location
+    APIs are not called, and misses are served as no result.
+    """
+
+    def __init__(self, path: Path, grid: float, max_bytes: int, offline: bool):
+        self.path = path
+        self.grid = grid
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits: t.Counter[str] = Counter()
+        self.misses: t.Counter[str] = Counter()
+        self._n_bytes: t.Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _entry_path(self, kind: str, lat: float, lon: float) -> Path:
+        cell = f"{round(lat / self.grid)}_{round(lon / self.grid)}"
+        return self.path / kind / cell
+
+    def get(
+        self, kind: str, lat: float, lon: float
+    ) -> t.Optional[tuple[dict, t.Optional[bytes]]]:
+        entry_path = self._entry_path(kind, lat, lon)
+        try:
+            entry = json.loads(entry_path.with_suffix(".json").read_text())
+            data = (
+                entry_path.with_suffix(".bin").read_bytes()
+                if entry["has_data"]
+                else None
+            )
+        except (FileNotFoundError, json.JSONDecodeError):
+            entry = None
+        if entry is None or entry["expires_at"] < time.time():
+            with self._lock:
+                self.misses[kind] += 1
+            return None
+        # recently used entries are evicted last
+        with suppress(FileNotFoundError):
+            os.utime(entry_path.with_suffix(".json"))
+        with self._lock:
+            self.hits[kind] += 1
+        return entry["value"], data
+
+    def put(
+        self,
+        kind: str,
+        lat: float,
+        lon: float,
+        value: dict,
+        data: t.Optional[bytes],
+        ttl: float,
+    ) -> None:
+        entry_path = self._entry_path(kind, lat, lon)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        entry = {
+            "value": value,
+            "has_data": data is not None,
+            "expires_at": time.time() + ttl,
+        }
+        with self._lock:
+            n_bytes = self._size()
+            n_bytes -= self._remove(entry_path)
+            if data is not None:
+                n_bytes += self._write(entry_path.with_suffix(".bin"), data)
+            # the json file is written last, it marks the entry as complete
+            n_bytes += self._write(
+                entry_path.with_suffix(".json"), json.dumps(entry).encode()
+            )
+            self._n_bytes = n_bytes
+            if n_bytes > self.max_bytes:
+                self._evict()
+
+    @property
+    def n_bytes(self) -> int:
+        with self._lock:
+            return self._size()
+
+    def _size(self) -> int:
+        if self._n_bytes is None:
+            self._n_bytes = sum(
+                path.stat().st_size for path in self.path.rglob("*") if path.is_file()
+            )
+        return self._n_bytes
+
+    @staticmethod
+    def _write(path: Path, data: bytes) -> int:
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        return len(data)
+
+    @staticmethod
+    def _remove(entry_path: Path) -> int:
+        n_bytes = 0
+        for path in [entry_path.with_suffix(".json"), entry_path.with_suffix(".bin")]:
+            try:
+                n_bytes += path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        return n_bytes
+
+    def _evict(self) -> None:
+        assert self._n_bytes is not None
+        entries = sorted(
+            self.path.glob("*/*.json"), key=lambda path: path.stat().st_mtime
+        )
+        for entry in entries:
+            if self._n_bytes <= self.max_bytes:
+                break
+            self._n_bytes -= self._remove(entry.with_suffix(""))
+        log.info(f"Evicted geo cache entries, {self._n_bytes} bytes left")
+
+
+geo_cache = GeoCache(
+    path=config.geo_cache_path,
+    grid=config.geo_cache_grid,
+    max_bytes=config.geo_cache_max_bytes,
+    offline=config.geo_cache_offline,
+)
@@ -1,16 +1,18 @@
 import base64
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import hashlib
 import hmac
 import logging
+import threading
+import time
 import typing as t
 import urllib.parse
 
-from geopy.geocoders import Nominatim
-import googlemaps
-import httpx
 import pendulum
 
 from trek import config
+from trek.core import clients
+from trek.core.progress.geo_cache import geo_cache
 from trek.core.progress.upload import UploadFunc
 from trek.models import Id
 
@@ -29,6 +31,26 @@ class LocationApisFunc(t.Protocol):
         ...
 
 
+class RateLimiter:
+    """Spaces the calls to an API at least 1 / rate seconds apart, across threads"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_at)
+            self._next_at = start_at + self.interval
+        time.sleep(start_at - now)
+
+
+# https://operations.osmfoundation.org/policies/nominatim/
+nominatim_limit = RateLimiter(config.nominatim_rate)
+google_limit = RateLimiter(config.google_api_rate)
+
 poi_radius = 2500
 
 poi_types = {
@@ -58,18 +80,39 @@ poi_types = {
 def address_for_location(
     lat, lon
 ) -> tuple[t.Optional[str], t.Optional[str]]:  # no test coverage
-    geolocator = Nominatim(user_agent=config.app_name)
+    cached = geo_cache.get("address", lat, lon)
+    if cached is not None:
+        value, _ = cached
+        return value["address"], value["country"]
+    if geo_cache.offline:
+        return None, None
+    nominatim_limit.wait()
     try:
-        location = geolocator.reverse(f"{lat}, {lon}", language="en")
+        location = clients.nominatim().reverse(f"{lat}, {lon}", language="en")
         address = location.address
         country = location.raw.get("address", {}).get("country")
-        return address, country
     except Exception:
         log.error("Error getting address for location", exc_info=True)
         return None, None
+    geo_cache.put(
+        "address",
+        lat,
+        lon,
+        {"address": address, "country": country},
+        None,
+        ttl=config.geo_cache_address_ttl,
+    )
+    return address, country
 
 
 def street_view_for_location(lat, lon) -> t.Optional[bytes]:  # no test coverage
+    cached = geo_cache.get("street_view", lat, lon)
+    if cached is not None:
+        _, data = cached
+        return data
+    if geo_cache.offline:
+        return None
+
     def encode_url(domain, endpoint, params):
         params = params.copy()
         url_to_sign = endpoint + urllib.parse.urlencode(params)
@@ -93,23 +136,43 @@ def street_view_for_location(lat, lon) -> t.Optional[bytes]:  # no test coverage
         "key": config.google_api_key,
     }
     metadata_url = encode_url(domain, metadata_endpoint, params)
+    google_limit.wait()
     try:
-        response = httpx.get(metadata_url)
+        response = clients.httpx_client().get(metadata_url)
         metadata = response.json()
-        if metadata["status"] != "OK":
-            log.info(f"Metadata indicates no streetview image: {metadata}")
-            return None
+        status = metadata["status"]
     except Exception:
         log.error("Error downloading streetview image metadata", exc_info=True)
         return None
+    if status != "OK":
+        log.info(f"Metadata indicates no streetview image: {metadata}")
+        if status == "ZERO_RESULTS":
+            geo_cache.put(
+                "street_view",
+                lat,
+                lon,
+                {"status": status},
+                None,
+                ttl=config.geo_cache_street_view_ttl,
+            )
+        return None
 
     photo_url = encode_url(domain, img_endpoint, params)
+    google_limit.wait()
     try:
-        response = httpx.get(photo_url)
+        response = clients.httpx_client().get(photo_url)
         data = response.content
     except Exception:
         log.error("Error downloading streetview image", exc_info=True)
         return None
+    geo_cache.put(
+        "street_view",
+        lat,
+        lon,
+        {"status": status},
+        data,
+        ttl=config.geo_cache_street_view_ttl,
+    )
     return data
 
 
@@ -123,8 +186,15 @@ def map_url_for_location(lat, lon) -> str:  # no test coverage
 def poi_for_location(
     lat, lon
 ) -> tuple[t.Optional[str], t.Optional[bytes]]:  # no test coverage
+    cached = geo_cache.get("poi", lat, lon)
+    if cached is not None:
+        value, photo = cached
+        return value["name"], photo
+    if geo_cache.offline:
+        return None, None
+    google_limit.wait()
     try:
-        gmaps = googlemaps.Client(key=config.google_api_key)
+        gmaps = clients.googlemaps_client()
         places = gmaps.places_nearby(location=(lat, lon), radius=poi_radius)["results"]
     except Exception:
         log.error("Error getting location data", exc_info=True)
@@ -132,25 +202,129 @@ def poi_for_location(
     place = next(
         (p for p in places if not poi_types.isdisjoint(p.get("types", []))), None
     )
-    if not place:
-        return None, None
-    name = place["name"]
-    try:
-        photo_data = next(
-            p for p in place.get("photos", []) if p.get("width", 0) >= 1000
-        )
-        ref = photo_data["photo_reference"]
-        photo_itr = gmaps.places_photo(ref, max_width=2000)
-        photo = b"".join([chunk for chunk in photo_itr if chunk])
-    except StopIteration:
-        log.info("No poi photo big enough")
-        return name, None
-    except Exception:
-        log.error("Error getting poi photo", exc_info=True)
-        return name, None
+    name = place["name"] if place else None
+    photo = None
+    if place:
+        try:
+            photo_data = next(
+                p for p in place.get("photos", []) if p.get("width", 0) >= 1000
+            )
+            ref = photo_data["photo_reference"]
+            google_limit.wait()
+            photo_itr = gmaps.places_photo(ref, max_width=2000)
+            photo = b"".join([chunk for chunk in photo_itr if chunk])
+        except StopIteration:
+            log.info("No poi photo big enough")
+        except Exception:
+            # not cached, the photo may download next time
+            log.error("Error getting poi photo", exc_info=True)
+            return name, None
+    geo_cache.put("poi", lat, lon, {"name": name}, photo, ttl=config.geo_cache_poi_ttl)
     return name, photo
 
 
+def _probe_result(future: Future) -> t.Any:
+    if future.exception() is not None:
+        log.error("Error querying location APIs", exc_info=future.exception())
+        return None
+    return future.result()
+
+
+def _is_found(kind: str, result: t.Any) -> bool:
+    if kind == "street_view":
+        return result is not None
+    return result is not None and result[0] is not None
+
+
+def _nearest_found(
+    probes: list[dict[str, Future]], kind: str, exhausted: bool
+) -> tuple[bool, t.Any]:
+    """The result for kind at the interval nearest the terminus where it was found
+
+    Returns whether it is settled, which it is not while a nearer interval is
+    still being probed.
+    """
+    for interval_probes in probes:
+        future = interval_probes.get(kind)
+        if future is None:
+            continue
+        if not future.done():
+            return False, None
+        result = _probe_result(future)
+        if _is_found(kind, result):
+            return True, result
+    return exhausted, None
+
+
+def _probe_intervals(
+    intervals: t.Iterator[tuple[float, float]]
+) -> tuple[t.Any, t.Any, t.Any, t.Optional[tuple[float, float]]]:
+    """Query the location APIs for a window of intervals at a time
+
+    Intervals are ordered nearest to the terminus first, and each result is taken
+    from the nearest interval that has one, as if they were queried one by one.
+    Outstanding queries are cancelled once an address, a POI and a photo are found.
+    """
+    functions = {
+        "address": address_for_location,
+        "poi": poi_for_location,
+        "street_view": street_view_for_location,
+    }
+    window = config.location_probe_window
+    executor = ThreadPoolExecutor(
+        max_workers=window * len(functions), thread_name_prefix="location"
+    )
+    probes: list[dict[str, Future]] = []
+    first_point = None
+    exhausted = False
+    try:
+        while True:
+            nearest = {
+                kind: _nearest_found(probes, kind, exhausted) for kind in functions
+            }
+            (address_settled, address), (poi_settled, poi), (sw_settled, sw) = (
+                nearest["address"],
+                nearest["poi"],
+                nearest["street_view"],
+            )
+            has_photo = (poi is not None and poi[1] is not None) or sw is not None
+            if address is not None and poi is not None and has_photo:
+                break
+            if address_settled and poi_settled and sw_settled:
+                break
+            in_flight = sum(
+                not all(future.done() for future in interval_probes.values())
+                for interval_probes in probes
+            )
+            while not exhausted and in_flight < window:
+                point = next(intervals, None)
+                if point is None:
+                    exhausted = True
+                    break
+                log.info(f"Querying location APIs for {point}")
+                if first_point is None:
+                    first_point = point
+                probes.append(
+                    {
+                        kind: executor.submit(function, *point)
+                        for kind, function in functions.items()
+                        if nearest[kind][1] is None
+                    }
+                )
+                in_flight += 1
+            pending = [
+                future
+                for interval_probes in probes
+                for future in interval_probes.values()
+                if not future.done()
+            ]
+            if pending:
+                wait(pending, return_when=FIRST_COMPLETED)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return address, poi, sw, first_point
+
+
 def main(
     trek_id: Id,
     leg_id: Id,
@@ -158,32 +332,18 @@ def main(
     intervals: t.Iterator[tuple[float, float]],
     upload_func: UploadFunc,
 ) -> tuple[t.Optional[str], t.Optional[str], t.Optional[str], str, t.Optional[str]]:
-    address = None
-    country = None
-    sw_photo = None
+    address_result, poi_result, sw_photo, first_point = _probe_intervals(intervals)
+    assert first_point is not None
+    map_url = map_url_for_location(*first_point)
+    address, country = address_result or (None, None)
+    poi, poi_photo = poi_result or (None, None)
     photo_url = None
-    map_url = None
-    poi = None
-    for lat, lon in intervals:
-        log.info(f"Querying location APIs for {(lat, lon)}")
-        if address is None:
-            address, country = address_for_location(lat, lon)
-        if poi is None:
-            poi, poi_photo = poi_for_location(lat, lon)
-        if sw_photo is None:
-            sw_photo = street_view_for_location(lat, lon)
-        if map_url is None:
-            map_url = map_url_for_location(lat, lon)
-        if (
-            address is not None
-            and poi is not None
-            and (poi_photo is not None or sw_photo is not None)
-        ):
-            break
-    assert map_url is not None  # satisfy mypy
     photo = poi_photo if poi is not None else sw_photo
     if photo:
         photo_url = upload_func(photo, trek_id, leg_id, date, "photo")
     if not poi:
         log.info("No interesting point of interest")
+    log.info(
+        f"geo cache hits: {dict(geo_cache.hits)}, misses: {dict(geo_cache.misses)}"
+    )
     return address, country, photo_url, map_url, poi
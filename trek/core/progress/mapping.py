@@ -3,11 +3,14 @@ import logging
 import typing as t
 
 from PIL import Image, ImageChops, ImageDraw, ImageFont
+import numpy as np
 import pendulum
-from staticmap import CircleMarker, Line, StaticMap
+from staticmap import CircleMarker, Line
 
 from trek.core.progress import progress_utils
+from trek.core.progress.overview_layers import OverviewLayer, overview_layers
 from trek.core.progress.progress_utils import UserProgress
+from trek.core.progress.tile_cache import CachedStaticMap, Frame, tile_cache
 from trek.core.progress.upload import UploadFunc
 from trek.database import Database
 from trek.models import Id, Location
@@ -15,12 +18,6 @@ from trek.models import Id, Location
 log = logging.getLogger(__name__)
 
 
-class Point(t.TypedDict):
-    lat: float
-    lon: float
-    distance: float
-
-
 PointT = tuple[float, float]
 PointTList = list[PointT]
 
@@ -37,6 +34,7 @@ class MappingFunc(t.Protocol):
         current_distance: float,
         users_progress: list[UserProgress],
         upload_func: UploadFunc,
+        geometry: progress_utils.LegGeometry,
     ) -> t.Optional[str]:
         ...
 
@@ -49,120 +47,111 @@ class UserPoint(t.TypedDict):
 list[tuple[UserProgress, PointTList]]
 
 
+def _line_between(
+    line: tuple[np.ndarray, np.ndarray, np.ndarray], low: float, high: float
+) -> PointTList:
+    lat, lon, distance = line
+    first = int(np.searchsorted(distance, low, side="left"))
+    last = int(np.searchsorted(distance, high, side="right"))
+    return list(zip(lon[first:last].tolist(), lat[first:last].tolist()))
+
+
 def _get_day_points(
-    current_points: list[Point],
+    geometry: progress_utils.LegGeometry,
     last_location: t.Optional[Location],
     users_progress: list[UserProgress],
     start_dist: float,
+    tolerance: float,
 ) -> list[tuple[UserProgress, PointTList]]:
     day_points: list[tuple[UserProgress, PointTList]] = []
-    waypoints_itr = iter(current_points)
     # starting location
-    latest_waypoint: Point = (
-        {
-            "lat": last_location["lat"],
-            "lon": last_location["lon"],
-            "distance": last_location["distance"],
-        }
+    start: PointT = (
+        (last_location["lon"], last_location["lat"])
         if last_location is not None
-        else current_points[0]
+        else (float(geometry.lon[0]), float(geometry.lat[0]))
     )
-    current_distance = start_dist
-    next_waypoint = None
-    for user in users_progress:
-        user_points: PointTList = []
-        user_points.append((latest_waypoint["lon"], latest_waypoint["lat"]))
-        user_distance: float = user["step"]["amount"] * progress_utils.STRIDE
-        current_distance += user_distance
-        while True:
-            if next_waypoint is None or next_waypoint["distance"] < current_distance:
-                # next_waypoint from previous users has been passed
-                next_waypoint = next(waypoints_itr, None)
-                if next_waypoint is None:
-                    # leg finished, no next waypoint
-                    break
-
-            if next_waypoint["distance"] < current_distance:
-                # next_waypoint passed by this user
-                user_points.append((next_waypoint["lon"], next_waypoint["lat"]))
-                latest_waypoint = next_waypoint
-                continue
-            elif next_waypoint["distance"] >= current_distance:
-                # next_waypoint will not be passed by this user
-                remaining_dist = current_distance - latest_waypoint["distance"]
-                last_lat, last_lon = progress_utils.point_between_waypoints(
-                    latest_waypoint, next_waypoint, remaining_dist
-                )
-                user_points.append((last_lon, last_lat))
-                # assign starting location for next user
-                latest_waypoint = {
-                    "lat": last_lat,
-                    "lon": last_lon,
-                    "distance": current_distance,
-                }
-                break
+    user_distances = [
+        user["step"]["amount"] * progress_utils.STRIDE for user in users_progress
+    ]
+    # a finished leg stops at its last waypoint
+    end_distances = np.minimum(
+        start_dist + np.cumsum(user_distances), geometry.total_distance
+    )
+    end_lats, end_lons, *_ = geometry.points_at_distances(end_distances)
+    line_lat, line_lon, line_distance = geometry.line(tolerance)
+    # waypoints passed by each user lie strictly between their start and end
+    starts = np.searchsorted(
+        line_distance, np.append(start_dist, end_distances[:-1]), side="right"
+    )
+    ends = np.searchsorted(line_distance, end_distances, side="left")
+    for user, first, last, end_lat, end_lon in zip(
+        users_progress, starts, ends, end_lats.tolist(), end_lons.tolist()
+    ):
+        user_points: PointTList = [start]
+        user_points.extend(
+            zip(
+                line_lon[first:last].tolist(),
+                line_lat[first:last].tolist(),
+            )
+        )
+        user_points.append((end_lon, end_lat))
         day_points.append((user, user_points))
+        # assign starting location for next user
+        start = (end_lon, end_lat)
     return day_points
 
 
 def _traversal_data(
-    db: Database,
-    trek_id: Id,
-    leg_id: Id,
+    geometry: progress_utils.LegGeometry,
     last_location: t.Optional[Location],
     current_lat: float,
     current_lon: float,
     current_distance: float,
     users_progress: list[UserProgress],
-) -> tuple[PointTList, PointTList, PointTList, list[tuple[UserProgress, PointTList]]]:
-    old_points: PointTList
-    location_points: PointTList
-    leg_points: PointTList
-    # TODO: add older legs from same trek?
+    overview_tolerance: float,
+    detailed_tolerance: float,
+) -> tuple[PointTList, list[tuple[UserProgress, PointTList]]]:
     if last_location is None:
-        old_points = []
-        location_points = []
         start_dist = 0.0
-        leg_points = []
+        leg_points: PointTList = []
     else:
-        old_waypoints = progress_utils.waypoints_between_distances(
-            db,
-            trek_id=trek_id,
-            leg_id=leg_id,
-            low=0,
-            high=last_location["distance"],
-        )
-        old_points = [(loc["lon"], loc["lat"]) for loc in old_waypoints]
-        old_points.append((last_location["lon"], last_location["lat"]))
-        locations = progress_utils.locations_between_distances(
-            db,
-            trek_id=trek_id,
-            leg_id=leg_id,
-            low=0,
-            high=last_location["distance"],
-        )
-        location_points = [(old_waypoints[0]["lon"], old_waypoints[0]["lat"])]
-        location_points.extend([(loc["lon"], loc["lat"]) for loc in locations])
         start_dist = last_location["distance"]
         leg_points = [(last_location["lon"], last_location["lat"])]
 
-    current_waypoints = progress_utils.waypoints_between_distances(
-        db, trek_id=trek_id, leg_id=leg_id, low=start_dist, high=current_distance
-    )
-    current_points: list[Point] = [
-        {"lat": point["lat"], "lon": point["lon"], "distance": point["distance"]}
-        for point in current_waypoints
-    ]
-    current_points.append(
-        {"lat": current_lat, "lon": current_lon, "distance": current_distance}
+    leg_points.extend(
+        _line_between(geometry.line(overview_tolerance), start_dist, current_distance)
     )
-    leg_points.extend([(loc["lon"], loc["lat"]) for loc in current_waypoints])
     leg_points.append((current_lon, current_lat))
 
     day_points = _get_day_points(
-        current_points, last_location, users_progress, start_dist
+        geometry, last_location, users_progress, start_dist, detailed_tolerance
+    )
+    return leg_points, day_points
+
+
+def _history_data(
+    db: Database,
+    geometry: progress_utils.LegGeometry,
+    trek_id: Id,
+    leg_id: Id,
+    last_location: t.Optional[Location],
+    tolerance: float,
+) -> tuple[PointTList, PointTList]:
+    # TODO: add older legs from same trek?
+    if last_location is None:
+        return [], []
+    old_points = _line_between(geometry.line(tolerance), 0, last_location["distance"])
+    old_points.append((last_location["lon"], last_location["lat"]))
+    locations = progress_utils.locations_between_distances(
+        db,
+        trek_id=trek_id,
+        leg_id=leg_id,
+        low=0,
+        high=last_location["distance"],
     )
-    return old_points, location_points, leg_points, day_points
+    location_points = [(float(geometry.lon[0]), float(geometry.lat[0]))]
+    location_points.extend([(loc["lon"], loc["lat"]) for loc in locations])
+    return old_points, location_points
 
 
 def _map_legend(user_points: list[tuple[UserProgress, PointTList]]) -> Image.Image:
@@ -190,12 +179,14 @@ def _map_legend(user_points: list[tuple[UserProgress, PointTList]]) -> Image.Ima
     return trimmed
 
 
-def _render_map(map_: StaticMap) -> t.Optional[Image.Image]:  # no test coverage
+def _render_map(
+    map_: CachedStaticMap, frame: Frame, base: t.Optional[Image.Image] = None
+) -> t.Optional[Image.Image]:  # no test coverage
     try:
-        img = map_.render()
+        img = map_.render_on(frame, base)
     except Exception:
         try:
-            img = map_.render()
+            img = map_.render_on(frame, base)
         except Exception:
             log.error("Error rendering map", exc_info=True)
             img = None
@@ -243,31 +234,31 @@ def main(
     current_distance: float,
     users_progress: list[UserProgress],
     upload_func: UploadFunc,
+    geometry: progress_utils.LegGeometry,
 ) -> t.Optional[str]:
+    height = 600
+    width = 1000
     current_lat, current_lon = current_location
-    old_points, location_points, leg_points, day_points = _traversal_data(
-        db,
-        trek_id,
-        leg_id,
+    start_dist = last_location["distance"] if last_location is not None else 0.0
+    # lines are simplified to what the maps can show
+    overview_tolerance = geometry.fit_tolerance(0, current_distance, width, height)
+    leg_points, day_points = _traversal_data(
+        geometry,
         last_location,
         current_lat,
         current_lon,
         current_distance,
         users_progress,
+        overview_tolerance,
+        geometry.fit_tolerance(start_dist, current_distance, width, height),
     )
 
-    template = "https://a.basemaps.cartocdn.com/rastertiles/voyager/{z}/{x}/{y}.png"
-    height = 600
-    width = 1000
-    overview_map = StaticMap(width=width, height=height, url_template=template)
-    if old_points:
-        overview_map.add_line(Line(old_points, "grey", 2))
-    for lon, lat in location_points:
-        overview_map.add_marker(CircleMarker((lon, lat), "blue", 6))
+    # the day's segment, drawn on the leg's history
+    overview_map = CachedStaticMap(width=width, height=height, cache=tile_cache)
     overview_map.add_line(Line(leg_points, "red", 2))
     overview_map.add_marker(CircleMarker((current_lon, current_lat), "red", 6))
 
-    detailed_map = StaticMap(width=width, height=height, url_template=template)
+    detailed_map = CachedStaticMap(width=width, height=height, cache=tile_cache)
     start = day_points[0][1][0]
     detailed_map.add_marker(CircleMarker(start, "black", 6))
     detailed_map.add_marker(CircleMarker(start, "grey", 4))
@@ -277,10 +268,56 @@ def main(
         detailed_map.add_line(Line(points, color, 2))
         detailed_map.add_marker(CircleMarker(points[-1], "black", 6))
         detailed_map.add_marker(CircleMarker(points[-1], color, 4))
+    detailed_frame = detailed_map.frame()
+
+    # yesterday's layer is reused while the map keeps its bounding box and zoom
+    layer = overview_layers.get(trek_id, leg_id)
+    if (
+        last_location is not None
+        and layer is not None
+        and layer.distance == last_location["distance"]
+        and overview_map.fits(layer.frame)
+    ):
+        overview_frame = layer.frame
+        tile_cache.prefetch(detailed_map.tiles(detailed_frame))
+        history_img: t.Optional[Image.Image] = layer.image
+    else:
+        old_points, location_points = _history_data(
+            db, geometry, trek_id, leg_id, last_location, overview_tolerance
+        )
+        history_map = CachedStaticMap(width=width, height=height, cache=tile_cache)
+        if old_points:
+            history_map.add_line(Line(old_points, "grey", 2))
+        for lon, lat in location_points:
+            history_map.add_marker(CircleMarker((lon, lat), "blue", 6))
+        full_map = CachedStaticMap(width=width, height=height, cache=tile_cache)
+        full_map.lines = history_map.lines + overview_map.lines
+        full_map.markers = history_map.markers + overview_map.markers
+        overview_frame = full_map.frame()
+        # both maps' tiles in one pass, rendering and its retry then read from disk
+        tile_cache.prefetch(
+            [*full_map.tiles(overview_frame), *detailed_map.tiles(detailed_frame)]
+        )
+        history_img = _render_map(history_map, overview_frame)
+
+    overview_img = None
+    if history_img is not None:
+        overview_img = _render_map(overview_map, overview_frame, history_img)
+        # the next day's history has the segment grey, its ends as locations
+        segment_map = CachedStaticMap(width=width, height=height, cache=tile_cache)
+        segment_map.add_line(Line(leg_points, "grey", 2))
+        for lon, lat in [leg_points[0], leg_points[-1]]:
+            segment_map.add_marker(CircleMarker((lon, lat), "blue", 6))
+        next_history_img = _render_map(segment_map, overview_frame, history_img)
+        if next_history_img is not None:
+            overview_layers.put(
+                trek_id,
+                leg_id,
+                OverviewLayer(current_distance, overview_frame, next_history_img),
+            )
     legend = _map_legend(day_points)
 
-    overview_img = _render_map(overview_map)
-    detailed_img = _render_map(detailed_map)
+    detailed_img = _render_map(detailed_map, detailed_frame)
     img = _merge_maps(overview_img, detailed_img, legend)
     if img is None:
         return None
@@ -0,0 +1,65 @@
+from dataclasses import dataclass
+import json
+import os
+from pathlib import Path
+import typing as t  # noqa
+import uuid
+
+from PIL import Image
+
+from trek import config
+from trek.core.progress.tile_cache import Frame
+from trek.models import Id
+
+
+@dataclass(frozen=True)
+class OverviewLayer:
+    """The overview map of a leg traversed up to distance, as history"""
+
+    distance: float
+    frame: Frame
+    image: Image.Image
+
+
+class OverviewLayers:
+    """The latest overview layer of each leg on local disk
+
+    A layer is the map tiles with the traversed part of the leg and its
+    locations drawn on, so the next day only has to draw its own segment on top.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def _layer_path(self, trek_id: Id, leg_id: Id) -> Path:
+        return self.path / trek_id / leg_id
+
+    def get(self, trek_id: Id, leg_id: Id) -> t.Optional[OverviewLayer]:
+        layer_path = self._layer_path(trek_id, leg_id)
+        try:
+            meta = json.loads(layer_path.with_suffix(".json").read_text())
+            with Image.open(layer_path.with_suffix(".png")) as image:
+                image.load()
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        zoom, x_center, y_center = meta["frame"]
+        return OverviewLayer(
+            distance=meta["distance"], frame=(zoom, x_center, y_center), image=image
+        )
+
+    def put(self, trek_id: Id, leg_id: Id, layer: OverviewLayer) -> None:
+        layer_path = self._layer_path(trek_id, leg_id)
+        layer_path.parent.mkdir(parents=True, exist_ok=True)
+        # the json file is removed first and written last, it marks the layer as
+        # complete
+        json_path = layer_path.with_suffix(".json")
+        json_path.unlink(missing_ok=True)
+        tmp_path = layer_path.with_name(f"{layer_path.name}.{uuid.uuid4().hex}.tmp")
+        layer.image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, layer_path.with_suffix(".png"))
+        meta = {"distance": layer.distance, "frame": layer.frame}
+        tmp_path.write_text(json.dumps(meta))
+        os.replace(tmp_path, json_path)
+
+
+overview_layers = OverviewLayers(path=config.overview_layers_path)
@@ -1,11 +1,17 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
 import json
 import logging
+import math
+import threading
+import time
 import typing as t
 
 import pendulum
 import pyarrow as pa
 import pyarrow.compute as pc
 
+from trek import config
 from trek.core.core_utils import get_next_leg_adder
 from trek.core.output.output import outputters
 from trek.core.output.output_utils import Outputter
@@ -15,13 +21,14 @@ from trek.core.progress import (
     location_apis,
     mapping,
     progress_utils,
+    stats,
 )
 from trek.core.progress.location_apis import LocationApisFunc
 from trek.core.progress.mapping import MappingFunc
 from trek.core.progress.progress_utils import UserProgress
 from trek.core.progress.upload import UploadFunc, make_upload_f
-from trek.core.trackers import trackers
-from trek.database import Database, achievement_schema, step_schema
+from trek.core.trackers import tracker_utils, trackers
+from trek.database import CommitConflictError, Database, leg_schema
 from trek.models import (
     Achievement,
     Id,
@@ -32,11 +39,13 @@ from trek.models import (
     TrekUser,
     User,
     UserToken,
-    Waypoint,
 )
 
 log = logging.getLogger(__name__)
 
+# a message about a trek, posted once the changes it reports are committed
+Post = t.Callable[[Database], None]
+
 
 def _get_treks_to_update(
     db: Database, now: pendulum.DateTime
@@ -91,9 +100,7 @@ def _get_treks_to_update(
 
 
 def _users_in_trek(db: Database, trek_id: Id) -> list[TrekUser]:
-    trek_users = db.load_records(
-        TrekUser, filter=pc.field("trek_id") == pc.scalar(trek_id)
-    )
+    trek_users = db.load_records(TrekUser, where={"trek_id": trek_id})
     return trek_users
 
 
@@ -108,8 +115,7 @@ def _get_steps_for_single_user(
     try:
         token_record = db.load_records(
             UserToken,
-            filter=(pc.field("user_id") == pc.scalar(user_record["id"]))
-            & (pc.field("tracker_name") == pc.scalar(active_tracker)),
+            where={"user_id": user_record["id"], "tracker_name": active_tracker},
         )[0]
     except IndexError:
         log.info("could not find token for user")
@@ -127,6 +133,72 @@ def _get_steps_for_single_user(
     return steps
 
 
+def _get_steps_for_users(
+    db: Database,
+    users: list[User],
+    date: pendulum.Date,
+    step_cache: tracker_utils.StepCache,
+) -> dict[Id, int]:
+    """Fetch the steps of all users in parallel, within config.tracker_deadline.
+
+    Trackers write refreshed tokens and caches to the session from the worker
+    threads; those calls are funnelled back to this thread by a SingleWriter.
+    Users whose fetch fails or does not finish in time get 0 steps. Steps already
+    fetched for another trek are taken from step_cache.
+    """
+    writer = tracker_utils.SingleWriter(db)
+    session = t.cast(Database, writer)
+    limits = {
+        name: threading.BoundedSemaphore(config.tracker_concurrency)
+        for name in trackers.name_to_service
+    }
+
+    def fetch(user_record: User) -> int:
+        active_tracker = user_record["active_tracker"]
+        if active_tracker is None:
+            return _get_steps_for_single_user(session, user_record, date)
+        limit = limits[active_tracker]
+
+        def fetch_uncached() -> int:
+            with limit:
+                return _get_steps_for_single_user(session, user_record, date)
+
+        key = (user_record["id"], active_tracker, date)
+        return step_cache.get(key, fetch_uncached)
+
+    deadline = time.monotonic() + config.tracker_deadline
+    executor = ThreadPoolExecutor(
+        max_workers=config.tracker_workers, thread_name_prefix="tracker"
+    )
+    futures = {executor.submit(fetch, user): user["id"] for user in users}
+    for future in futures:
+        future.add_done_callback(writer.wake)
+    try:
+        while not all(future.done() for future in futures):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            writer.serve(timeout=remaining)
+    finally:
+        writer.close()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    steps: dict[Id, int] = {}
+    for future, user_id in futures.items():
+        if not future.done():
+            log.info(f"Fetching steps for user {user_id} timed out")
+            steps[user_id] = 0
+        elif future.exception() is not None:
+            log.info(
+                f"Fetching steps for user {user_id} failed",
+                exc_info=future.exception(),
+            )
+            steps[user_id] = 0
+        else:
+            steps[user_id] = future.result()
+    return steps
+
+
 def _get_users_progress(
     db: Database,
     trek_id: Id,
@@ -134,21 +206,24 @@ def _get_users_progress(
     date: pendulum.Date,
     users: list[User],
     trek_users: list[TrekUser],
+    step_cache: tracker_utils.StepCache,
 ) -> list[UserProgress]:
     user_id_to_user_record = {user["id"]: user for user in users}
+    steps = _get_steps_for_users(
+        db,
+        [user_id_to_user_record[user["user_id"]] for user in trek_users],
+        date,
+        step_cache,
+    )
     users_progress: list[UserProgress] = []
     for trek_user in trek_users:
         user_id = trek_user["user_id"]
-        # first from db
-        # second from apis
-        amount = _get_steps_for_single_user(db, user_id_to_user_record[user_id], date)
-
         step_record: Step = {
             "trek_id": trek_id,
             "leg_id": leg_id,
             "user_id": user_id,
             "taken_at": date,
-            "amount": amount,
+            "amount": steps[user_id],
         }
         user_record = user_id_to_user_record[user_id]
         user_progress: UserProgress = {
@@ -165,10 +240,8 @@ def _get_users_progress(
 
 def _save_users_progress(db: Database, users_progress: list[UserProgress]) -> None:
     new_step_records: list[Step] = [user["step"] for user in users_progress]
-    steps_table = db.load_table(Step)
-    record_table = pa.Table.from_pylist(new_step_records, schema=step_schema)
-    merged_table = pa.concat_tables([steps_table, record_table])
-    db.save_table(Step, merged_table)
+    db.append_records(Step, new_step_records)
+    stats.add_steps(db, new_step_records)
 
 
 def _most_recent_location(
@@ -176,11 +249,7 @@ def _most_recent_location(
 ) -> t.Optional[Location]:
     try:
         return (
-            db.load_table(
-                Location,
-                filter=(pc.field("trek_id") == pc.scalar(trek_id))
-                & (pc.field("leg_id") == pc.scalar(leg_id)),
-            )
+            db.load_table(Location, where={"trek_id": trek_id, "leg_id": leg_id})
             .sort_by([("added_at", "descending")])
             .to_pylist()[0]
         )
@@ -188,57 +257,18 @@ def _most_recent_location(
         return None
 
 
-def _load_waypoints_table(db: Database, trek_id: Id, leg_id: Id) -> pa.Table:
-    return db.load_table(
-        Waypoint,
-        filter=(
-            (pc.field("trek_id") == pc.scalar(trek_id))
-            & (pc.field("leg_id") == pc.scalar(leg_id))
-        ),
-        columns=["lat", "lon", "distance", "id"],
-    ).sort_by("distance")
-
-
-def _point_at_distance(
-    waypoints: pa.Table, distance: float
-) -> tuple[tuple[float, float], Waypoint, bool]:
-    has_passed_waypoint = pc.less_equal(waypoints.column("distance"), distance)
-
-    passed_waypoints = waypoints.filter(has_passed_waypoint)
-    log.info(f"{distance=}, {waypoints.num_rows=}, {passed_waypoints.num_rows=}")
-    latest_waypoint = passed_waypoints.slice(
-        offset=passed_waypoints.num_rows - 1, length=1
-    ).to_pylist()[0]
-
-    future_waypoints = waypoints.filter(pc.invert(has_passed_waypoint))
-
-    try:
-        next_waypoint = future_waypoints.slice(length=1).to_pylist()[0]
-    except IndexError:
-        finished = True
-        current_lat = latest_waypoint["lat"]
-        current_lon = latest_waypoint["lon"]
-    else:
-        finished = False
-        remaining_dist = distance - latest_waypoint["distance"]
-        current_lat, current_lon = progress_utils.point_between_waypoints(
-            latest_waypoint, next_waypoint, remaining_dist
-        )
-
-    return (current_lat, current_lon), latest_waypoint, finished
-
-
 def _get_days_distance_intervals(
-    waypoints_table: pa.Table, from_distance: float, to_distance: float
+    geometry: progress_utils.LegGeometry, from_distance: float, to_distance: float
 ) -> t.Iterator[tuple[float, float]]:
     incr_length = location_apis.poi_radius * 2
-    for intermediate_distance in range(
+    distances = range(
         int(to_distance),
         int(min(from_distance + incr_length, from_distance)),
         -incr_length,
-    ):
-        inter_lat_lon, *_ = _point_at_distance(waypoints_table, intermediate_distance)
-        yield inter_lat_lon
+    )
+    lats, lons, *_ = geometry.points_at_distances(distances)
+    for lat, lon in zip(lats.tolist(), lons.tolist()):
+        yield lat, lon
 
 
 def _execute_daily_progression(
@@ -263,17 +293,17 @@ def _execute_daily_progression(
         return None
     progress_before_today = last_location["distance"] if last_location else 0
 
-    waypoints_table = _load_waypoints_table(db, trek_id=trek_id, leg_id=leg_id)
+    geometry = progress_utils.LegGeometry.load(db, trek_id=trek_id, leg_id=leg_id)
     progress_today = steps_today * progress_utils.STRIDE
     cumulative_progress = progress_today + progress_before_today
-    days_terminus, latest_waypoint, is_finished = _point_at_distance(
-        waypoints_table, cumulative_progress
+    days_terminus, latest_waypoint, is_finished = geometry.point_at_distance(
+        cumulative_progress
     )
     if is_finished:
         # make sure we do not over-shoot
         cumulative_progress = latest_waypoint["distance"]
     days_intervals = _get_days_distance_intervals(
-        waypoints_table,
+        geometry,
         from_distance=progress_before_today,
         to_distance=cumulative_progress,
     )
@@ -298,10 +328,13 @@ def _execute_daily_progression(
         current_distance=cumulative_progress,
         users_progress=users_progress,
         upload_func=upload_func,
+        geometry=geometry,
     )
 
     factoid = (
-        factoids.main(db, trek_id, leg_id, date, progress_today, cumulative_progress)
+        factoids.main(
+            db, trek_id, leg_id, date, progress_today, cumulative_progress, geometry
+        )
         if not is_finished
         else factoids.leg_summary(db, trek_id, leg_id)
     )
@@ -329,13 +362,11 @@ def _execute_daily_progression(
 
 def _save_location_data(db: Database, record: Location):
     db.append_record(Location, record)
+    stats.add_location(db, record)
 
 
 def _save_achievements_data(db: Database, achievements: list[Achievement]):
-    table = db.load_table(Achievement)
-    record_table = pa.Table.from_pylist(achievements, schema=achievement_schema)
-    merged_table = pa.concat_tables([table, record_table]).combine_chunks()
-    db.save_table(Achievement, merged_table)
+    db.append_records(Achievement, achievements)
 
 
 def execute_one(
@@ -345,7 +376,8 @@ def execute_one(
     date: pendulum.Date,
     upload_func: UploadFunc,
     outputter: t.Optional[Outputter],
-) -> None:
+    step_cache: tracker_utils.StepCache,
+) -> t.Optional[Post]:
     log.info(f"Executing update for {trek['id']} on {date}")
     trek_id = trek["id"]
     leg_id = leg["id"]
@@ -354,7 +386,7 @@ def execute_one(
     user_records = db.load_records(User, filter=pc.field("id").isin(trek_user_ids))
     log.info(user_records)
     users_progress = _get_users_progress(
-        db, trek_id, leg_id, date, user_records, trek_users
+        db, trek_id, leg_id, date, user_records, trek_users, step_cache
     )
     log.info(users_progress)
     _save_users_progress(db, users_progress)
@@ -369,10 +401,14 @@ def execute_one(
         mapping_func=mapping.main,
     )
     if location is None:
-        return
+        return None
     _save_location_data(db, location)
     new_achievements = achievements.main(
-        db=db, trek_id=trek_id, leg_id=leg_id, date=date
+        db=db,
+        trek_id=trek_id,
+        leg_id=leg_id,
+        date=date,
+        steps=[user["step"] for user in users_progress],
     )
     if new_achievements:
         log.info(new_achievements)
@@ -380,30 +416,127 @@ def execute_one(
     next_adder = None
     if location["is_last_in_leg"]:
         leg["is_finished"] = True
-        db.upsert_record(Leg, leg, pc.field("id") == pc.scalar(leg["id"]))
+        db.upsert_records(
+            Leg, pa.Table.from_pylist([leg], schema=leg_schema), key_columns=["id"]
+        )
         next_adder_id = get_next_leg_adder(leg["added_by"], trek_users)
         next_adder = next(user for user in user_records if user["id"] == next_adder_id)
-    if outputter is not None:
-        outputter.post_update(
-            db, trek, users_progress, location, new_achievements, next_adder
-        )
+    if outputter is None:
+        return None
+    return partial(
+        outputter.post_update,
+        trek=trek,
+        users_progress=users_progress,
+        location=location,
+        achievements=new_achievements,
+        next_adder=next_adder,
+    )
+
+
+def _update_trek(
+    db: Database,
+    trek: Trek,
+    leg: Leg,
+    date: pendulum.Date,
+    upload_func: UploadFunc,
+    step_cache: tracker_utils.StepCache,
+) -> t.Optional[Post]:
+    output_to = trek["output_to"]
+    outputter = outputters[output_to] if output_to is not None else None
+    if not leg["is_finished"]:
+        return execute_one(db, trek, leg, date, upload_func, outputter, step_cache)
+    if outputter is None:
+        return None
+    trek_users = _users_in_trek(db, trek["id"])
+    next_adder_id = get_next_leg_adder(leg["added_by"], trek_users)
+    next_adder = db.load_records(User, where={"id": next_adder_id})[0]
+    return partial(outputter.post_leg_reminder, trek=trek, next_adder=next_adder)
+
+
+def _unless_abandoned(
+    upload_func: UploadFunc, abandoned: threading.Event
+) -> UploadFunc:
+    def upload(
+        data: bytes, trek_id: Id, leg_id: Id, date: pendulum.Date, name: str
+    ) -> t.Optional[str]:
+        if abandoned.is_set():
+            log.info(f"Not uploading {name} image of abandoned trek {trek_id}")
+            return None
+        return upload_func(data, trek_id, leg_id, date, name)
+
+    return upload
 
 
 def run():
+    """Update the treks due this hour in parallel, each in a session of its own
+
+    The sessions are merged into one commit when all treks have finished, or when
+    config.trek_deadline has passed. The changes of a trek that failed or did not
+    finish in time are left out, and a trek still running uploads nothing more.
+    Updates are posted only once the commit has succeeded.
+    """
     upload_func = make_upload_f()
-    with Database.get_db_mgr() as db:
-        now = pendulum.now("utc")
-        to_update = _get_treks_to_update(db, now)
-        yesterday = now.date().subtract(days=1)
-        for trek, leg in to_update:
-            output_to = trek["output_to"]
-            outputter = outputters[output_to] if output_to is not None else None
-            if not leg["is_finished"]:
-                execute_one(db, trek, leg, yesterday, upload_func, outputter)
-            elif outputter is not None:
-                trek_users = _users_in_trek(db, trek["id"])
-                next_adder_id = get_next_leg_adder(leg["added_by"], trek_users)
-                next_adder = db.load_records(
-                    User, filter=pc.field("id") == pc.scalar(next_adder_id)
-                )[0]
-                outputter.post_leg_reminder(db, trek, next_adder)
+    # users in several treks have their steps fetched once per run
+    step_cache = tracker_utils.StepCache(ttl=math.inf)
+    stages: list[Database] = []
+    posts: list[tuple[Id, Post]] = []
+    try:
+        # appends from the treks are written together where possible
+        with Database.get_db_mgr() as db, db.batch():
+            now = pendulum.now("utc")
+            yesterday = now.date().subtract(days=1)
+            executor = ThreadPoolExecutor(
+                max_workers=config.trek_workers, thread_name_prefix="trek"
+            )
+            futures: dict[Future, tuple[Id, Database, threading.Event]] = {}
+            for trek, leg in _get_treks_to_update(db, now):
+                stage = db.stage()
+                stages.append(stage)
+                abandoned = threading.Event()
+                future = executor.submit(
+                    _update_trek,
+                    stage,
+                    trek,
+                    leg,
+                    yesterday,
+                    _unless_abandoned(upload_func, abandoned),
+                    step_cache,
+                )
+                futures[future] = (trek["id"], stage, abandoned)
+            try:
+                wait(futures, timeout=config.trek_deadline)
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+            for future, (trek_id, stage, abandoned) in futures.items():
+                if not future.done():
+                    abandoned.set()
+                    log.error(f"Update of trek {trek_id} timed out")
+                elif future.exception() is not None:
+                    log.error(
+                        f"Update of trek {trek_id} failed",
+                        exc_info=future.exception(),
+                    )
+                else:
+                    try:
+                        db.merge(stage)
+                    except CommitConflictError:
+                        log.error(
+                            f"Changes of trek {trek_id} conflict with other treks",
+                            exc_info=True,
+                        )
+                        continue
+                    post = future.result()
+                    if post is not None:
+                        posts.append((trek_id, post))
+    finally:
+        # staged sessions may refer to files of their version until committed
+        for stage in stages:
+            stage.close()
+    if not posts:
+        return
+    with Database.get_read_db_mgr() as db:
+        for trek_id, post in posts:
+            try:
+                post(db)
+            except Exception:
+                log.error(f"Posting update of trek {trek_id} failed", exc_info=True)
@@ -1,8 +1,14 @@
+import dataclasses
+from dataclasses import dataclass
 import typing as t
 
-import gpxpy
+from gpxpy.geo import ONE_DEGREE
+import numpy as np
+import numpy.typing as npt
+import pyarrow as pa
 import pyarrow.compute as pc
 
+from trek.core import geometry
 from trek.database import Database
 from trek.models import Id, Location, Step, TrekUser, User, Waypoint
 
@@ -27,43 +33,125 @@ def round_meters(n: float) -> str:
     return f"{n} {unit}"
 
 
-def point_between_waypoints(
-    first_waypoint, last_waypoint, distance: float
-) -> tuple[float, float]:
-    angle = gpxpy.geo.get_course(
-        first_waypoint["lat"],
-        first_waypoint["lon"],
-        last_waypoint["lat"],
-        last_waypoint["lon"],
-    )
-    delta = gpxpy.geo.LocationDelta(distance=distance, angle=angle)
-    first_waypoint_obj = gpxpy.geo.Location(
-        first_waypoint["lat"], first_waypoint["lon"]
-    )
-    current_lat, current_lon = delta.move(first_waypoint_obj)
-    return round(current_lat, 7), round(current_lon, 7)
+@dataclass(frozen=True)
+class LegGeometry:
+    """The waypoints of one leg as arrays sorted by distance.
 
+    Built once per leg, and shared by progress, mapping and factoids so that
+    points along the leg are found by binary search rather than by filtering
+    the waypoints table.
+    """
 
-def waypoints_between_distances(
-    db: Database,
-    trek_id: Id,
-    leg_id: Id,
-    low: float,
-    high: float,
-) -> list[Waypoint]:
-    return (
-        db.load_table(
+    ids: np.ndarray
+    lat: np.ndarray
+    lon: np.ndarray
+    distance: np.ndarray
+    # movement in degrees per meter along the rhumb line from each waypoint
+    # towards the next, matching gpxpy's course and move_by_angle_and_distance
+    lat_per_meter: np.ndarray
+    lon_per_meter: np.ndarray
+    # the stored simplifications of the leg line, finest first
+    levels: tuple[geometry.SimplifiedLine, ...] = ()
+
+    @classmethod
+    def from_table(cls, table: pa.Table) -> "LegGeometry":
+        table = table.sort_by("distance")
+        lat = table.column("lat").to_numpy()
+        lon = table.column("lon").to_numpy()
+        lat_rad = np.radians(lat)
+        d_lon = np.radians(np.diff(lon))
+        d_lon = np.where(d_lon > np.pi, d_lon - 2 * np.pi, d_lon)
+        d_lon = np.where(d_lon < -np.pi, d_lon + 2 * np.pi, d_lon)
+        d_phi = np.log(
+            np.tan(np.pi / 4 + lat_rad[1:] / 2) / np.tan(np.pi / 4 + lat_rad[:-1] / 2)
+        )
+        course = np.arctan2(d_lon, d_phi)
+        # the last waypoint has no next waypoint to move towards
+        lat_per_meter = np.append(np.cos(course) / ONE_DEGREE, 0.0)
+        lon_per_meter = np.append(
+            np.sin(course) / ONE_DEGREE / np.cos(lat_rad[:-1]), 0.0
+        )
+        return cls(
+            ids=np.array(table.column("id").to_pylist(), dtype=object),
+            lat=lat,
+            lon=lon,
+            distance=table.column("distance").to_numpy(),
+            lat_per_meter=lat_per_meter,
+            lon_per_meter=lon_per_meter,
+        )
+
+    @classmethod
+    def load(cls, db: Database, trek_id: Id, leg_id: Id) -> "LegGeometry":
+        table = db.load_table(
             Waypoint,
             filter=(
                 (pc.field("trek_id") == pc.scalar(trek_id))
                 & (pc.field("leg_id") == pc.scalar(leg_id))
-                & (pc.field("distance") >= pc.scalar(low))
-                & (pc.field("distance") <= pc.scalar(high))
             ),
+            columns=["lat", "lon", "distance", "id"],
         )
-        .sort_by("distance")
-        .to_pylist()
-    )
+        levels = tuple(geometry.load_levels(db, trek_id, leg_id))
+        return dataclasses.replace(cls.from_table(table), levels=levels)
+
+    @property
+    def total_distance(self) -> float:
+        return float(self.distance[-1])
+
+    def waypoint(self, index: int) -> Waypoint:
+        waypoint: t.Any = {
+            "id": self.ids[index],
+            "lat": float(self.lat[index]),
+            "lon": float(self.lon[index]),
+            "distance": float(self.distance[index]),
+        }
+        return waypoint
+
+    def points_at_distances(
+        self, distances: npt.ArrayLike
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Find the points at many distances along the leg at once.
+
+        Returns the latitudes, longitudes, the index of the latest waypoint
+        passed and whether the end of the leg has been reached, per distance.
+        """
+        values = np.asarray(distances, dtype=np.float64)
+        latest = np.searchsorted(self.distance, values, side="right") - 1
+        latest = np.clip(latest, 0, len(self.distance) - 1)
+        finished = latest == len(self.distance) - 1
+        remaining = np.where(finished, 0.0, values - self.distance[latest])
+        lat = np.round(self.lat[latest] + remaining * self.lat_per_meter[latest], 7)
+        lon = np.round(self.lon[latest] + remaining * self.lon_per_meter[latest], 7)
+        return lat, lon, latest, finished
+
+    def point_at_distance(
+        self, distance: float
+    ) -> tuple[tuple[float, float], Waypoint, bool]:
+        lat, lon, latest, finished = self.points_at_distances([distance])
+        return (
+            (float(lat[0]), float(lon[0])),
+            self.waypoint(int(latest[0])),
+            bool(finished[0]),
+        )
+
+    def waypoints_between(self, low: float, high: float) -> list[Waypoint]:
+        first = np.searchsorted(self.distance, low, side="left")
+        last = np.searchsorted(self.distance, high, side="right")
+        return [self.waypoint(i) for i in range(first, last)]
+
+    def fit_tolerance(self, low: float, high: float, width: int, height: int) -> float:
+        """Meters per pixel of a map that fits the leg between low and high"""
+        first = int(np.searchsorted(self.distance, low, side="left"))
+        last = int(np.searchsorted(self.distance, high, side="right"))
+        return geometry.fit_tolerance(
+            self.lat[first:last], self.lon[first:last], width, height
+        )
+
+    def line(self, tolerance: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Latitudes, longitudes and distances of the leg line within tolerance"""
+        level = geometry.pick_level(self.levels, tolerance)
+        if level is None:
+            return self.lat, self.lon, self.distance
+        return level.lat, level.lon, level.distance
 
 
 def locations_between_distances(
@@ -73,16 +161,12 @@ def locations_between_distances(
     low: float,
     high: float,
 ) -> list[Location]:
-    return (
-        db.load_table(
-            Location,
-            filter=(
-                (pc.field("trek_id") == pc.scalar(trek_id))
-                & (pc.field("leg_id") == pc.scalar(leg_id))
-                & (pc.field("distance") >= pc.scalar(low))
-                & (pc.field("distance") <= pc.scalar(high))
-            ),
-        )
-        .sort_by("added_at")
-        .to_pylist()
+    # locations are stored sorted by added_at, and appended in that order
+    return db.load_records(
+        Location,
+        filter=(
+            (pc.field("distance") >= pc.scalar(low))
+            & (pc.field("distance") <= pc.scalar(high))
+        ),
+        where={"trek_id": trek_id, "leg_id": leg_id},
     )
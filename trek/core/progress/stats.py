@@ -0,0 +1,210 @@
+"""Running totals of a trek and of its legs, for the factoids
+
+Stats are updated as a day's steps and location are saved, so the factoids
+read one row instead of scanning the steps and locations. Stats that are
+missing, or that already contain the day, are rebuilt from the history.
+"""
+import logging
+import typing as t
+
+import numpy as np
+import pendulum
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from trek.database import Database, trek_stats_schema
+from trek.models import Id, Location, Step, TrekStats
+
+log = logging.getLogger(__name__)
+
+STATS_KEY: t.Final = ["trek_id", "scope"]
+# the recent days are the week up to and including the last day
+N_RECENT_DAYS: t.Final = 7
+
+
+def _recent_amounts(stats: TrekStats) -> np.ndarray:
+    return np.array(stats["recent_amounts"], dtype=np.int64).reshape(
+        len(stats["recent_days"]), len(stats["user_ids"])
+    )
+
+
+def _from_history(
+    db: Database,
+    trek_id: Id,
+    scope: Id,
+    before: t.Optional[pendulum.Date] = None,
+) -> TrekStats:
+    """The stats of the days before before, of all days if None"""
+    where = (
+        {"trek_id": trek_id}
+        if scope == trek_id
+        else {"trek_id": trek_id, "leg_id": scope}
+    )
+    steps = db.load_table(
+        Step,
+        filter=pc.field("taken_at") < pc.scalar(before) if before else None,
+        columns=["user_id", "taken_at", "amount"],
+        where=where,
+    )
+    locations = db.load_table(
+        Location,
+        filter=pc.field("added_at") < pc.scalar(before) if before else None,
+        columns=["added_at"],
+        where=where,
+    )
+    user_ids = pc.unique(steps.column("user_id"))
+    totals = steps.group_by("user_id").aggregate([("amount", "sum")])
+    total_index = pc.index_in(totals.column("user_id"), value_set=user_ids).to_numpy()
+    step_totals = np.zeros(len(user_ids), dtype=np.int64)
+    step_totals[total_index] = totals.column("amount_sum").to_numpy()
+
+    taken_at = pc.max(steps.column("taken_at")).as_py()
+    stats: TrekStats = {
+        "trek_id": trek_id,
+        "scope": scope,
+        "taken_at": taken_at,
+        "n_days": locations.num_rows,
+        "located_at": pc.max(locations.column("added_at")).as_py(),
+        "user_ids": user_ids.to_pylist(),
+        "step_totals": step_totals.tolist(),
+        "recent_days": [],
+        "recent_amounts": [],
+    }
+    if taken_at is None:
+        return stats
+    recent = steps.filter(
+        pc.field("taken_at")
+        > pc.scalar(taken_at - pendulum.duration(days=N_RECENT_DAYS))
+    )
+    days = pc.unique(recent.column("taken_at"))
+    days = days.take(pc.array_sort_indices(days))
+    amounts = np.zeros((len(days), len(user_ids)), dtype=np.int64)
+    day_index = pc.index_in(recent.column("taken_at"), value_set=days).to_numpy()
+    user_index = pc.index_in(recent.column("user_id"), value_set=user_ids).to_numpy()
+    amounts[day_index, user_index] = recent.column("amount").to_numpy()
+    stats["recent_days"] = days.to_pylist()
+    stats["recent_amounts"] = amounts.ravel().tolist()
+    return stats
+
+
+def _load(
+    db: Database, trek_id: Id, leg_id: Id
+) -> tuple[t.Optional[TrekStats], t.Optional[TrekStats]]:
+    rows = db.load_records(
+        TrekStats,
+        where={"trek_id": trek_id},
+        filter=pc.field("scope").isin([trek_id, leg_id]),
+    )
+    stats_for_scope = {stats["scope"]: stats for stats in rows}
+    return stats_for_scope.get(trek_id), stats_for_scope.get(leg_id)
+
+
+def _save(db: Database, rows: list[TrekStats]) -> None:
+    db.upsert_records(
+        TrekStats,
+        pa.Table.from_pylist(rows, schema=trek_stats_schema),
+        key_columns=STATS_KEY,
+    )
+
+
+def _add_steps(stats: TrekStats, date: pendulum.Date, steps: list[Step]) -> None:
+    known = set(stats["user_ids"])
+    new_user_ids = [step["user_id"] for step in steps if step["user_id"] not in known]
+    user_ids = stats["user_ids"] + new_user_ids
+    index_for_user_id = {user_id: i for i, user_id in enumerate(user_ids)}
+    amounts = np.zeros(len(user_ids), dtype=np.int64)
+    for step in steps:
+        amounts[index_for_user_id[step["user_id"]]] = step["amount"]
+
+    recent = np.hstack(
+        [
+            _recent_amounts(stats),
+            np.zeros((len(stats["recent_days"]), len(new_user_ids)), dtype=np.int64),
+        ]
+    )
+    recent_days = stats["recent_days"] + [date]
+    recent = np.vstack([recent, amounts])
+    is_recent = np.array(
+        [day > date.subtract(days=N_RECENT_DAYS) for day in recent_days]
+    )
+    totals = np.array(stats["step_totals"] + [0] * len(new_user_ids), dtype=np.int64)
+
+    stats["user_ids"] = user_ids
+    stats["step_totals"] = (totals + amounts).tolist()
+    stats["recent_days"] = [day for day, keep in zip(recent_days, is_recent) if keep]
+    stats["recent_amounts"] = recent[is_recent].ravel().tolist()
+    stats["taken_at"] = date
+
+
+def _current(
+    db: Database,
+    trek_id: Id,
+    scope: Id,
+    stats: t.Optional[TrekStats],
+    date: pendulum.Date,
+) -> TrekStats:
+    if stats is None or (stats["taken_at"] is not None and stats["taken_at"] >= date):
+        log.info(f"Rebuilding stats of {trek_id}, {scope}")
+        return _from_history(db, trek_id, scope, before=date)
+    return stats
+
+
+def add_steps(db: Database, steps: list[Step]) -> None:
+    """Add a day's steps to the stats of their trek and leg"""
+    if not steps:
+        return
+    trek_id, leg_id, date = (
+        steps[0]["trek_id"],
+        steps[0]["leg_id"],
+        steps[0]["taken_at"],
+    )
+    trek_stats, leg_stats = _load(db, trek_id, leg_id)
+    rows = [
+        _current(db, trek_id, trek_id, trek_stats, date),
+        _current(db, trek_id, leg_id, leg_stats, date),
+    ]
+    for stats in rows:
+        _add_steps(stats, date, steps)
+    _save(db, rows)
+
+
+def add_location(db: Database, location: Location) -> None:
+    """Count a day's location in the stats of its trek and leg"""
+    trek_id, leg_id, date = (
+        location["trek_id"],
+        location["leg_id"],
+        location["added_at"],
+    )
+    rows = []
+    for scope, stats in zip([trek_id, leg_id], _load(db, trek_id, leg_id)):
+        if stats is None:
+            stats = _from_history(db, trek_id, scope)
+        elif stats["located_at"] is None or stats["located_at"] < date:
+            stats["n_days"] += 1
+            stats["located_at"] = date
+        rows.append(stats)
+    _save(db, rows)
+
+
+def load(db: Database, trek_id: Id, scope: Id) -> TrekStats:
+    """The stats of the trek, or of a leg, from the history if they are missing"""
+    trek_stats, leg_stats = _load(db, trek_id, scope)
+    stats = trek_stats if scope == trek_id else leg_stats
+    if stats is None:
+        return _from_history(db, trek_id, scope)
+    return stats
+
+
+def step_totals(stats: TrekStats) -> dict[Id, int]:
+    return dict(zip(stats["user_ids"], stats["step_totals"]))
+
+
+def weekly_steps(stats: TrekStats, date: pendulum.Date) -> t.Optional[dict[Id, int]]:
+    """Steps per user in the week up to and including date, None without steps"""
+    is_in_week = np.array(
+        [day > date.subtract(weeks=1) for day in stats["recent_days"]], dtype=bool
+    )
+    if not is_in_week.any():
+        return None
+    sums = _recent_amounts(stats)[is_in_week].sum(axis=0)
+    return dict(zip(stats["user_ids"], sums.tolist()))
@@ -0,0 +1,261 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+import json
+import logging
+from math import ceil, floor
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+import typing as t  # noqa
+import uuid
+
+from PIL import Image
+import requests  # type: ignore
+from staticmap import StaticMap
+from staticmap.staticmap import _lat_to_y, _lon_to_x
+
+from trek import config
+from trek.core import clients
+
+log = logging.getLogger(__name__)
+
+TileKey = tuple[int, int, int]
+# zoom, and the center in tile numbers
+Frame = tuple[int, float, float]
+
+
+class TileCache:
+    """Map tiles on local disk, by z/x/y
+
+    Tiles are fetched from url_template and kept for ttl seconds, after which
+    they are revalidated with their ETag, so unchanged tiles are not downloaded
+    again. The least recently used tiles go first when the cache grows over
+    max_bytes. If the tile server can not be reached, a stale tile is served.
+    With an MBTiles file, tiles are read from it and neither the network nor the
+    disk cache is used.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        url_template: str,
+        max_bytes: int,
+        ttl: float,
+        mbtiles_path: t.Optional[Path],
+    ):
+        self.path = path
+        self.url_template = url_template
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.mbtiles_path = mbtiles_path
+        self.counts: t.Counter[str] = Counter()
+        self._n_bytes: t.Optional[int] = None
+        self._lock = threading.Lock()
+        # sqlite connections can not be shared between threads
+        self._local = threading.local()
+
+    def _tile_path(self, key: TileKey) -> Path:
+        z, x, y = key
+        return self.path / str(z) / str(x) / str(y)
+
+    def get(self, key: TileKey) -> bytes:
+        if self.mbtiles_path is not None:
+            return self._read_mbtiles(key)
+        tile_path = self._tile_path(key)
+        try:
+            meta = json.loads(tile_path.with_suffix(".json").read_text())
+            data: t.Optional[bytes] = tile_path.with_suffix(".png").read_bytes()
+        except (FileNotFoundError, json.JSONDecodeError):
+            meta, data = None, None
+        if meta is not None and meta["expires_at"] >= time.time():
+            # recently used tiles are evicted last
+            with suppress(FileNotFoundError):
+                os.utime(tile_path.with_suffix(".json"))
+            self._count("hit")
+            assert data is not None
+            return data
+
+        z, x, y = key
+        headers = {}
+        if meta is not None and meta["etag"] is not None:
+            headers["If-None-Match"] = meta["etag"]
+        try:
+            response = clients.requests_session().get(
+                self.url_template.format(z=z, x=x, y=y),
+                headers=headers,
+                timeout=config.http_timeout,
+            )
+            response.raise_for_status()
+        except requests.RequestException:
+            if data is None:
+                raise
+            log.warning(f"Serving stale tile {z}/{x}/{y}", exc_info=True)
+            self._count("stale")
+            return data
+        if response.status_code == 304 and data is not None:
+            self._count("revalidated")
+            content = data
+        else:
+            self._count("fetched")
+            content = response.content
+        self._put(tile_path, content, response.headers.get("ETag"))
+        return content
+
+    def prefetch(self, keys: t.Iterable[TileKey]) -> None:
+        """Fetch the tiles in parallel, so rendering reads them from disk"""
+        unique_keys = sorted(set(keys))
+        with ThreadPoolExecutor(config.tile_workers) as executor:
+            futures = [executor.submit(self.get, key) for key in unique_keys]
+        for key, future in zip(unique_keys, futures):
+            if future.exception() is not None:
+                log.warning(
+                    f"Error prefetching tile {key}", exc_info=future.exception()
+                )
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def _read_mbtiles(self, key: TileKey) -> bytes:
+        if not hasattr(self._local, "connection"):
+            uri = f"file:{self.mbtiles_path}?mode=ro"
+            self._local.connection = sqlite3.connect(uri, uri=True)
+        z, x, y = key
+        # MBTiles rows are counted from the bottom
+        row = self._local.connection.execute(
+            "SELECT tile_data FROM tiles "
+            "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, (1 << z) - 1 - y),
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"Tile {z}/{x}/{y} not in {self.mbtiles_path}")
+        self._count("hit")
+        return row[0]
+
+    def _put(self, tile_path: Path, data: bytes, etag: t.Optional[str]) -> None:
+        tile_path.parent.mkdir(parents=True, exist_ok=True)
+        meta = {"etag": etag, "expires_at": time.time() + self.ttl}
+        with self._lock:
+            n_bytes = self._size()
+            n_bytes -= self._remove(tile_path)
+            n_bytes += self._write(tile_path.with_suffix(".png"), data)
+            # the json file is written last, it marks the tile as complete
+            n_bytes += self._write(
+                tile_path.with_suffix(".json"), json.dumps(meta).encode()
+            )
+            self._n_bytes = n_bytes
+            if n_bytes > self.max_bytes:
+                self._evict()
+
+    @property
+    def n_bytes(self) -> int:
+        with self._lock:
+            return self._size()
+
+    def _size(self) -> int:
+        if self._n_bytes is None:
+            self._n_bytes = sum(
+                path.stat().st_size for path in self.path.rglob("*") if path.is_file()
+            )
+        return self._n_bytes
+
+    @staticmethod
+    def _write(path: Path, data: bytes) -> int:
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        return len(data)
+
+    @staticmethod
+    def _remove(tile_path: Path) -> int:
+        n_bytes = 0
+        for path in [tile_path.with_suffix(".json"), tile_path.with_suffix(".png")]:
+            try:
+                n_bytes += path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        return n_bytes
+
+    def _evict(self) -> None:
+        assert self._n_bytes is not None
+        tiles = sorted(
+            self.path.glob("*/*/*.json"), key=lambda path: path.stat().st_mtime
+        )
+        for tile in tiles:
+            if self._n_bytes <= self.max_bytes:
+                break
+            self._n_bytes -= self._remove(tile.with_suffix(""))
+        log.info(f"Evicted tiles, {self._n_bytes} bytes left")
+
+
+class CachedStaticMap(StaticMap):
+    """A StaticMap that takes its tiles from a TileCache"""
+
+    def __init__(self, width: int, height: int, cache: TileCache):
+        super().__init__(width=width, height=height, url_template="{z}/{x}/{y}")
+        self.cache = cache
+
+    def get(self, url: str, **kwargs) -> tuple[int, bytes]:
+        z, x, y = (int(part) for part in url.split("/"))
+        return 200, self.cache.get((z, x, y))
+
+    def frame(self) -> Frame:
+        """The zoom and center that fit all features, as render() picks them"""
+        zoom = self._calculate_zoom()
+        extent = self.determine_extent(zoom=zoom)
+        x_center = _lon_to_x((extent[0] + extent[2]) / 2, zoom)
+        y_center = _lat_to_y((extent[1] + extent[3]) / 2, zoom)
+        return zoom, x_center, y_center
+
+    def fits(self, frame: Frame) -> bool:
+        """Whether all features lie inside the map when rendered in frame"""
+        zoom, x_center, y_center = frame
+        min_lon, min_lat, max_lon, max_lat = self.determine_extent(zoom=zoom)
+        left = (_lon_to_x(min_lon, zoom) - x_center) * self.tile_size
+        right = (_lon_to_x(max_lon, zoom) - x_center) * self.tile_size
+        top = (_lat_to_y(max_lat, zoom) - y_center) * self.tile_size
+        bottom = (_lat_to_y(min_lat, zoom) - y_center) * self.tile_size
+        return (
+            -self.width / 2 <= left
+            and right <= self.width / 2
+            and -self.height / 2 <= top
+            and bottom <= self.height / 2
+        )
+
+    def tiles(self, frame: t.Optional[Frame] = None) -> list[TileKey]:
+        """The tiles rendering in frame will draw, as placed by StaticMap"""
+        zoom, x_center, y_center = frame if frame is not None else self.frame()
+        half_width = 0.5 * self.width / self.tile_size
+        half_height = 0.5 * self.height / self.tile_size
+        max_tile = 2**zoom
+        return [
+            (zoom, (x + max_tile) % max_tile, (y + max_tile) % max_tile)
+            for x in range(floor(x_center - half_width), ceil(x_center + half_width))
+            for y in range(floor(y_center - half_height), ceil(y_center + half_height))
+        ]
+
+    def render_on(
+        self, frame: Frame, base: t.Optional[Image.Image] = None
+    ) -> Image.Image:
+        """Render the features in frame, on base instead of the tiles if given"""
+        self.zoom, self.x_center, self.y_center = frame
+        if base is None:
+            image = Image.new("RGB", (self.width, self.height), self.background_color)
+            self._draw_base_layer(image)
+        else:
+            image = base.copy()
+        self._draw_features(image)
+        return image
+
+
+tile_cache = TileCache(
+    path=config.tile_cache_path,
+    url_template=config.tile_url,
+    max_bytes=config.tile_cache_max_bytes,
+    ttl=config.tile_cache_ttl,
+    mbtiles_path=config.tile_mbtiles_path,
+)
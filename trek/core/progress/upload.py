@@ -2,10 +2,9 @@ import logging
 from pathlib import Path
 import typing as t
 
-from dropbox import Dropbox
 import pendulum
 
-from trek import config
+from trek.core import clients
 from trek.models import Id
 
 log = logging.getLogger(__name__)
@@ -19,7 +18,7 @@ class UploadFunc(t.Protocol):
 
 
 def make_upload_f():
-    dbx = Dropbox(config.dbx_token)
+    dbx = clients.dropbox_client()
 
     def upload(
         data: bytes, trek_id: Id, leg_id: Id, date: pendulum.Date, name: str
@@ -7,6 +7,7 @@ from fitbit.api import FitbitOauth2Client
 import pendulum
 
 from trek import config
+from trek.core import clients
 from trek.core.trackers import tracker_utils
 from trek.database import Database
 from trek.models import Id
@@ -35,7 +36,9 @@ class FitbitUser:
             expires_at=token["expires_at"],
             refresh_cb=self._persist_token_callback,
             system=FitbitApi.METRIC,
+            timeout=config.http_timeout,
         )
+        clients.mount_pool(self.client.client.session)
 
     def persist_token(self, token: FitbitToken) -> None:
         tracker_user_id = FitbitService.tracker_user_id_from_token(token)
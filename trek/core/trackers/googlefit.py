@@ -1,13 +1,12 @@
 import logging
 import typing as t  # noqa
 
-import google.auth
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
 import pendulum
 
 from trek import config
+from trek.core import clients
 from trek.core.trackers import tracker_utils
 from trek.database import Database
 from trek.models import Id
@@ -31,12 +30,10 @@ class GooglefitUser:
         self.credentials = _credentials_from_token(token)
         self.credentials.expiry = pendulum.from_timestamp(token["expires_at"]).naive()
         if self.credentials.expired:
-            self.credentials.refresh(google.auth.transport.requests.Request())
+            self.credentials.refresh(clients.google_auth_request())
         if not self.credentials.valid:
             raise Exception("Invalid credentials")
-        self.client = build(
-            "fitness", "v1", credentials=self.credentials, cache_discovery=False
-        )
+        self.client = clients.google_service("fitness", "v1", self.credentials)
 
     def persist_token(self, token: GoogleFitToken) -> None:
         tracker_user_id = GooglefitService.tracker_user_id_from_token(token)
@@ -68,7 +65,7 @@ class GooglefitUser:
                     "endTimeMillis": end_ms,
                 },
             )
-            .execute()
+            .execute(num_retries=config.http_retries)
         )
 
     def steps(self, date: pendulum.Date, db: Database) -> int:
@@ -144,7 +141,5 @@ def _credentials_from_token(token):
 
 
 def _get_user_info(credentials):
-    user_info_service = build(
-        "oauth2", "v2", credentials=credentials, cache_discovery=False
-    )
-    return user_info_service.userinfo().get().execute()
+    user_info_service = clients.google_service("oauth2", "v2", credentials)
+    return user_info_service.userinfo().get().execute(num_retries=config.http_retries)
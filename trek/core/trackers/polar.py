@@ -6,12 +6,13 @@ import typing as t
 from accesslink import AccessLink as PolarApi
 from accesslink.endpoints.daily_activity_transaction import DailyActivityTransaction
 import pendulum
+import pyarrow as pa
 import pyarrow.compute as pc
 from requests.exceptions import HTTPError  # type: ignore
 
 from trek import config
 from trek.core.trackers import tracker_utils
-from trek.database import Database
+from trek.database import Database, polar_cache_schema
 from trek.models import Id, PolarCache
 
 log = logging.getLogger(__name__)
@@ -73,6 +74,7 @@ class PolarUser:
                 }
                 steps_by_date[taken_at].append(cache_entry)
 
+            newest_entries: list[PolarCache] = []
             for activity_date, activity_list in steps_by_date.items():
                 if activity_date < date:
                     # no use storing old data
@@ -83,16 +85,18 @@ class PolarUser:
                 log.info(
                     f"newest_entry_for_date, {activity_date}: {newest_entry_for_date}"
                 )
-                db.upsert_record(
-                    PolarCache,
-                    newest_entry_for_date,
-                    filter=(
-                        (pc.field("user_id") == pc.scalar(self.user_id))
-                        & (pc.field("taken_at") == pc.scalar(taken_at))
-                    ),
-                )
-            db.commit_table(PolarCache)
+                newest_entries.append(newest_entry_for_date)
+            # the transaction is not listed again once committed
+            db.upsert_committed(
+                PolarCache,
+                pa.Table.from_pylist(newest_entries, schema=polar_cache_schema),
+                key_columns=["user_id", "taken_at"],
+            )
             trans.commit()
+            # the session does not see the entries committed on their own
+            for entry in newest_entries:
+                if entry["taken_at"] == date:
+                    return entry["n_steps"]
         cache_records = db.load_records(
             PolarCache,
             filter=(
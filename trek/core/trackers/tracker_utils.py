@@ -1,11 +1,19 @@
+from concurrent.futures import Future
 import json
+import queue
+import threading
+import time
 import typing as t  # noqa
 
-import pyarrow.compute as pc
+import pendulum
+import pyarrow as pa
 
-from trek.database import Database
+from trek import config
+from trek.database import Database, user_token_schema
 from trek.models import Id, TrackerName, UserToken
 
+StepKey = tuple[Id, TrackerName, pendulum.Date]
+
 
 def persist_token(
     db: Database,
@@ -20,8 +28,141 @@ def persist_token(
         "tracker_name": tracker_name,
         "tracker_user_id": tracker_user_id,
     }
-    user_tracker_filter = (pc.field("user_id") == pc.scalar(user_id)) & (
-        pc.field("tracker_name") == pc.scalar(tracker_name)
+    # refresh tokens are single use, the new one must survive a failed session
+    db.upsert_committed(
+        UserToken,
+        pa.Table.from_pylist([user_token_record], schema=user_token_schema),
+        key_columns=["user_id", "tracker_name"],
     )
-    db.upsert_record(UserToken, user_token_record, user_tracker_filter)
-    db.commit_table(UserToken)
+
+
+class WriterClosedError(Exception):
+    pass
+
+
+class SingleWriter:
+    """Proxy for a Database session that is shared with tracker threads.
+
+    The session is not thread safe, so method calls made from other threads
+    are queued and executed by the thread that owns the session while it
+    waits in serve(). Methods that commit in a session of their own are still
+    executed once the writer is closed, so a token refreshed by a fetch that
+    outlived the deadline is not lost.
+    """
+
+    detached_methods: t.Final = frozenset({"upsert_committed"})
+
+    def __init__(self, db: Database):
+        self._db = db
+        self._owner = threading.get_ident()
+        self._calls: queue.Queue[
+            t.Optional[tuple[t.Callable, Future, bool]]
+        ] = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> t.Any:
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._run(
+                lambda: attr(*args, **kwargs), name in self.detached_methods
+            )
+
+        return call
+
+    def _run(self, func: t.Callable, is_detached: bool = False) -> t.Any:
+        if threading.get_ident() == self._owner:
+            return func()
+        future: Future = Future()
+        with self._lock:
+            is_closed = self._closed
+            if not is_closed:
+                self._calls.put((func, future, is_detached))
+        if not is_closed:
+            return future.result()
+        if not is_detached:
+            raise WriterClosedError
+        return func()
+
+    def wake(self, *args) -> None:
+        self._calls.put(None)
+
+    def serve(self, timeout: float) -> None:
+        """Execute queued calls until woken, or until the timeout expires."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                item = self._calls.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                return
+            if item is None:
+                return
+            func, future, _ = item
+            self._execute(func, future)
+
+    @staticmethod
+    def _execute(func: t.Callable, future: Future) -> None:
+        try:
+            future.set_result(func())
+        except Exception as e:
+            future.set_exception(e)
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                item = self._calls.get_nowait()
+            except queue.Empty:
+                return
+            if item is None:
+                continue
+            func, future, is_detached = item
+            if is_detached:
+                self._execute(func, future)
+            else:
+                future.set_exception(WriterClosedError())
+
+
+class StepCache:
+    """Steps fetched from the trackers, reused for ttl seconds
+
+    Concurrent lookups of a key wait for the one fetch in progress. Failed
+    fetches are not cached.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: dict[StepKey, tuple[Future, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: StepKey, fetch: t.Callable[[], int]) -> int:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                future, _ = entry
+                is_fetcher = False
+            else:
+                future = Future()
+                # in progress until it completes
+                self._entries[key] = (future, float("inf"))
+                is_fetcher = True
+        if not is_fetcher:
+            return future.result()
+        try:
+            steps = fetch()
+        except BaseException as e:
+            with self._lock:
+                del self._entries[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._entries[key] = (future, time.monotonic() + self.ttl)
+        future.set_result(steps)
+        return steps
+
+
+step_cache = StepCache(config.step_cache_ttl)
@@ -12,6 +12,7 @@ from withings_api.common import (
 )
 
 from trek import config
+from trek.core import clients
 from trek.core.trackers import tracker_utils
 from trek.database import Database
 from trek.models import Id
@@ -45,6 +46,7 @@ class WithingsUser:
         self.client: WithingsApi = WithingsApi(
             credentials, refresh_cb=self._persist_token_callback
         )
+        clients.mount_pool(self.client._client)
 
     def persist_token(self, token: WithingsToken) -> None:
         tracker_user_id = WithingsService.tracker_user_id_from_token(token)
@@ -10,7 +10,7 @@ from pydantic import BaseModel
 
 from trek import exceptions as exc
 from trek import utils
-from trek.core.trackers import trackers
+from trek.core.trackers import tracker_utils, trackers
 from trek.core.trackers.trackers import Tracker
 from trek.database import Database, user_schema
 from trek.models import Id, TrackerName, Trek, TrekUser, User, UserToken
@@ -19,19 +19,14 @@ log = logging.getLogger(__name__)
 
 
 def _user_id_for_tracker_user_id(db: Database, tracker_user_id: Id) -> t.Optional[Id]:
-    table = db.load_table(
-        UserToken,
-        filter=pc.field("tracker_user_id") == pc.scalar(tracker_user_id),
-    )
+    table = db.load_table(UserToken, where={"tracker_user_id": tracker_user_id})
     if table.num_rows == 0:
         return None
     return table.column("user_id").to_pylist()[0]
 
 
 def _tokens_for_user(db: Database, user_id: Id) -> list[UserToken]:
-    user_tokens = db.load_records(
-        UserToken, filter=pc.field("user_id") == pc.scalar(user_id)
-    )
+    user_tokens = db.load_records(UserToken, where={"user_id": user_id})
     return user_tokens
 
 
@@ -45,7 +40,7 @@ def _get_treks_owner_of(db: Database, user_id: Id) -> list[Id]:
 
 def _get_treks_user_in(db: Database, user_id: Id) -> list[Id]:
     return (
-        db.load_table(TrekUser, filter=pc.field("user_id") == pc.scalar(user_id))
+        db.load_table(TrekUser, where={"user_id": user_id})
         .column("trek_id")
         .to_pylist()
     )
@@ -161,7 +156,7 @@ class MeResponse(BaseModel):
 
 
 def me(db: Database, user_id: Id) -> MeResponse:
-    user_records = db.load_records(User, filter=pc.field("id") == pc.scalar(user_id))
+    user_records = db.load_records(User, where={"id": user_id})
     if not user_records:
         raise exc.ServerException(
             exc.E101Error(status_code=1, detail="user_id not found")
@@ -171,13 +166,18 @@ def me(db: Database, user_id: Id) -> MeResponse:
     steps_data = []
     now = pendulum.yesterday().date()
     for token_data in token_records:
-        try:
+
+        def fetch() -> int:
             tracker_user = trackers.name_to_service[token_data["tracker_name"]].User(
                 user_id=token_data["user_id"],
                 token=json.loads(token_data["token"]),
                 db=db,
             )
-            steps = tracker_user.steps(now, db)
+            return tracker_user.steps(now, db)
+
+        key = (user_id, token_data["tracker_name"], now)
+        try:
+            steps = tracker_utils.step_cache.get(key, fetch)
         except Exception as e:
             log.info(f"Failed to authenticate tracker user: {e}", exc_info=True)
         else:
@@ -202,7 +202,7 @@ class IsAuthenticatedResponse(BaseModel):
 
 
 def is_authenticated(db: Database, user_id: Id) -> IsAuthenticatedResponse:
-    user_records = db.load_records(User, filter=pc.field("id") == pc.scalar(user_id))
+    user_records = db.load_records(User, where={"id": user_id})
     if not user_records:
         raise exc.ServerException(
             exc.E101Error(status_code=1, detail="user_id not found")
@@ -1,18 +1,27 @@
-from contextlib import contextmanager
-from dataclasses import dataclass
+import asyncio
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+import fcntl
+from functools import lru_cache, partial, reduce
+from itertools import groupby
+import json
 import logging
+from operator import and_, attrgetter
+import os
 from pathlib import Path
 import shutil
 import tempfile
+import threading
 import typing as t  # noqa
 import uuid
 
-from filelock import FileLock
+import numpy as np
 import pendulum
 import pyarrow as pa
 import pyarrow.compute as pc
 import pyarrow.dataset as ds
-import pyarrow.parquet as pq
 
 from trek import config, models
 from trek.models import Id
@@ -59,6 +68,10 @@ class ValidationError(Exception):
     pass
 
 
+class ReadOnlyError(Exception):
+    pass
+
+
 def _validate(table: pa.Table, expression: pc.Expression):
     invalid = table.filter(~expression)
     if not invalid.num_rows == 0:
@@ -66,126 +79,1441 @@ def _validate(table: pa.Table, expression: pc.Expression):
 
 
 R = t.TypeVar("R")
+T = t.TypeVar("T")
+
+parquet_format = ds.ParquetFileFormat()
+
+DELTA_PREFIX = "delta-"
+MANIFEST_NAME = "manifest.json"
+VERSIONS_NAME = "_versions"
+JOURNAL_NAME = "commit.journal"
+STAGING_NAME = "_staging"
+LOCK_NAME = "database.lock"
+INDEX_SUFFIX = ".index.json"
+
+
+class CommitConflictError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Fragment:
+    # a single parquet file, relative to the table directory under root
+    root: Path
+    path: Path
+
+
+@dataclass(frozen=True)
+class PendingMutation:
+    kind: t.Literal["append", "upsert", "delete"]
+    table: pa.Table
+    key_columns: tuple[str, ...] = ()
+
+    def can_merge(self, other: "PendingMutation") -> bool:
+        return (self.kind, self.key_columns) == (other.kind, other.key_columns)
+
+    def merge(self, other: "PendingMutation") -> "PendingMutation":
+        table = pa.concat_tables([self.table, other.table])
+        return PendingMutation(self.kind, table, self.key_columns)
+
+    def apply(self, db: "Database", metadata: "TableMetadata") -> None:
+        if self.kind == "append":
+            db._append_table(metadata, self.table)
+        elif self.kind == "upsert":
+            db._upsert_table(metadata, self.table, list(self.key_columns))
+        else:
+            db._delete_keys(metadata, self.table)
+
+
+# a change to a table, made again on the newest version if a commit conflicts
+Change = t.Callable[["Database"], None]
+
+
+def _is_delta(path: Path) -> bool:
+    return path.name.startswith(DELTA_PREFIX)
+
+
+def _delta_seq(path: Path) -> int:
+    return int(path.name.split("-")[1])
+
+
+def _list_fragments(table_dir: Path) -> list[Path]:
+    # base files first, then deltas in the order they were appended
+    if not table_dir.exists():
+        return []
+    paths = [path.relative_to(table_dir) for path in table_dir.rglob("*.parquet")]
+    return sorted(paths, key=lambda path: (path.parent, _is_delta(path), path.name))
+
+
+def _index_path(fragment_path: Path) -> Path:
+    return fragment_path.with_name(fragment_path.name + INDEX_SUFFIX)
+
+
+# row groups of a fragment per key, per index
+FragmentIndex = dict[str, dict[str, list[int]]]
+
+
+def _index_key(values: t.Iterable) -> str:
+    return json.dumps(list(values))
+
+
+# rows of a cached table per key, per index
+RowIndex = dict[str, dict[str, list[int]]]
+
+
+def _index_rows(table: pa.Table, columns: tuple[str, ...]) -> dict[str, list[int]]:
+    entries: dict[str, list[int]] = {}
+    keys = zip(*(table.column(c).to_pylist() for c in columns))
+    for row, values in enumerate(keys):
+        entries.setdefault(_index_key(values), []).append(row)
+    return entries
+
+
+@lru_cache(maxsize=4096)
+def _read_index(path: Path) -> FragmentIndex:
+    # index files are never modified, like the fragments they belong to
+    return json.loads(path.read_text())
+
+
+def _equality_filter(where: dict[str, t.Any]) -> pc.Expression:
+    return reduce(
+        and_, [pc.field(column) == pc.scalar(value) for column, value in where.items()]
+    )
+
+
+def _match_keys(table: pa.Table, keys: pa.Table) -> pa.Array:
+    """Mask of the rows of table that equal a row of keys on the key columns"""
+    row_ids = pa.array(range(table.num_rows), type=pa.int64())
+    indexed = table.select(keys.column_names).append_column("_row_id", row_ids)
+    # a threaded join can hang while upserts in other threads hold arrow's CPU pool
+    matched = indexed.join(
+        keys, keys=keys.column_names, join_type="left semi", use_threads=False
+    )
+    return pc.is_in(row_ids, value_set=matched.column("_row_id").combine_chunks())
+
+
+def _last_per_key(table: pa.Table, key_columns: list[str]) -> pa.Table:
+    # later rows win, as if the rows had been upserted one by one
+    row_ids = pa.array(range(table.num_rows), type=pa.int64())
+    indexed = table.select(key_columns).append_column("_row_id", row_ids)
+    last = indexed.group_by(key_columns).aggregate([("_row_id", "max")])
+    last_row_ids = last.column("_row_id_max")
+    return table.take(last_row_ids.take(pc.sort_indices(last_row_ids)))
+
+
+def _fsync(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_json_atomic(path: Path, data: dict) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync(path.parent)
+
+
+def _try_lock_exclusive(path: Path) -> t.Optional[int]:
+    # None if a live session holds a shared lock on the path
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+Manifest = dict[str, list[Path]]
+
+
+def _read_manifest(path: Path) -> Manifest:
+    data = json.loads(path.read_text())
+    return {
+        name: [Path(fragment) for fragment in fragments]
+        for name, fragments in data["tables"].items()
+    }
+
+
+def _write_manifest(path: Path, manifest: Manifest) -> None:
+    tables = {
+        name: [fragment.as_posix() for fragment in fragments]
+        for name, fragments in manifest.items()
+    }
+    _write_json_atomic(path, {"tables": tables})
+
+
+def _read_legacy_manifest(load_dir: Path) -> t.Optional[Manifest]:
+    # single manifest written before tables were versioned
+    path = load_dir / MANIFEST_NAME
+    if not path.exists():
+        return None
+    return _read_manifest(path)
+
+
+def _version_path(load_dir: Path, version: int) -> Path:
+    return load_dir / VERSIONS_NAME / f"{version:08d}.json"
+
+
+def _list_versions(load_dir: Path) -> list[int]:
+    versions_dir = load_dir / VERSIONS_NAME
+    if not versions_dir.exists():
+        return []
+    return sorted(int(path.stem) for path in versions_dir.glob("*.json"))
+
+
+def _referenced(load_dir: Path) -> dict[str, set[Path]]:
+    referenced: dict[str, set[Path]] = {}
+    for version in _list_versions(load_dir):
+        manifest = _read_manifest(_version_path(load_dir, version))
+        for name, fragments in manifest.items():
+            referenced.setdefault(name, set()).update(fragments)
+    return referenced
+
+
+def _remove_unreferenced(
+    load_dir: Path,
+    partitions: dict[str, set[Path]],
+    referenced: dict[str, set[Path]],
+) -> None:
+    # only the given partitions are scanned, a full scan would read every table
+    for name, table_partitions in partitions.items():
+        table_dir = load_dir / name
+        table_referenced = referenced.get(name, set())
+        for partition in table_partitions:
+            partition_dir = table_dir / partition
+            if not partition_dir.exists():
+                continue
+            for path in list(partition_dir.iterdir()):
+                fragment_path = path.with_name(path.name.removesuffix(INDEX_SUFFIX))
+                if fragment_path.suffix != ".parquet":
+                    continue
+                if fragment_path.relative_to(table_dir) not in table_referenced:
+                    path.unlink()
+            while partition_dir != table_dir and not any(partition_dir.iterdir()):
+                partition_dir.rmdir()
+                partition_dir = partition_dir.parent
+
+
+def _rebase(
+    base: list[Path], ours: list[Path], head: list[Path], partitions: set[Path]
+) -> list[Path]:
+    """Apply a session's changes to a table onto the newest committed version
+
+    Partitions changed by both sessions only merge if this session appended to them.
+    """
+    if head == base:
+        return ours
+    rebased = [path for path in head if path.parent not in partitions]
+    for partition in sorted(partitions):
+        base_part = [path for path in base if path.parent == partition]
+        ours_part = [path for path in ours if path.parent == partition]
+        head_part = [path for path in head if path.parent == partition]
+        if head_part == base_part:
+            rebased.extend(ours_part)
+        elif ours_part[: len(base_part)] == base_part:
+            rebased.extend(head_part + ours_part[len(base_part) :])
+        else:
+            raise CommitConflictError(partition)
+    return rebased
+
+
+class ReadWriteLock:
+    """Inter-process lock, shared between readers and exclusive for writers"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # waiting writers hold the turnstile so new readers queue behind them
+        self.turnstile_path = path + ".turnstile"
+
+    @contextmanager
+    def _flock(self, path: str, operation: int):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    @asynccontextmanager
+    async def _async_flock(self, path: str, operation: int):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            # polled, so waiting holds neither the event loop nor a thread
+            while True:
+                try:
+                    fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(config.db_lock_poll_interval)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    @contextmanager
+    def shared(self):
+        with self._flock(self.turnstile_path, fcntl.LOCK_EX):
+            pass
+        with self._flock(self.path, fcntl.LOCK_SH):
+            yield
+
+    @contextmanager
+    def exclusive(self):
+        with self._flock(self.turnstile_path, fcntl.LOCK_EX):
+            with self._flock(self.path, fcntl.LOCK_EX):
+                yield
+
+    @asynccontextmanager
+    async def async_shared(self):
+        async with self._async_flock(self.turnstile_path, fcntl.LOCK_EX):
+            pass
+        async with self._async_flock(self.path, fcntl.LOCK_SH):
+            yield
+
+    @asynccontextmanager
+    async def async_exclusive(self):
+        async with self._async_flock(self.turnstile_path, fcntl.LOCK_EX):
+            async with self._async_flock(self.path, fcntl.LOCK_EX):
+                yield
+
+
+CacheKey = tuple[Path, str, tuple[Path, ...]]
+
+
+class TableCache:
+    """Decoded tables shared by the sessions of a process, least recently used go first
+
+    Fragments are never modified once committed, so a table's list of fragments
+    identifies the version of its contents.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.n_bytes = 0
+        self._tables: t.OrderedDict[CacheKey, pa.Table] = OrderedDict()
+        # small next to the tables, so not counted in n_bytes
+        self._row_indexes: dict[CacheKey, RowIndex] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: CacheKey) -> t.Optional[pa.Table]:
+        with self._lock:
+            table = self._tables.get(key)
+            if table is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._tables.move_to_end(key)
+            return table
+
+    def put(self, key: CacheKey, table: pa.Table) -> None:
+        if table.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._tables:
+                return
+            self._tables[key] = table
+            self.n_bytes += table.nbytes
+            while self.n_bytes > self.max_bytes:
+                evicted_key, evicted = self._tables.popitem(last=False)
+                self._row_indexes.pop(evicted_key, None)
+                self.n_bytes -= evicted.nbytes
+
+    def rows(
+        self, key: CacheKey, table: pa.Table, index: "Index", index_key: str
+    ) -> list[int]:
+        """Rows of a cached table with index_key, the index is built on first use"""
+        with self._lock:
+            entries = self._row_indexes.get(key, {}).get(index.name)
+        if entries is None:
+            entries = _index_rows(table, index.columns)
+            with self._lock:
+                if key in self._tables:
+                    self._row_indexes.setdefault(key, {})[index.name] = entries
+        return entries.get(index_key, [])
+
+    def invalidate(self, load_dir: Path, name: str) -> None:
+        with self._lock:
+            keys = [key for key in self._tables if key[:2] == (load_dir, name)]
+            for key in keys:
+                self._row_indexes.pop(key, None)
+                self.n_bytes -= self._tables.pop(key).nbytes
+
+
+table_cache = TableCache(config.table_cache_max_bytes)
+db_executor = ThreadPoolExecutor(config.db_workers, thread_name_prefix="db")
+
+
+async def run_io(function: t.Callable[..., T], *args, **kwargs) -> T:
+    """Call function in db_executor, the event loop carries on meanwhile"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(function, *args, **kwargs))
+
+
+def _make_staging_dir(load_dir: Path) -> tuple[Path, int]:
+    """A new staging directory and the locked descriptor, must hold the lock"""
+    staging_dir = Path(tempfile.mkdtemp(dir=load_dir / STAGING_NAME))
+    fd = os.open(staging_dir, os.O_RDONLY)
+    # garbage collection leaves staging directories of live sessions alone
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    return staging_dir, fd
+
+
+def _remove_staging_dir(staging_dir: Path, fd: int) -> None:
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.close(fd)
+
+
+@contextmanager
+def _staging_dir(load_dir: Path):
+    # staging next to the tables keeps commits to plain renames
+    (load_dir / STAGING_NAME).mkdir(parents=True, exist_ok=True)
+    with ReadWriteLock(str(load_dir / LOCK_NAME)).shared():
+        staging_dir, fd = _make_staging_dir(load_dir)
+    try:
+        yield staging_dir
+    finally:
+        _remove_staging_dir(staging_dir, fd)
+
+
+@asynccontextmanager
+async def _async_staging_dir(load_dir: Path):
+    await run_io((load_dir / STAGING_NAME).mkdir, parents=True, exist_ok=True)
+    async with ReadWriteLock(str(load_dir / LOCK_NAME)).async_shared():
+        staging_dir, fd = await run_io(_make_staging_dir, load_dir)
+    try:
+        yield staging_dir
+    finally:
+        await run_io(_remove_staging_dir, staging_dir, fd)
 
 
 class Database:
-    lock = FileLock("database.lock")
+    """Session on a snapshot of the tables
+
+    Every commit writes a new numbered version listing the fragments of all tables.
+    Sessions read the version that was newest when they opened and hold a shared
+    lock on it, so garbage collection keeps its files until the session closes.
+    The database lock is only held to pin a version and to commit.
+    """
 
     @classmethod
     @contextmanager
-    def get_db_mgr(cls):
-        with cls.lock, tempfile.TemporaryDirectory() as temp_dir_name:
-            temp_dir = Path(temp_dir_name)
-            db = cls(save_dir=temp_dir, load_dir=config.tables_path)
-            yield db
-            db.commit()
+    def get_db_mgr(cls, load_dir: t.Optional[Path] = None):
+        load_dir = config.tables_path if load_dir is None else load_dir
+        with _staging_dir(load_dir) as staging_dir:
+            db = cls(save_dir=staging_dir, load_dir=load_dir)
+            try:
+                yield db
+                db.commit()
+            finally:
+                db.close()
 
     @classmethod
     def get_db(cls):
         with cls.get_db_mgr() as db:
             yield db
 
-    def __init__(self, save_dir: Path, load_dir: Path):
+    @classmethod
+    @contextmanager
+    def get_read_db_mgr(cls):
+        db = cls(
+            save_dir=config.tables_path, load_dir=config.tables_path, read_only=True
+        )
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @classmethod
+    def get_read_db(cls):
+        with cls.get_read_db_mgr() as db:
+            yield db
+
+    def __init__(
+        self,
+        save_dir: Path,
+        load_dir: Path,
+        read_only: bool = False,
+        pin_latest: bool = True,
+    ):
         self.save_dir = save_dir
         self.load_dir = load_dir
+        self.read_only = read_only
+        self.load_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = ReadWriteLock(str(load_dir / LOCK_NAME))
+        self.version = 0
+        self._manifest: t.Optional[Manifest] = None
+        self._pin_fd: t.Optional[int] = None
+        if pin_latest:
+            with self.lock.shared():
+                self._pin_latest()
+        self._fragments: dict[str, list[Fragment]] = {}
+        # committed fragments each table was read from, to rebase changes onto
+        self._base: dict[str, list[Path]] = {}
+        # changed partition directories per table, "." for unpartitioned tables
+        self._changed: dict[str, set[Path]] = {}
+        # mutations buffered by batch(), per table
+        self._batch_depth = 0
+        self._pending: dict[str, list[PendingMutation]] = {}
+        # changes made since the last commit, per table
+        self._changes: dict[str, list[Change]] = {}
+
+    def _pin_latest(self) -> None:
+        """Move the session to the newest version, must hold the lock"""
+        versions = _list_versions(self.load_dir)
+        if versions:
+            self._pin(versions[-1])
+        else:
+            self._manifest = _read_legacy_manifest(self.load_dir)
+
+    def _pin(self, version: int) -> None:
+        """Move the session to a version, must hold the lock"""
+        self.close()
+        path = _version_path(self.load_dir, version)
+        self._pin_fd = os.open(path, os.O_RDONLY)
+        fcntl.flock(self._pin_fd, fcntl.LOCK_SH)
+        self.version = version
+        self._manifest = _read_manifest(path)
+
+    def close(self) -> None:
+        if self._pin_fd is not None:
+            os.close(self._pin_fd)
+            self._pin_fd = None
+
+    @staticmethod
+    def recover(load_dir: Path) -> None:
+        """Clean up after a commit that was interrupted, must hold the lock"""
+        journal_path = load_dir / JOURNAL_NAME
+        if not journal_path.exists():
+            return
+        log.info("Recovering from interrupted commit")
+        journal = json.loads(journal_path.read_text())
+        changed = {name: {Path(p) for p in parts} for name, parts in journal.items()}
+        _remove_unreferenced(load_dir, changed, _referenced(load_dir))
+        journal_path.unlink()
+
+    def _committed_paths(self, metadata: "TableMetadata") -> list[Path]:
+        if self._manifest is None:
+            # tables written before the manifest existed
+            return _list_fragments(self.load_dir / metadata.name)
+        return self._manifest.get(metadata.name, [])
+
+    def _table_fragments(self, metadata: "TableMetadata") -> list[Fragment]:
+        if metadata.name in self._pending:
+            self._flush(metadata)
+        if metadata.name not in self._fragments:
+            paths = self._committed_paths(metadata)
+            self._base[metadata.name] = paths
+            self._fragments[metadata.name] = [
+                Fragment(self.load_dir, path) for path in paths
+            ]
+        return self._fragments[metadata.name]
+
+    def _assert_writable(self) -> None:
+        if self.read_only:
+            raise ReadOnlyError("Database session is read-only")
+
+    def _mark_changed(
+        self, metadata: "TableMetadata", fragments: t.Iterable[Fragment]
+    ) -> None:
+        partitions = self._changed.setdefault(metadata.name, set())
+        partitions.update(fragment.path.parent for fragment in fragments)
+
+    def _fragment_path(self, metadata: "TableMetadata", fragment: Fragment) -> Path:
+        return fragment.root / metadata.name / fragment.path
 
     def load_table(
         self,
         Type: t.Type[R],
         filter: t.Optional[pc.Expression] = None,
         columns: t.Optional[list[str]] = None,
+        where: t.Optional[dict[str, t.Any]] = None,
     ) -> pa.Table:
+        """Load a table, optionally filtered
+
+        Equality conditions in `where` are served from an index when the table has one
+        on those columns, `filter` is applied on top.
+        """
         metadata = table_metadatas[Type]
-        path = self.save_dir / metadata.name
-        if not path.exists():
-            path = self.load_dir / metadata.name
+        fragments = self._table_fragments(metadata)
+        if where:
+            where_filter = _equality_filter(where)
+            filter = where_filter if filter is None else where_filter & filter
+        if not fragments:
+            return _empty_table(metadata, columns)
+        index = _find_index(metadata, where) if where else None
+        if where and index is not None:
+            index_key = _index_key(where[column] for column in index.columns)
+        # tables with staged changes are private to the session
+        if metadata.cached and all(f.root == self.load_dir for f in fragments):
+            key = (self.load_dir, metadata.name, tuple(f.path for f in fragments))
+            table = table_cache.get(key)
+            if table is None:
+                table = self._read_fragments(metadata, fragments)
+                table_cache.put(key, table)
+            if index is not None:
+                rows = table_cache.rows(key, table, index, index_key)
+                table = table.take(pa.array(rows, type=pa.int64()))
+            if filter is None and columns is None:
+                return table
+            return ds.dataset(table).to_table(filter=filter, columns=columns)
+        if index is not None:
+            return self._read_indexed(
+                metadata, fragments, index, index_key, filter, columns
+            )
+        return self._read_fragments(metadata, fragments, filter, columns)
+
+    def _dataset(
+        self, metadata: "TableMetadata", root: Path, fragments: t.Iterable[Fragment]
+    ) -> ds.FileSystemDataset:
+        return ds.dataset(
+            [str(self._fragment_path(metadata, fragment)) for fragment in fragments],
+            schema=metadata.schema,
+            format="parquet",
+            partitioning=metadata.partitioning,
+            partition_base_dir=str(root / metadata.name),
+        )
+
+    def _read_fragments(
+        self,
+        metadata: "TableMetadata",
+        fragments: list[Fragment],
+        filter: t.Optional[pc.Expression] = None,
+        columns: t.Optional[list[str]] = None,
+    ) -> pa.Table:
+        datasets = [
+            self._dataset(metadata, root, group)
+            for root, group in groupby(fragments, key=attrgetter("root"))
+        ]
+        dataset = datasets[0] if len(datasets) == 1 else ds.dataset(datasets)
+        return dataset.to_table(filter=filter, columns=columns)
+
+    def _read_indexed(
+        self,
+        metadata: "TableMetadata",
+        fragments: list[Fragment],
+        index: "Index",
+        key: str,
+        filter: pc.Expression,
+        columns: t.Optional[list[str]],
+    ) -> pa.Table:
+        # only the row groups holding the key are read, the filter does the rest
+        selected = []
+        for fragment in fragments:
+            row_groups = self._fragment_index(metadata, fragment)[index.name].get(key)
+            if row_groups:
+                dataset = self._dataset(metadata, fragment.root, [fragment])
+                file_fragment = next(iter(dataset.get_fragments()))
+                selected.append(file_fragment.subset(row_group_ids=row_groups))
+        if not selected:
+            return _empty_table(metadata, columns)
+        dataset = ds.FileSystemDataset(
+            selected,
+            schema=metadata.schema,
+            format=parquet_format,
+            filesystem=selected[0].filesystem,
+        )
+        return dataset.to_table(filter=filter, columns=columns)
+
+    def _build_index(
+        self, metadata: "TableMetadata", fragment: Fragment
+    ) -> FragmentIndex:
+        dataset = self._dataset(metadata, fragment.root, [fragment])
+        file_fragment = next(iter(dataset.get_fragments()))
+        key_columns = sorted({c for index in metadata.indexes for c in index.columns})
+        fragment_index: FragmentIndex = {index.name: {} for index in metadata.indexes}
+        for row_group in file_fragment.split_by_row_group():
+            row_group_id = row_group.row_groups[0].id
+            table = row_group.to_table(schema=metadata.schema, columns=key_columns)
+            for index in metadata.indexes:
+                entries = fragment_index[index.name]
+                keys = zip(*(table.column(c).to_pylist() for c in index.columns))
+                for key in {_index_key(values) for values in keys}:
+                    entries.setdefault(key, []).append(row_group_id)
+        return fragment_index
+
+    def _is_indexed(self, metadata: "TableMetadata", fragment: Fragment) -> bool:
+        path = _index_path(self._fragment_path(metadata, fragment))
         if not path.exists():
-            table = pa.Table.from_pylist([], schema=metadata.schema)
-        else:
-            table = ds.dataset(
-                path,
-                schema=metadata.schema,
-                format="parquet",
-                partitioning=metadata.partitioning,
-            ).to_table(filter=filter, columns=columns)
+            return False
+        fragment_index = _read_index(path)
+        return all(index.name in fragment_index for index in metadata.indexes)
+
+    def _fragment_index(
+        self, metadata: "TableMetadata", fragment: Fragment
+    ) -> FragmentIndex:
+        if self._is_indexed(metadata, fragment):
+            return _read_index(_index_path(self._fragment_path(metadata, fragment)))
+        # written before the table had its current indexes, until migrate() runs
+        return self._build_index(metadata, fragment)
 
-        return table
+    def _check_unique(
+        self, metadata: "TableMetadata", table: pa.Table, fragments: list[Fragment]
+    ) -> None:
+        for index in metadata.indexes:
+            if not index.unique:
+                continue
+            keys = zip(*(table.column(c).to_pylist() for c in index.columns))
+            key_counts = Counter(_index_key(values) for values in keys)
+            duplicates = {key for key, count in key_counts.items() if count > 1}
+            for fragment in fragments:
+                entries = self._fragment_index(metadata, fragment)[index.name]
+                duplicates.update(key for key in key_counts if key in entries)
+            if duplicates:
+                raise ValidationError(index, sorted(duplicates))
 
     def load_records(
         self,
         Type: t.Type[R],
         filter: t.Optional[pc.Expression] = None,
         columns: t.Optional[list[str]] = None,
+        where: t.Optional[dict[str, t.Any]] = None,
     ) -> list[R]:
-        return self.load_table(Type, filter, columns).to_pylist()
+        return self.load_table(Type, filter, columns, where).to_pylist()
+
+    def _write_fragments(
+        self, metadata: "TableMetadata", table: pa.Table, prefix: str
+    ) -> list[Fragment]:
+        table_dir = self.save_dir / metadata.name
+        basename = f"{prefix}{uuid.uuid4().hex}"
+        written: list[Path] = []
+        if metadata.sort_by is not None:
+            table = table.sort_by(metadata.sort_by)
+        ds.write_dataset(
+            # order is SOMETIMES non-deterministic if chunks not combined
+            table.combine_chunks(),
+            table_dir,
+            format="parquet",
+            partitioning=metadata.partitioning,
+            basename_template=f"{basename}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            file_visitor=lambda file: written.append(Path(file.path)),
+            file_options=parquet_format.make_write_options(write_statistics=True),
+            max_rows_per_group=metadata.row_group_size,
+        )
+        paths = sorted(path.relative_to(table_dir) for path in written)
+        fragments = [Fragment(self.save_dir, path) for path in paths]
+        if metadata.indexes:
+            for fragment in fragments:
+                fragment_index = self._build_index(metadata, fragment)
+                index_path = _index_path(self._fragment_path(metadata, fragment))
+                index_path.write_text(json.dumps(fragment_index))
+        return fragments
+
+    def _drop_fragments(
+        self, metadata: "TableMetadata", to_drop: t.Iterable[Fragment]
+    ) -> None:
+        # committed files are removed on commit, staged files right away
+        for fragment in to_drop:
+            if fragment.root == self.save_dir:
+                path = self._fragment_path(metadata, fragment)
+                path.unlink(missing_ok=True)
+                _index_path(path).unlink(missing_ok=True)
 
     def save_table(self, Type: t.Type[R], table: pa.Table) -> None:
+        self._assert_writable()
         metadata = table_metadatas[Type]
+        self._apply(metadata, lambda db: db._save_table(metadata, table))
+
+    def _save_table(self, metadata: "TableMetadata", table: pa.Table) -> None:
         if metadata.validators is not None:
             for validator in metadata.validators:
                 _validate(table, validator)
+        self._check_unique(metadata, table, fragments=[])
+        fragments = self._table_fragments(metadata)
+        new_fragments = self._write_fragments(metadata, table, prefix="part-")
         if metadata.partitioning is None:
-            ds.write_dataset(
-                table,
-                self.save_dir / metadata.name,
-                format="parquet",
-                existing_data_behavior="overwrite_or_ignore",
-            )
+            replaced = fragments
         else:
-            pq.write_to_dataset(
-                table,
-                root_path=self.save_dir / metadata.name,
-                partitioning=metadata.partitioning,
-                existing_data_behavior="overwrite_or_ignore",
-            )
+            # only the partitions present in the new table are replaced
+            touched = {fragment.path.parent for fragment in new_fragments}
+            replaced = [f for f in fragments if f.path.parent in touched]
+        kept = [fragment for fragment in fragments if fragment not in replaced]
+        self._drop_fragments(metadata, replaced)
+        self._fragments[metadata.name] = kept + new_fragments
+        self._mark_changed(metadata, replaced + new_fragments)
+
+    def append_records(self, Type: t.Type[R], records: list[R]) -> None:
+        self._assert_writable()
+        metadata = table_metadatas[Type]
+        records_table = pa.Table.from_pylist(records, schema=metadata.schema)
+        self._mutate(metadata, PendingMutation("append", records_table))
+
+    def _append_table(self, metadata: "TableMetadata", records_table: pa.Table):
+        if records_table.num_rows == 0:
+            return
+        if metadata.validators is not None:
+            for validator in metadata.validators:
+                _validate(records_table, validator)
+        fragments = self._table_fragments(metadata)
+        self._check_unique(metadata, records_table, fragments)
+        seq = max(
+            (
+                _delta_seq(fragment.path)
+                for fragment in fragments
+                if _is_delta(fragment.path)
+            ),
+            default=0,
+        )
+        new_fragments = self._write_fragments(
+            metadata, records_table, prefix=f"{DELTA_PREFIX}{seq + 1:06d}-"
+        )
+        self._fragments[metadata.name] = fragments + new_fragments
+        self._mark_changed(metadata, new_fragments)
+        partitions = {fragment.path.parent for fragment in new_fragments}
+        to_compact = {p for p in partitions if self._needs_compaction(metadata, p)}
+        if to_compact:
+            self._compact(metadata, to_compact)
 
     def append_record(self, Type: t.Type[R], record: R) -> None:
+        self.append_records(Type, [record])
+
+    def _needs_compaction(self, metadata: "TableMetadata", partition: Path) -> bool:
+        deltas = [
+            f
+            for f in self._table_fragments(metadata)
+            if f.path.parent == partition and _is_delta(f.path)
+        ]
+        if len(deltas) >= config.compaction_max_fragments:
+            return True
+        n_bytes = sum(self._fragment_path(metadata, f).stat().st_size for f in deltas)
+        return n_bytes >= config.compaction_max_bytes
+
+    def compact(
+        self, Type: t.Type[R], partitions: t.Optional[set[Path]] = None
+    ) -> None:
+        """Merge base and delta fragments of a table into new base files
+
+        For partitioned tables only the given partitions are rewritten, if any.
+        """
+        self._compact(table_metadatas[Type], partitions)
+
+    def _compact(
+        self, metadata: "TableMetadata", partitions: t.Optional[set[Path]]
+    ) -> None:
+        fragments = self._table_fragments(metadata)
+        if partitions is not None:
+            fragments = [f for f in fragments if f.path.parent in partitions]
+        if not fragments:
+            return
+        table = self._read_fragments(metadata, fragments)
+        self._replace_fragments(metadata, fragments, table)
+
+    def _replace_fragments(
+        self, metadata: "TableMetadata", replaced: list[Fragment], table: pa.Table
+    ) -> None:
+        fragments = self._table_fragments(metadata)
+        new_fragments = self._write_fragments(metadata, table, prefix="part-")
+        self._drop_fragments(metadata, replaced)
+        self._fragments[metadata.name] = [
+            fragment for fragment in fragments if fragment not in replaced
+        ] + new_fragments
+        self._mark_changed(metadata, replaced + new_fragments)
+
+    def repartition(self, Type: t.Type[R]) -> None:
+        """Rewrite all fragments of a table into its current partitioning"""
+        self._assert_writable()
         metadata = table_metadatas[Type]
-        table = self.load_table(Type)
-        record_table = pa.Table.from_pylist([record], schema=metadata.schema)
-        merged_table = pa.concat_tables([table, record_table])
-        # order is SOMETIMES non-deterministic if chunks not combined
-        merged_table = merged_table.combine_chunks()
-        self.save_table(Type, merged_table)
+        fragments = self._table_fragments(metadata)
+        if fragments:
+            table = self._read_fragments(metadata, fragments)
+            self._replace_fragments(metadata, fragments, table)
 
     def upsert_record(self, Type: t.Type[R], record: R, filter: pc.Expression):
+        self._assert_writable()
+        self._apply(
+            table_metadatas[Type], lambda db: db._upsert_where(Type, record, filter)
+        )
+
+    def _upsert_where(self, Type: t.Type[R], record: R, filter: pc.Expression):
         metadata = table_metadatas[Type]
         table = self.load_table(Type)
-        is_in_table = table.filter(filter)
-        if is_in_table.num_rows == 0:
-            self.append_record(Type, record)
+        record_table = pa.Table.from_pylist([record], schema=metadata.schema)
+        if table.filter(filter).num_rows == 0:
+            self._append_table(metadata, record_table)
         else:
             table_without_new = table.filter(~filter)
-            record_table = pa.Table.from_pylist([record], schema=metadata.schema)
             merged_table = pa.concat_tables([table_without_new, record_table])
-            self.save_table(Type, merged_table)
+            self._save_table(metadata, merged_table)
+
+    def upsert_committed(
+        self, Type: t.Type[R], table: pa.Table, key_columns: list[str]
+    ) -> None:
+        """Upsert rows in a session of their own, and commit them right away
+
+        For rows that must not be lost with this session, such as single use
+        refresh tokens. This session does not see them. Commits that conflict are
+        redone, so concurrent writers do not make it fail.
+        """
+        with Database.get_db_mgr(self.load_dir) as db:
+            db.upsert_records(Type, table, key_columns)
+
+    def upsert_records(
+        self, Type: t.Type[R], table: pa.Table, key_columns: list[str]
+    ) -> None:
+        """Replace the rows that match a row of table on key_columns, append the rest"""
+        self._assert_writable()
+        metadata = table_metadatas[Type]
+        table = table.cast(metadata.schema)
+        self._mutate(metadata, PendingMutation("upsert", table, tuple(key_columns)))
+
+    def _upsert_table(
+        self, metadata: "TableMetadata", table: pa.Table, key_columns: list[str]
+    ) -> None:
+        if table.num_rows == 0:
+            return
+        table = _last_per_key(table, key_columns)
+        fragments = self._table_fragments(metadata)
+        if not fragments:
+            self._append_table(metadata, table)
+            return
+        keys = table.select(key_columns)
+        partition_columns = (
+            [] if metadata.partitioning is None else metadata.partitioning.schema.names
+        )
+        columns = list(dict.fromkeys(key_columns + partition_columns)) + ["__filename"]
+        existing_keys = self._read_fragments(metadata, fragments, columns=columns)
+        matching = existing_keys.filter(_match_keys(existing_keys, keys))
+        if matching.num_rows == 0:
+            self._append_table(metadata, table)
+            return
+        # only the partitions holding rows to replace are rewritten, the rows for
+        # other partitions are appended
+        matching_paths = {Path(path) for path in matching["__filename"].to_pylist()}
+        partitions = {
+            fragment.path.parent
+            for fragment in fragments
+            if self._fragment_path(metadata, fragment) in matching_paths
+        }
+        affected = [f for f in fragments if f.path.parent in partitions]
+        in_affected = (
+            _match_keys(table, matching.select(partition_columns))
+            if partition_columns
+            else pa.array([True] * table.num_rows)
+        )
+        rewritten = table.filter(in_affected)
+        if metadata.validators is not None:
+            for validator in metadata.validators:
+                _validate(rewritten, validator)
+        existing = self._read_fragments(metadata, affected)
+        merged = pa.concat_tables(
+            [existing.filter(pc.invert(_match_keys(existing, keys))), rewritten]
+        )
+        unaffected = [f for f in fragments if f not in affected]
+        self._check_unique(metadata, merged, unaffected)
+        self._replace_fragments(metadata, affected, merged)
+        self._append_table(metadata, table.filter(pc.invert(in_affected)))
+
+    def delete_records_many(self, Type: t.Type[R], keys: pa.Table) -> None:
+        """Delete the rows that match a row of keys on the columns of keys"""
+        self._assert_writable()
+        metadata = table_metadatas[Type]
+        keys = keys.cast(
+            pa.schema([metadata.schema.field(c) for c in keys.column_names])
+        )
+        self._mutate(
+            metadata, PendingMutation("delete", keys, tuple(keys.column_names))
+        )
+
+    def _delete_keys(self, metadata: "TableMetadata", keys: pa.Table) -> None:
+        fragments = self._table_fragments(metadata)
+        if not fragments or keys.num_rows == 0:
+            return
+        columns = keys.column_names + ["__filename"]
+        table = self._read_fragments(metadata, fragments, columns=columns)
+        matching = table.filter(_match_keys(table, keys)).column("__filename")
+        self._delete_from_partitions(
+            metadata,
+            {Path(path) for path in matching.to_pylist()},
+            lambda table: table.filter(pc.invert(_match_keys(table, keys))),
+        )
+
+    def _delete_from_partitions(
+        self,
+        metadata: "TableMetadata",
+        matching_paths: set[Path],
+        keep: t.Callable[[pa.Table], pa.Table],
+    ) -> None:
+        # only partitions with matching rows are rewritten, possibly to nothing
+        fragments = self._table_fragments(metadata)
+        partitions = {
+            fragment.path.parent
+            for fragment in fragments
+            if self._fragment_path(metadata, fragment) in matching_paths
+        }
+        affected = [f for f in fragments if f.path.parent in partitions]
+        if affected:
+            kept = keep(self._read_fragments(metadata, affected))
+            self._replace_fragments(metadata, affected, kept)
+
+    @contextmanager
+    def batch(self):
+        """Buffer appends, upserts and deletes, and apply them per table at the end
+
+        Consecutive mutations of the same kind on a table are applied as one write.
+        Buffered mutations of a table are applied before it is read or written
+        otherwise, so the session always sees its own changes.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            if self._batch_depth == 1:
+                self._pending.clear()
+            raise
+        finally:
+            self._batch_depth -= 1
+        if self._batch_depth == 0:
+            for metadata in table_metadatas.values():
+                if metadata.name in self._pending:
+                    self._flush(metadata)
+
+    def _buffer(self, metadata: "TableMetadata", mutation: "PendingMutation") -> None:
+        pending = self._pending.setdefault(metadata.name, [])
+        if pending and pending[-1].can_merge(mutation):
+            pending[-1] = pending[-1].merge(mutation)
+        else:
+            pending.append(mutation)
+
+    def _flush(self, metadata: "TableMetadata") -> None:
+        for mutation in self._pending.pop(metadata.name):
+            self._apply(metadata, partial(mutation.apply, metadata=metadata))
+
+    def _mutate(self, metadata: "TableMetadata", mutation: "PendingMutation") -> None:
+        if self._batch_depth:
+            self._buffer(metadata, mutation)
+        else:
+            self._apply(metadata, partial(mutation.apply, metadata=metadata))
+
+    def _apply(self, metadata: "TableMetadata", change: Change) -> None:
+        """Make a change to a table, and keep it to redo if the commit conflicts"""
+        if metadata.name in self._pending:
+            self._flush(metadata)
+        change(self)
+        self._changes.setdefault(metadata.name, []).append(change)
+
+    def _redo(self, metadata: "TableMetadata", head: list[Path]) -> None:
+        """Make the changes to a table again, on top of the committed fragments"""
+        log.info(f"Redoing changes to {metadata.name} on version {self.version}")
+        changes = self._changes.pop(metadata.name, [])
+        self._drop_fragments(metadata, self._fragments[metadata.name])
+        self._fragments[metadata.name] = [Fragment(self.load_dir, p) for p in head]
+        self._base[metadata.name] = head
+        del self._changed[metadata.name]
+        for change in changes:
+            self._apply(metadata, change)
+
+    def _redo_conflicting(self, metadatas: list["TableMetadata"]) -> None:
+        """Redo the changes to tables that conflict with the pinned version"""
+        self._forget_unchanged()
+        for metadata in metadatas:
+            head = self._committed_paths(metadata)
+            try:
+                _rebase(
+                    base=self._base[metadata.name],
+                    ours=[f.path for f in self._fragments[metadata.name]],
+                    head=head,
+                    partitions=self._changed[metadata.name],
+                )
+            except CommitConflictError:
+                self._redo(metadata, head)
+
+    def stage(self) -> "Database":
+        """Open a session for another thread, whose changes merge() takes over
+
+        Its appends, upserts and deletes stay buffered as in batch(), so they are
+        merged as mutations. Only partitions it had to rewrite can conflict.
+        """
+        self._assert_writable()
+        # inside this session's staging directory, which garbage collection skips
+        staged = Database(
+            save_dir=self.save_dir / uuid.uuid4().hex, load_dir=self.load_dir
+        )
+        staged._batch_depth = 1
+        return staged
+
+    def merge(self, other: "Database") -> None:
+        """Rebase the uncommitted changes of a session from stage() onto this one
+
+        Changes to partitions that both rewrote are made again in this session.
+        """
+        metadatas = list(table_metadatas.values())
+        rebased: dict[str, list[Fragment]] = {}
+        conflicting = []
+        for metadata in metadatas:
+            if metadata.name not in other._changed:
+                continue
+            ours = self._table_fragments(metadata)
+            theirs = other._fragments[metadata.name]
+            by_path = {fragment.path: fragment for fragment in ours + theirs}
+            try:
+                paths = _rebase(
+                    base=other._base[metadata.name],
+                    ours=[fragment.path for fragment in theirs],
+                    head=[fragment.path for fragment in ours],
+                    partitions=other._changed[metadata.name],
+                )
+            except CommitConflictError:
+                conflicting.append(metadata)
+                continue
+            rebased[metadata.name] = [by_path[path] for path in paths]
+        for name, fragments in rebased.items():
+            self._fragments[name] = fragments
+            self._changed.setdefault(name, set()).update(other._changed[name])
+            self._changes.setdefault(name, []).extend(other._changes.get(name, []))
+        for metadata in conflicting:
+            log.info(f"Redoing merged changes to {metadata.name}")
+            for change in other._changes.get(metadata.name, []):
+                self._apply(metadata, change)
+        for metadata in metadatas:
+            for mutation in other._pending.get(metadata.name, []):
+                self._buffer(metadata, mutation)
+            if metadata.name in self._pending and not self._batch_depth:
+                self._flush(metadata)
 
     def delete_records(self, Type: t.Type[R], filter: pc.Expression):
-        new_table = self.load_table(Type, filter=~filter)
-        self.save_table(Type, new_table)
+        self._assert_writable()
+        self._apply(table_metadatas[Type], lambda db: db._delete_where(Type, filter))
 
-    def delete_partion(self, Type: t.Type[R], partition_id: Id):
+    def _delete_where(self, Type: t.Type[R], filter: pc.Expression):
         metadata = table_metadatas[Type]
-        shutil.rmtree(
-            str(self.save_dir / metadata.name / partition_id), ignore_errors=True
+        if metadata.partitioning is None:
+            new_table = self.load_table(Type, filter=~filter)
+            self._save_table(metadata, new_table)
+            return
+        fragments = self._table_fragments(metadata)
+        if not fragments:
+            return
+        matching = self._read_fragments(
+            metadata, fragments, filter=filter, columns=["__filename"]
         )
+        self._delete_from_partitions(
+            metadata,
+            {Path(path) for path in matching.column(0).to_pylist()},
+            lambda table: ds.dataset(table).to_table(filter=~filter),
+        )
+
+    def delete_partion(self, Type: t.Type[R], partition_id: Id):
+        self._assert_writable()
+        metadata = table_metadatas[Type]
+        self._apply(metadata, lambda db: db._delete_partition(metadata, partition_id))
+
+    def _delete_partition(self, metadata: "TableMetadata", partition_id: Id):
+        partitioning = metadata.partitioning
+        assert partitioning is not None
+        if isinstance(partitioning, ds.HivePartitioning):
+            partition_name = f"{partitioning.schema.names[0]}={partition_id}"
+        else:
+            partition_name = partition_id
+        fragments = self._table_fragments(metadata)
+        in_partition = [f for f in fragments if f.path.parts[0] == partition_name]
+        self._drop_fragments(metadata, in_partition)
+        self._fragments[metadata.name] = [
+            fragment for fragment in fragments if fragment not in in_partition
+        ]
+        self._mark_changed(metadata, in_partition)
+
+    def _move_into_place(self, metadata: "TableMetadata") -> list[Fragment]:
+        table_dir = self.load_dir / metadata.name
+        committed = []
+        for fragment in self._table_fragments(metadata):
+            if fragment.root != self.load_dir:
+                from_path = self._fragment_path(metadata, fragment)
+                to_path = table_dir / fragment.path
+                to_path.parent.mkdir(parents=True, exist_ok=True)
+                if metadata.indexes:
+                    shutil.move(str(_index_path(from_path)), _index_path(to_path))
+                    _fsync(_index_path(to_path))
+                shutil.move(str(from_path), to_path)
+                _fsync(to_path)
+                _fsync(to_path.parent)
+            committed.append(Fragment(self.load_dir, fragment.path))
+        return committed
+
+    def _to_commit(self, metadatas: list["TableMetadata"]) -> list["TableMetadata"]:
+        for metadata in metadatas:
+            if metadata.name in self._pending:
+                self._flush(metadata)
+        return [metadata for metadata in metadatas if metadata.name in self._changed]
+
+    def _commit(self, metadatas: list["TableMetadata"]) -> None:
+        """Commit the changes to tables, redone on top of commits made meanwhile"""
+        n_conflicts = 0
+        while True:
+            to_commit = self._to_commit(metadatas)
+            if not to_commit:
+                return
+            try:
+                with self.lock.exclusive():
+                    self._commit_locked(to_commit)
+                return
+            except CommitConflictError:
+                n_conflicts += 1
+                if n_conflicts > config.commit_retries:
+                    raise
+            with self.lock.shared():
+                self._pin_latest()
+            self._redo_conflicting(to_commit)
+
+    def _commit_locked(self, to_commit: list["TableMetadata"]) -> None:
+        """Make the changes to the tables a new version, must hold the lock"""
+        self.recover(self.load_dir)
+        versions = _list_versions(self.load_dir)
+        if not versions:
+            # first commit over tables written before versioning
+            legacy = _read_legacy_manifest(self.load_dir)
+            if legacy is None:
+                legacy = {
+                    metadata.name: _list_fragments(self.load_dir / metadata.name)
+                    for metadata in table_metadatas.values()
+                }
+            (self.load_dir / VERSIONS_NAME).mkdir(exist_ok=True)
+            _write_manifest(_version_path(self.load_dir, 1), legacy)
+            (self.load_dir / MANIFEST_NAME).unlink(missing_ok=True)
+            versions = [1]
+        head = versions[-1]
+        manifest = _read_manifest(_version_path(self.load_dir, head))
+        # other sessions may have committed since this one was opened
+        for metadata in to_commit:
+            manifest[metadata.name] = _rebase(
+                base=self._base[metadata.name],
+                ours=[f.path for f in self._table_fragments(metadata)],
+                head=manifest.get(metadata.name, []),
+                partitions=self._changed[metadata.name],
+            )
+        changed = {
+            metadata.name: self._changed.pop(metadata.name) for metadata in to_commit
+        }
+        for name in changed:
+            self._changes.pop(name, None)
+        journal = {
+            name: [p.as_posix() for p in parts] for name, parts in changed.items()
+        }
+        _write_json_atomic(self.load_dir / JOURNAL_NAME, journal)
+
+        for metadata in to_commit:
+            self._move_into_place(metadata)
+        # the commit takes effect once the new version is in place
+        _write_manifest(_version_path(self.load_dir, head + 1), manifest)
+        self._pin(head + 1)
+        for metadata in to_commit:
+            table_cache.invalidate(self.load_dir, metadata.name)
+        self._forget_unchanged()
+
+        self._collect_garbage(changed)
+        (self.load_dir / JOURNAL_NAME).unlink()
+
+    def _forget_unchanged(self) -> None:
+        # uncommitted tables keep their changes, the rest is read anew
+        self._fragments = {
+            name: fragments
+            for name, fragments in self._fragments.items()
+            if name in self._changed
+        }
+        self._base = {
+            name: paths for name, paths in self._base.items() if name in self._changed
+        }
+
+    def _collect_garbage(self, changed: dict[str, set[Path]]) -> None:
+        """Remove versions no session has pinned, and files no version references"""
+        dropped: dict[str, set[Path]] = {}
+        for version in _list_versions(self.load_dir)[:-1]:
+            path = _version_path(self.load_dir, version)
+            fd = _try_lock_exclusive(path)
+            if fd is None:
+                continue
+            for name, fragments in _read_manifest(path).items():
+                dropped.setdefault(name, set()).update(fragments)
+            path.unlink()
+            os.close(fd)
+
+        referenced = _referenced(self.load_dir)
+        partitions = {name: set(parts) for name, parts in changed.items()}
+        for name, paths in dropped.items():
+            unreferenced = paths - referenced.get(name, set())
+            partitions.setdefault(name, set()).update(p.parent for p in unreferenced)
+        _remove_unreferenced(self.load_dir, partitions, referenced)
+
+        staging_root = self.load_dir / STAGING_NAME
+        if staging_root.exists():
+            for staging_dir in staging_root.iterdir():
+                fd = _try_lock_exclusive(staging_dir)
+                if fd is not None:
+                    # left behind by a session that died
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+                    os.close(fd)
 
     def commit(self):
-        self.load_dir.mkdir(exist_ok=True)
-        for metadata in self.save_dir.iterdir():
-            to_path = self.load_dir / metadata.name
-            shutil.copytree(metadata, to_path, dirs_exist_ok=True)
+        self._commit(list(table_metadatas.values()))
 
     def commit_table(self, Type: t.Type[R]):
-        metadata = table_metadatas[Type]
-        from_path = self.save_dir / metadata.name
-        to_path = self.load_dir / metadata.name
-        shutil.copytree(from_path, to_path, dirs_exist_ok=True)
+        self._commit([table_metadatas[Type]])
 
     @staticmethod
     def make_id() -> Id:
         return Id(uuid.uuid4().hex)
 
+    @staticmethod
+    def make_ids(n: int) -> pa.Array:
+        """n ids as make_id makes them, built as one string array"""
+        raw = np.frombuffer(os.urandom(16 * n), dtype=np.uint8).reshape(n, 16).copy()
+        # version 4 and the RFC 4122 variant, as uuid.uuid4
+        raw[:, 6] = raw[:, 6] & 0x0F | 0x40
+        raw[:, 8] = raw[:, 8] & 0x3F | 0x80
+        data = pa.py_buffer(raw.tobytes().hex().encode("ascii"))
+        offsets = pa.py_buffer(np.arange(0, 32 * n + 1, 32, dtype=np.int32))
+        return pa.StringArray.from_buffers(n, offsets, data)
+
+
+class AsyncDatabase:
+    """Database session for async code
+
+    The file I/O of a session is done in db_executor, so the number of threads
+    stays bounded however many requests are served, and the database lock is
+    waited for on the event loop. Sync code takes the session as `db.session`,
+    through `db.run`. Sync code that also waits on the network is run in
+    starlette's threadpool instead, so that it does not hold up the file I/O.
+    """
+
+    def __init__(self, session: Database):
+        self.session = session
+
+    @classmethod
+    async def _open(
+        cls, save_dir: Path, load_dir: Path, read_only: bool = False
+    ) -> "AsyncDatabase":
+        session = await run_io(
+            Database,
+            save_dir=save_dir,
+            load_dir=load_dir,
+            read_only=read_only,
+            pin_latest=False,
+        )
+        async with session.lock.async_shared():
+            await run_io(session._pin_latest)
+        return cls(session)
+
+    @classmethod
+    @asynccontextmanager
+    async def get_db_mgr(cls, load_dir: Path = config.tables_path):
+        async with _async_staging_dir(load_dir) as staging_dir:
+            db = await cls._open(save_dir=staging_dir, load_dir=load_dir)
+            try:
+                yield db
+                await db.commit()
+            finally:
+                db.session.close()
+
+    @classmethod
+    async def get_db(cls):
+        async with cls.get_db_mgr() as db:
+            yield db
+
+    @classmethod
+    @asynccontextmanager
+    async def get_read_db_mgr(cls, load_dir: Path = config.tables_path):
+        db = await cls._open(save_dir=load_dir, load_dir=load_dir, read_only=True)
+        try:
+            yield db
+        finally:
+            db.session.close()
+
+    @classmethod
+    async def get_read_db(cls):
+        async with cls.get_read_db_mgr() as db:
+            yield db
+
+    async def run(self, function: t.Callable[..., T], *args, **kwargs) -> T:
+        """Call function in db_executor, for sync code that uses the session
+
+        Only for file I/O, function must not wait on the network.
+        """
+        return await run_io(function, *args, **kwargs)
+
+    async def load_table(
+        self,
+        Type: t.Type[R],
+        filter: t.Optional[pc.Expression] = None,
+        columns: t.Optional[list[str]] = None,
+        where: t.Optional[dict[str, t.Any]] = None,
+    ) -> pa.Table:
+        return await run_io(self.session.load_table, Type, filter, columns, where)
+
+    async def load_records(
+        self,
+        Type: t.Type[R],
+        filter: t.Optional[pc.Expression] = None,
+        columns: t.Optional[list[str]] = None,
+        where: t.Optional[dict[str, t.Any]] = None,
+    ) -> list[R]:
+        return await run_io(self.session.load_records, Type, filter, columns, where)
+
+    async def save_table(self, Type: t.Type[R], table: pa.Table) -> None:
+        await run_io(self.session.save_table, Type, table)
+
+    async def append_records(self, Type: t.Type[R], records: list[R]) -> None:
+        await run_io(self.session.append_records, Type, records)
+
+    async def append_record(self, Type: t.Type[R], record: R) -> None:
+        await run_io(self.session.append_record, Type, record)
+
+    async def upsert_record(
+        self, Type: t.Type[R], record: R, filter: pc.Expression
+    ) -> None:
+        await run_io(self.session.upsert_record, Type, record, filter)
+
+    async def upsert_records(
+        self, Type: t.Type[R], table: pa.Table, key_columns: list[str]
+    ) -> None:
+        await run_io(self.session.upsert_records, Type, table, key_columns)
+
+    async def delete_records(self, Type: t.Type[R], filter: pc.Expression) -> None:
+        await run_io(self.session.delete_records, Type, filter)
+
+    async def delete_records_many(self, Type: t.Type[R], keys: pa.Table) -> None:
+        await run_io(self.session.delete_records_many, Type, keys)
+
+    async def commit(self) -> None:
+        metadatas = list(table_metadatas.values())
+        n_conflicts = 0
+        while True:
+            to_commit = await run_io(self.session._to_commit, metadatas)
+            if not to_commit:
+                return
+            try:
+                async with self.session.lock.async_exclusive():
+                    await run_io(self.session._commit_locked, to_commit)
+                return
+            except CommitConflictError:
+                n_conflicts += 1
+                if n_conflicts > config.commit_retries:
+                    raise
+            async with self.session.lock.async_shared():
+                await run_io(self.session._pin_latest)
+            await run_io(self.session._redo_conflicting, to_commit)
+
+    def make_id(self) -> Id:
+        return self.session.make_id()
+
+
+@dataclass(frozen=True)
+class Index:
+    columns: tuple[str, ...]
+    unique: bool = False
+
+    @property
+    def name(self) -> str:
+        return ",".join(self.columns)
+
 
 @dataclass
 class TableMetadata:
@@ -193,6 +1521,27 @@ class TableMetadata:
     schema: pa.Schema
     partitioning: t.Optional[ds.Partitioning] = None
     validators: t.Optional[list[pc.Expression]] = None
+    # small tables read on most requests are kept decoded in memory
+    cached: bool = False
+    indexes: list[Index] = field(default_factory=list)
+    # fragments are written sorted and load in order, with row group statistics
+    # that let range filters skip row groups
+    sort_by: t.Optional[list[tuple[str, str]]] = None
+    row_group_size: int = 1 << 20
+
+
+def _find_index(metadata: TableMetadata, where: dict[str, t.Any]) -> t.Optional[Index]:
+    usable = [index for index in metadata.indexes if set(index.columns) <= set(where)]
+    if not usable:
+        return None
+    return max(usable, key=lambda index: (index.unique, len(index.columns)))
+
+
+def _empty_table(metadata: TableMetadata, columns: t.Optional[list[str]]) -> pa.Table:
+    table = pa.Table.from_pylist([], schema=metadata.schema)
+    if columns is not None:
+        table = table.select(columns)
+    return table
 
 
 user_schema = _make_schema(models.User)
@@ -202,23 +1551,32 @@ polar_cache_schema = _make_schema(models.PolarCache)
 trek_schema = _make_schema(models.Trek)
 leg_schema = _make_schema(models.Leg)
 waypoint_schema = _make_schema(models.Waypoint)
+leg_simplification_schema = _make_schema(models.LegSimplification)
+leg_summary_schema = _make_schema(models.LegSummary)
 location_schema = _make_schema(models.Location)
 trek_user_schema = _make_schema(models.TrekUser)
 step_schema = _make_schema(models.Step)
 achievement_schema = _make_schema(models.Achievement)
+achievement_state_schema = _make_schema(models.AchievementState)
+trek_stats_schema = _make_schema(models.TrekStats)
 
 table_metadatas: dict[t.Any, TableMetadata] = {
     models.User: TableMetadata(
         name="users",
         schema=user_schema,
+        cached=True,
+        indexes=[Index(("id",), unique=True)],
     ),
     models.UserToken: TableMetadata(
         name="user_tokens",
         schema=user_token_schema,
+        indexes=[Index(("tracker_user_id",)), Index(("user_id",))],
     ),
     models.TrekUser: TableMetadata(
         name="trek_users",
         schema=trek_user_schema,
+        cached=True,
+        indexes=[Index(("trek_id",)), Index(("user_id",))],
     ),
     models.DiscordChannel: TableMetadata(
         name="discord_channels",
@@ -232,26 +1590,85 @@ table_metadatas: dict[t.Any, TableMetadata] = {
         name="treks",
         schema=trek_schema,
         validators=models.trek_validators,
+        cached=True,
+        indexes=[Index(("id",), unique=True)],
     ),
     models.Leg: TableMetadata(
         name="legs",
         schema=leg_schema,
+        cached=True,
+        indexes=[Index(("id",), unique=True), Index(("trek_id",))],
     ),
     models.Waypoint: TableMetadata(
         name="waypoints",
         schema=waypoint_schema,
         partitioning=models.waypoints_partitioning,
+        sort_by=[("distance", "ascending")],
+        row_group_size=1024,
+    ),
+    models.LegSimplification: TableMetadata(
+        name="leg_simplifications",
+        schema=leg_simplification_schema,
+        partitioning=models.waypoints_partitioning,
+    ),
+    models.LegSummary: TableMetadata(
+        name="leg_geometry",
+        schema=leg_summary_schema,
+        cached=True,
+        indexes=[Index(("trek_id", "leg_id"), unique=True)],
     ),
     models.Location: TableMetadata(
         name="locations",
         schema=location_schema,
+        partitioning=models.trek_partitioning,
+        indexes=[Index(("trek_id", "leg_id"))],
+        sort_by=[("trek_id", "ascending"), ("added_at", "ascending")],
+        row_group_size=1024,
     ),
     models.Step: TableMetadata(
         name="steps",
         schema=step_schema,
+        partitioning=models.trek_partitioning,
+        indexes=[Index(("trek_id", "leg_id"))],
+        sort_by=[("trek_id", "ascending"), ("taken_at", "ascending")],
+        row_group_size=4096,
     ),
     models.Achievement: TableMetadata(
         name="achievements",
         schema=achievement_schema,
     ),
+    models.AchievementState: TableMetadata(
+        name="achievement_states",
+        schema=achievement_state_schema,
+        partitioning=models.trek_partitioning,
+    ),
+    models.TrekStats: TableMetadata(
+        name="trek_stats",
+        schema=trek_stats_schema,
+        partitioning=models.trek_partitioning,
+    ),
 }
+
+
+def migrate() -> None:
+    """Rewrite fragments written before the table was partitioned, or indexed"""
+    with Database.get_db_mgr() as db:
+        for Type, metadata in table_metadatas.items():
+            fragments = db._table_fragments(metadata)
+            if metadata.partitioning is not None and any(
+                fragment.path.parent == Path(".") for fragment in fragments
+            ):
+                log.info(f"Repartitioning {metadata.name}")
+                db.repartition(Type)
+                # the rewritten fragments are indexed
+                continue
+            if not metadata.indexes:
+                continue
+            unindexed = {
+                fragment.path.parent
+                for fragment in fragments
+                if not db._is_indexed(metadata, fragment)
+            }
+            if unindexed:
+                log.info(f"Indexing {metadata.name}")
+                db.compact(Type, unindexed)
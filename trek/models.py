@@ -77,6 +77,35 @@ class Waypoint(t.TypedDict):
     distance: t.Annotated[float, pa.float64()]
 
 
+# the line of a leg simplified with Douglas–Peucker at tolerance, in meters
+class LegSimplification(t.TypedDict):
+    trek_id: Id
+    leg_id: Id
+    tolerance: t.Annotated[float, pa.float64()]
+    lat: t.Annotated[list[float], pa.list_(pa.float64())]
+    lon: t.Annotated[list[float], pa.list_(pa.float64())]
+    distance: t.Annotated[list[float], pa.list_(pa.float64())]
+
+
+# what never changes about the line of a leg, stored when its waypoints are added
+class LegSummary(t.TypedDict):
+    trek_id: Id
+    leg_id: Id
+    n_waypoints: t.Annotated[int, pa.uint32()]
+    total_distance: t.Annotated[float, pa.float64()]
+    start_waypoint_id: Id
+    start_lat: t.Annotated[float, pa.float64()]
+    start_lon: t.Annotated[float, pa.float64()]
+    end_waypoint_id: Id
+    end_lat: t.Annotated[float, pa.float64()]
+    end_lon: t.Annotated[float, pa.float64()]
+    # the bounding box
+    min_lat: t.Annotated[float, pa.float64()]
+    min_lon: t.Annotated[float, pa.float64()]
+    max_lat: t.Annotated[float, pa.float64()]
+    max_lon: t.Annotated[float, pa.float64()]
+
+
 waypoints_partitioning = ds.partitioning(
     schema=pa.schema(
         [
@@ -86,6 +115,12 @@ waypoints_partitioning = ds.partitioning(
     )
 )
 
+# one directory per trek, so daily updates only touch their own trek's files
+trek_partitioning = ds.partitioning(
+    schema=pa.schema([pa.field("trek_id", pa.string(), nullable=False)]),
+    flavor="hive",
+)
+
 
 class Location(t.TypedDict):
     trek_id: Id
@@ -126,3 +161,41 @@ class Achievement(t.TypedDict):
     achievement_type: str
     description: str
     unit: str
+
+
+# the running state of an achievement type, over the days of a trek or of a leg
+class AchievementState(t.TypedDict):
+    trek_id: Id
+    # the trek id for the whole trek, the leg id for a leg
+    scope: Id
+    achievement_type: str
+    # the last day added
+    taken_at: pendulum.Date
+    n_days: t.Annotated[int, pa.uint32()]
+    # in the order the users first took steps in the trek
+    user_ids: t.Annotated[list[Id], pa.list_(pa.string())]
+    # the last amounts of each user, in rows of user_ids, NaN before the first
+    recent_amounts: t.Annotated[list[float], pa.list_(pa.float64())]
+    record_user_id: t.Optional[Id]
+    record_taken_at: t.Optional[pendulum.Date]
+    record_amount: t.Annotated[t.Optional[float], pa.float64()]
+    streak_user_id: t.Optional[Id]
+    streak_length: t.Annotated[int, pa.uint32()]
+
+
+# running totals of a trek or of a leg, for the factoids
+class TrekStats(t.TypedDict):
+    trek_id: Id
+    # the trek id for the whole trek, the leg id for a leg
+    scope: Id
+    # the last day with steps
+    taken_at: t.Optional[pendulum.Date]
+    # days with a location, the last of them located_at
+    n_days: t.Annotated[int, pa.uint32()]
+    located_at: t.Optional[pendulum.Date]
+    # in the order the users first took steps
+    user_ids: t.Annotated[list[Id], pa.list_(pa.string())]
+    step_totals: t.Annotated[list[int], pa.list_(pa.uint64())]
+    # the days of the last week with steps, and a row of user_ids' amounts for each
+    recent_days: t.Annotated[list[pendulum.Date], pa.list_(pa.date32())]
+    recent_amounts: t.Annotated[list[int], pa.list_(pa.uint32())]
@@ -9,11 +9,7 @@ from fastapi import Depends
 from fastapi_jwt_auth import AuthJWT
 
 
-def round_coords(coordinates: float) -> float:
-    return round(coordinates, 7)
-
-
-def protect_endpoint(Authorize: AuthJWT = Depends()):
+async def protect_endpoint(Authorize: AuthJWT = Depends()):
     Authorize.jwt_required()
 
 